@@ -0,0 +1,130 @@
+import time
+import numpy as np
+from profiling import add_time
+
+
+def augment_rng(seed, epoch, idx):
+    '''
+    :return: RandomState of batch `idx` in `epoch`, so augmented batches do not depend on the worker computing them
+    '''
+    return np.random.RandomState([seed, epoch, idx])
+
+
+def crop_origins(rng, n, shape, crop, batch_y=None, outline=0.5):
+    '''
+    draw the top-left corners of n `crop` windows in images of `shape`: with probability `outline` (when masks
+    are given) the window is centred on a random pixel of the mask outline, the pixels a refinement model
+    predicts, else it is uniform over the image
+    :param shape: (rows, cols) of the images
+    :param crop: (rows, cols) of the windows
+    :param batch_y: optional [n, rows, cols, 1] masks
+    :return: int64 [n, 2] (row, col) corners
+    '''
+    rows, cols = shape[0] - crop[0], shape[1] - crop[1]
+    if rows < 0 or cols < 0:
+        raise ValueError("crop {} does not fit images of {}".format(tuple(crop), tuple(shape)))
+    origins = np.stack([rng.randint(0, rows + 1, n), rng.randint(0, cols + 1, n)], axis=1).astype(np.int64)
+    centred = rng.uniform(size=n) < outline
+    for i in np.flatnonzero(centred) if batch_y is not None else []:
+        mask = batch_y[i, :, :, 0] > 0.5
+        edge = np.zeros_like(mask)
+        edge[1:] |= mask[1:] != mask[:-1]
+        edge[:, 1:] |= mask[:, 1:] != mask[:, :-1]
+        points = np.argwhere(edge)
+        if len(points):
+            r, c = points[rng.randint(len(points))]
+            origins[i] = np.clip(r - crop[0] // 2, 0, rows), np.clip(c - crop[1] // 2, 0, cols)
+    return origins
+
+
+def random_affine(rng, n, shape, flip=0.5, rotate=5., scale=(0.9, 1.1), shift=0.05, shear=0.02):
+    '''
+    draw n affine maps about the image centre, each a horizontal flip (with probability `flip`), a rotation in
+    [-rotate, rotate] degrees, a zoom in `scale` (> 1 crops), a shear and a shift of up to `shift` x the image
+    size
+    :param shape: (rows, cols)
+    :return: float32 [n, 2, 3]: the source (row, col) of output pixel (row, col) is m @ (row, col, 1)
+    '''
+    h, w = shape
+    angle = np.deg2rad(rng.uniform(-rotate, rotate, n))
+    zoom = np.exp(rng.uniform(np.log(scale[0]), np.log(scale[1]), n))
+    s = rng.uniform(-shear, shear, n)
+    t = rng.uniform(-shift, shift, (n, 2)) * [h, w]
+    flips = np.where(rng.uniform(size=n) < flip, -1., 1.)
+    cos, sin = np.cos(angle) / zoom, np.sin(angle) / zoom
+    # rotation x shear / zoom, then the flip of the output columns
+    a = np.empty((n, 2, 2))
+    a[:, 0, 0] = cos
+    a[:, 0, 1] = (cos * s - sin) * flips
+    a[:, 1, 0] = sin
+    a[:, 1, 1] = (sin * s + cos) * flips
+    centre = np.array([(h - 1) / 2., (w - 1) / 2.])
+    m = np.empty((n, 2, 3), dtype=np.float32)
+    m[:, :, :2] = a
+    m[:, :, 2] = centre + t - a.dot(centre)
+    return m
+
+
+def _source_coords(m, shape):
+    h, w = shape
+    rows = np.arange(h, dtype=np.float32)[None, :, None]
+    cols = np.arange(w, dtype=np.float32)[None, None, :]
+    m = m[:, :, :, None, None]
+    return m[:, 0, 0] * rows + m[:, 0, 1] * cols + m[:, 0, 2], m[:, 1, 0] * rows + m[:, 1, 1] * cols + m[:, 1, 2]
+
+
+def warp_batch(batch, m, bilinear=True):
+    '''
+    resample every image of `batch` through its affine map; source pixels outside the image repeat the edge
+    :param batch: [n, rows, cols, channel]
+    :param m: [n, 2, 3], see random_affine
+    :return: float32 [n, rows, cols, channel] with bilinear sampling, batch.dtype with nearest
+    '''
+    n, h, w, c = batch.shape
+    src_r, src_c = _source_coords(m, (h, w))
+    flat = batch.reshape(n * h * w, c)
+    base = (np.arange(n, dtype=np.intp) * h * w)[:, None, None]
+    if not bilinear:
+        r = np.clip(np.rint(src_r), 0, h - 1).astype(np.intp)
+        col = np.clip(np.rint(src_c), 0, w - 1).astype(np.intp)
+        return flat[base + r * w + col]
+    r0, c0 = np.floor(src_r), np.floor(src_c)
+    fr, fc = (src_r - r0)[..., None], (src_c - c0)[..., None]
+    r0 = np.clip(r0, 0, h - 1).astype(np.intp)
+    c0 = np.clip(c0, 0, w - 1).astype(np.intp)
+    r1 = np.minimum(r0 + 1, h - 1) * w
+    c1 = np.minimum(c0 + 1, w - 1)
+    r0 = r0 * w + base
+    r1 = r1 + base
+    top = flat[r0 + c0] * (1 - fc) + flat[r0 + c1] * fc
+    bottom = flat[r1 + c0] * (1 - fc) + flat[r1 + c1] * fc
+    return top * (1 - fr) + bottom * fr
+
+
+def augment_batch(batch_x, batch_y, rng, flip=0.5, rotate=5., scale=(0.9, 1.1), shift=0.05, shear=0.02,
+                  brightness=0.1, contrast=0.1, timings=None):
+    '''
+    augment a batch in place, vectorized over the batch: each image and its mask go through the same random
+    affine map (see random_affine), then the image gets a brightness shift of up to `brightness` x 255 and a
+    contrast factor in [1 - contrast, 1 + contrast] about its mean. uint8 {0, 1} masks are resampled nearest,
+    float coverage masks bilinear.
+    :param batch_x: uint8 [n, rows, cols, channel]
+    :param batch_y: [n, rows, cols, 1] or None
+    :param rng: RandomState, e.g. augment_rng(seed, epoch, idx)
+    :param timings: optional dict the seconds spent are added to as 'augment'
+    '''
+    start = time.time()
+    n = len(batch_x)
+    m = random_affine(rng, n, batch_x.shape[1:3], flip, rotate, scale, shift, shear)
+    gain = rng.uniform(1 - contrast, 1 + contrast, n).astype(np.float32)[:, None, None, None]
+    bias = (rng.uniform(-brightness, brightness, n) * 255.).astype(np.float32)[:, None, None, None]
+    if batch_y is not None:
+        batch_y[:] = warp_batch(batch_y, m, bilinear=batch_y.dtype != np.uint8)
+    x = warp_batch(batch_x, m)
+    mean = x.mean(axis=(1, 2, 3), keepdims=True)
+    x -= mean
+    x *= gain
+    x += mean + bias
+    np.clip(np.rint(x), 0, 255, out=x)
+    batch_x[:] = x
+    add_time(timings, 'augment', start)
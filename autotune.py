@@ -0,0 +1,322 @@
+import os
+import json
+import time
+import argparse
+import platform
+import numpy as np
+from multiprocessing import Pool
+from config import TARGET_SIZE, DECODE_BACKEND
+from utils import DECODE_BACKENDS
+from models import UPSAMPLE_MODES
+
+PROFILE_DIR = 'experiment/autotune'
+BATCH_SIZES = (1, 2, 4, 8, 16, 32, 64)
+QUEUE_DEPTHS = (2, 4, 8, 16, 32)
+MODES = ('train', 'test')
+# keras' queue of batches in train.py and test.py
+MAX_QUEUE_SIZE = 2
+
+
+def profile_path(profile_dir=PROFILE_DIR, host=None):
+    '''
+    :return: json file of the autotuned settings of `host` (this machine by default)
+    '''
+    return os.path.join(profile_dir, (host or platform.node()) + '.json')
+
+
+def profile_key(mode, input_shape, stream=False):
+    '''
+    the loader ring of test.py --stream holds more batches, so streamed runs are tuned separately
+    '''
+    return '{}{}-{}x{}x{}'.format(mode, '-stream' if stream else '', *input_shape)
+
+
+def load_profile(mode, input_shape, path=None, stream=False):
+    '''
+    :return: the tuned settings of (mode, input_shape, stream) on this host, or None
+    '''
+    path = path or profile_path()
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f).get('entries', {}).get(profile_key(mode, input_shape, stream))
+
+
+def save_profile(entry, mode, input_shape, path=None, stream=False):
+    '''
+    store the tuned settings of (mode, input_shape, stream), keeping the other entries of the host profile
+    '''
+    path = path or profile_path()
+    stored = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            stored = json.load(f)
+    elif os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    stored.update({'host': platform.node(), 'cpu_count': os.cpu_count(), 'memory_bytes': physical_memory()})
+    stored.setdefault('entries', {})[profile_key(mode, input_shape, stream)] = entry
+    with open(path + '.tmp', 'w') as f:
+        json.dump(stored, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def apply_profile(args, mode, input_shape, defaults, path=None, stream=False):
+    '''
+    fill the arguments left unset (None) from the autotune profile of this host, or else from `defaults`;
+    arguments given on the command line are kept
+    :param defaults: {argument name: value without a profile}
+    :param stream: look up the profile tuned with autotune.py --stream
+    :return: the profile entry used, or None
+    '''
+    entry = load_profile(mode, input_shape, path, stream)
+    for name, default in defaults.items():
+        if getattr(args, name) is None:
+            setattr(args, name, entry[name] if entry and name in entry else default)
+    if entry:
+        print("{} settings for {} loaded from {}...".format(mode, profile_key(mode, input_shape, stream),
+                                                            path or profile_path()))
+    return entry
+
+
+def physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def worker_counts(cpu_count=None):
+    '''
+    :return: 1, 2, 4, ... up to and including the number of cores
+    '''
+    cpu_count = cpu_count or os.cpu_count() or 1
+    counts = [1 << i for i in range(cpu_count.bit_length()) if 1 << i < cpu_count]
+    return counts + [cpu_count]
+
+
+def loader_hold(queue_depth, stream=False):
+    '''
+    :return: loader batches the consumer keeps alive besides the prefetched ones (see Prefetcher): keras' queue
+        plus the batch in use, or every batch in flight in the stages of test.py --stream
+    '''
+    return queue_depth + 2 if stream else MAX_QUEUE_SIZE + 2
+
+
+def loader_bytes(input_shape, batch_size, queue_depth, hold, masks=True):
+    '''
+    :return: bytes of the uint8 batch ring of a Prefetcher
+    '''
+    rows, cols, channel = input_shape
+    return (queue_depth + hold) * batch_size * rows * cols * (channel + (1 if masks else 0))
+
+
+def timed_rate(step, items, seconds, min_steps=3):
+    '''
+    call `step` once untimed (graph building, first allocations), then repeatedly for `seconds`
+    :param items: images per call
+    :return: images/sec
+    '''
+    step()
+    n = 0
+    start = time.time()
+    while n < min_steps or time.time() - start < seconds:
+        step()
+        n += 1
+    return n * items / (time.time() - start)
+
+
+def choose_batch_size(trials, tolerance=0.05):
+    '''
+    :param trials: [{'batch_size', 'images_per_sec'}] of the model step
+    :return: the smallest batch size within `tolerance` of the best throughput
+    '''
+    best = max(t['images_per_sec'] for t in trials)
+    return min(t['batch_size'] for t in trials if t['images_per_sec'] >= (1 - tolerance) * best)
+
+
+def choose_loader(trials, model_rate=None, headroom=1.25, tolerance=0.05):
+    '''
+    the cheapest loader that keeps up: fewest workers, then shallowest queue, then the first decoder tried,
+    among the trials within `tolerance` of the target throughput, the best one or `headroom` x the model's if
+    less
+    :param trials: [{'workers', 'queue_depth', 'decode', 'images_per_sec'}] in the order they were run
+    :return: the chosen trial
+    '''
+    target = max(t['images_per_sec'] for t in trials)
+    if model_rate:
+        target = min(target, headroom * model_rate)
+    decodes = [t['decode'] for t in trials]
+    good = [t for t in trials if t['images_per_sec'] >= (1 - tolerance) * target]
+    return min(good, key=lambda t: (t['workers'], t['queue_depth'], decodes.index(t['decode'])))
+
+
+def tune_batch_size(model, mode, input_shape, budget, seconds=5., batch_sizes=BATCH_SIZES, gain=0.05):
+    '''
+    time the training (train_on_batch) or inference (predict_on_batch) step on random batches of growing size
+    until the throughput stops improving by `gain`, the estimated activations exceed `budget` bytes or the
+    device runs out of memory
+    :return: trials [{'batch_size', 'images_per_sec', 'activation_bytes'}]
+    '''
+    import tensorflow as tf
+    from model_report import activation_bytes
+    # training keeps the activations and their gradients
+    per_image = activation_bytes(model) * (2 if mode == 'train' else 1) if hasattr(model, 'layers') else 0
+    rng = np.random.RandomState(0)
+    trials = []
+    for batch_size in batch_sizes:
+        if trials and per_image * batch_size > budget:
+            print("batch size {}: {:.1f}GB of activations over the budget...".format(
+                batch_size, per_image * batch_size / 2. ** 30))
+            break
+        x = rng.randint(0, 256, (batch_size,) + tuple(input_shape)).astype(np.uint8)
+        y = rng.randint(0, 2, (batch_size,) + tuple(input_shape[:2]) + (1,)).astype(np.uint8)
+        step = (lambda: model.train_on_batch(x, y)) if mode == 'train' else (lambda: model.predict_on_batch(x))
+        try:
+            rate = timed_rate(step, batch_size, seconds)
+        except tf.errors.ResourceExhaustedError:
+            print("batch size {}: out of memory...".format(batch_size))
+            break
+        print("batch size %3d: %8.2f images/sec" % (batch_size, rate))
+        trials.append({'batch_size': batch_size, 'images_per_sec': rate, 'activation_bytes': per_image * batch_size})
+        if len(trials) > 1 and rate < (1 + gain) * max(t['images_per_sec'] for t in trials[:-1]):
+            break
+    return trials
+
+
+def tune_loader(fns, fn_dict, mode, input_shape, batch_size, budget, seconds=5., workers=None,
+                queue_depths=QUEUE_DEPTHS, decodes=(DECODE_BACKEND,), data_aug=False, gain=0.05, stream=False):
+    '''
+    time the Prefetcher of train.py or test.py for every decoder over growing worker counts and queue depths;
+    a dimension stops growing once it gains less than `gain`, and rings over `budget` bytes are skipped
+    :param stream: size the ring as test.py --stream does
+    :return: trials [{'decode', 'workers', 'queue_depth', 'images_per_sec', 'ring_bytes'}]
+    '''
+    from loader import CarvanaSequence, Prefetcher
+    train = mode == 'train'
+    trials = []
+    for decode in decodes:
+        best = 0.
+        for n_workers in workers or worker_counts():
+            best_depth = 0.
+            for queue_depth in queue_depths:
+                hold = loader_hold(queue_depth, stream and not train)
+                ring = loader_bytes(input_shape, batch_size, queue_depth, hold, masks=train)
+                if ring > budget:
+                    break
+                seq = CarvanaSequence(fns, fn_dict, target_size=input_shape[:2], grayscale=input_shape[2] == 1,
+                                      batch_size=batch_size, shuffle=train, data_aug=data_aug and train,
+                                      test=not train, decode=decode)
+                with Prefetcher(seq, workers=n_workers, queue_depth=queue_depth, hold=hold) as loader:
+                    rate = timed_rate(lambda: next(loader), batch_size, seconds)
+                print("%-6s %3d workers  queue depth %3d: %8.2f images/sec" % (decode, n_workers, queue_depth, rate))
+                trials.append({'decode': decode, 'workers': n_workers, 'queue_depth': queue_depth,
+                               'images_per_sec': rate, 'ring_bytes': ring})
+                if rate < (1 + gain) * best_depth:
+                    break
+                best_depth = max(best_depth, rate)
+            if best_depth < (1 + gain) * best:
+                break
+            best = max(best, best_depth)
+    return trials
+
+
+def build_model(args, input_shape):
+    '''
+    the checkpoint of --model, or a unet_family configuration with random weights compiled as in train.py
+    '''
+    from export import FrozenModel, load_keras_model
+    if args.model:
+        return FrozenModel(args.model) if args.model.endswith('.pb') else load_keras_model(args.model)
+    from keras.optimizers import rmsprop
+    from models import unet_family
+    from utils import bce_dc_loss, dice_coef
+    model = unet_family(input_shape, width=args.width, depth=args.depth, separable=args.separable,
+                        upsample=args.upsample)
+    model.compile(loss=bce_dc_loss, optimizer=rmsprop(1e-4), metrics=[dice_coef, 'accuracy'])
+    return model
+
+
+def _model_trials(args, input_shape, budget):
+    import tensorflow as tf
+    from keras.backend.tensorflow_backend import set_session
+    config = tf.ConfigProto()
+    config.gpu_options.per_process_gpu_memory_fraction = args.gpu
+    config.gpu_options.visible_device_list = args.gpus
+    set_session(tf.Session(config=config))
+    return tune_batch_size(build_model(args, input_shape), args.mode, input_shape, budget, args.seconds,
+                           args.batch_sizes)
+
+
+def create_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', type=str, default='train', choices=MODES, help="tune train.py or test.py")
+    parser.add_argument('--imdir', type=str, required=True, help="images the loader trials read")
+    parser.add_argument('--maskdir', type=str, default=None, help="masks of --imdir; required with --mode train")
+    parser.add_argument('--target_size', type=int, nargs=2, default=list(TARGET_SIZE))
+    parser.add_argument('--rgb', action='store_true')
+    parser.add_argument('--model', type=str, default=None,
+                        help="checkpoint or .pb to time (its input size is used); else a unet_family configuration")
+    parser.add_argument('--width', type=float, default=1.)
+    parser.add_argument('--depth', type=int, default=5)
+    parser.add_argument('--separable', action='store_true')
+    parser.add_argument('--upsample', type=str, default='transpose', choices=UPSAMPLE_MODES)
+    parser.add_argument('--data_aug', action='store_true', help="time the training loader with augmentation")
+    parser.add_argument('--stream', action='store_true',
+                        help="with --mode test, size the loader ring for test.py --stream (and --ensemble, --refine, "
+                             "--tiled)")
+    parser.add_argument('--decode', type=str, nargs='+', default=[DECODE_BACKEND], choices=DECODE_BACKENDS,
+                        help="jpeg decoders to try; the first is preferred when they keep up equally")
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=list(BATCH_SIZES))
+    parser.add_argument('--workers', type=int, nargs='+', default=None, help="default: 1, 2, 4, ... cores")
+    parser.add_argument('--queue_depths', type=int, nargs='+', default=list(QUEUE_DEPTHS))
+    parser.add_argument('--memory_gb', type=float, default=None,
+                        help="budget of the activations and of the loader ring each (default: half the host memory)")
+    parser.add_argument('--seconds', type=float, default=5., help="length of every timed trial")
+    parser.add_argument('--gpu', type=float, default=1.)
+    parser.add_argument('--gpus', type=str, default=None)
+    parser.add_argument('--profile', type=str, default=None, help="default: experiment/autotune/<host>.json")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = create_args()
+    if args.mode == 'train' and not args.maskdir:
+        raise ValueError("--mode train needs --maskdir")
+    if args.mode == 'train' and args.stream:
+        raise ValueError("--stream only applies to --mode test")
+    budget = args.memory_gb * 2 ** 30 if args.memory_gb else (physical_memory() or 2 ** 33) / 2
+    input_shape = tuple(args.target_size) + (3 if args.rgb else 1,)
+    if args.model:
+        from ensemble import checkpoint_input_shape
+        input_shape = checkpoint_input_shape(args.model)
+
+    # the tensorflow session lives in a child process, so this one can fork the loader workers afterwards and
+    # the trials do not share the device memory
+    print("timing the {} step of {}...".format(args.mode, args.model or 'unet_family'))
+    with Pool(1) as pool:
+        model_trials = pool.apply(_model_trials, (args, input_shape, budget))
+    if not model_trials:
+        raise ValueError("batch size {} does not fit; give smaller --batch_sizes".format(args.batch_sizes[0]))
+    batch_size = choose_batch_size(model_trials)
+    model_rate = max(t['images_per_sec'] for t in model_trials if t['batch_size'] == batch_size)
+
+    from manifest import load_manifest
+    manifest = load_manifest(args.imdir, args.maskdir) if args.mode == 'train' else load_manifest(args.imdir)
+    print("timing the loader at batch size {}...".format(batch_size))
+    loader_trials = tune_loader(manifest.fns, manifest.fn_dict(), args.mode, input_shape, batch_size, budget,
+                                args.seconds, args.workers, args.queue_depths, args.decode, args.data_aug,
+                                stream=args.stream)
+    if not loader_trials:
+        raise ValueError("no loader fits in {:.1f}GB at batch size {}".format(budget / 2. ** 30, batch_size))
+    loader = choose_loader(loader_trials, model_rate)
+
+    entry = {'batch_size': batch_size, 'workers': loader['workers'], 'queue_depth': loader['queue_depth'],
+             'decode': loader['decode'], 'model_images_per_sec': model_rate,
+             'loader_images_per_sec': loader['images_per_sec'], 'model': args.model,
+             'budget_bytes': budget, 'seconds': args.seconds, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+             'model_trials': model_trials, 'loader_trials': loader_trials}
+    save_profile(entry, args.mode, input_shape, args.profile, args.stream)
+    print("batch size {}, {} workers, queue depth {}, {} decode: model {:.1f} images/sec, loader {:.1f} "
+          "images/sec...".format(batch_size, loader['workers'], loader['queue_depth'], loader['decode'], model_rate,
+                                 loader['images_per_sec']))
+    print("profile written to {}".format(args.profile or profile_path()))
@@ -0,0 +1,350 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from PIL import Image
+from config import ORIGIN_SHAPE, WORKERS
+from utils import rle_encode, rle_decode, rle_encode_batch, rle_decode_batch, resize_mask_matrix_encode, \
+    resize_mask_matrix_encode_batch, load_image, normalize_data, DataIterator, DECODE_BACKENDS
+from loader import CarvanaSequence, Prefetcher
+from masks import RLEMaskSource
+from augment import augment_batch, augment_rng
+from evaluate import rle_dice
+from manifest import load_manifest
+
+BENCHMARK_VERSION = 1
+BENCHMARKS = []
+
+
+def benchmark(name):
+    '''
+    register `func(data, args) -> (items, run)` under `name`; `run()` processes `items` items once
+    '''
+    def register(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return register
+
+
+def car_shape(rng, shape=ORIGIN_SHAPE):
+    '''
+    :return: bool [height, width] ellipse "car" with a ragged outline
+    '''
+    width, height = shape
+    yy, xx = np.ogrid[:height, :width]
+    cx, cy = width * rng.uniform(0.4, 0.6), height * rng.uniform(0.4, 0.6)
+    rx, ry = width * rng.uniform(0.25, 0.4), height * rng.uniform(0.2, 0.3)
+    noise = rng.uniform(0.97, 1.03, size=(height, 1))
+    return ((xx - cx) / rx) ** 2 + ((yy - cy) / ry) ** 2 < noise
+
+
+def car_masks(n, shape=ORIGIN_SHAPE, seed=0):
+    '''
+    :return: uint8 [n, height, width] car_shape masks
+    '''
+    rng = np.random.RandomState(seed)
+    return np.stack([car_shape(rng, shape) for _ in range(n)]).astype(np.uint8)
+
+
+def write_car(rng, img_path, mask_path=None, shape=ORIGIN_SHAPE):
+    '''
+    write a carvana-like jpeg (a textured car_shape on a gradient) and, with mask_path, its gif mask
+    :param shape: (width, height) of the image
+    :return: bool [height, width] car mask
+    '''
+    width, height = shape
+    yy, xx = np.mgrid[:height, :width]
+    img = np.stack([xx * 200 // width, yy * 200 // height, np.full((height, width), 120)], axis=-1)
+    car = car_shape(rng, shape)
+    img = img + rng.normal(0, 6, size=(height, width, 1))
+    img[car] = rng.randint(0, 255, size=3) + rng.normal(0, 20, size=(car.sum(), 1))
+    Image.fromarray(np.uint8(np.clip(img, 0, 255))).save(img_path, quality=95)
+    if mask_path:
+        Image.fromarray(car.astype(np.uint8) * 255).convert('P').save(mask_path)
+    return car
+
+
+def make_dataset(root, n=16, shape=ORIGIN_SHAPE, seed=0):
+    '''
+    write n write_car samples under root: train/<car>_<NN>.jpg, train_masks/<car>_<NN>_mask.gif and
+    train_masks.csv with the matching rle strings. an existing dataset with the same parameters is reused.
+    :param shape: (width, height) of the images
+    :return: path of train_masks.csv
+    '''
+    params = {'version': BENCHMARK_VERSION, 'n': n, 'shape': list(shape), 'seed': seed}
+    params_path = os.path.join(root, 'dataset.json')
+    csv_path = os.path.join(root, 'train_masks.csv')
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            if json.load(f) == params:
+                return csv_path
+        shutil.rmtree(root)
+    for d in ['train', 'train_masks']:
+        os.makedirs(os.path.join(root, d))
+    rng = np.random.RandomState(seed)
+    rows = []
+    for i in range(n):
+        fn = '{:012x}_{:02d}'.format(i // 16, i % 16 + 1)
+        car = write_car(rng, os.path.join(root, 'train', fn + '.jpg'),
+                        os.path.join(root, 'train_masks', fn + '_mask.gif'), shape)
+        rows.append((fn + '.jpg', rle_encode_batch(car[np.newaxis])[0]))
+    pd.DataFrame(rows, columns=['img', 'rle_mask']).to_csv(csv_path, index=False)
+    with open(params_path, 'w') as f:
+        json.dump(params, f)
+    return csv_path
+
+
+class SyntheticData(object):
+    def __init__(self, root, n=16, shape=ORIGIN_SHAPE, target_size=(256, 256)):
+        self.shape = shape
+        self.target_size = target_size
+        self.csv_path = make_dataset(root, n, shape)
+        manifest = load_manifest(os.path.join(root, 'train'), os.path.join(root, 'train_masks'),
+                                 path=os.path.join(root, 'manifest.npz'))
+        self.fns = manifest.fns
+        self.fn_dict = manifest.fn_dict()
+        self.rles = list(pd.read_csv(self.csv_path)['rle_mask'])
+        self.masks = rle_decode_batch(self.rles, shape)
+        # low resolution "predictions" as they come out of the network
+        preds = np.stack([np.array(Image.fromarray(m * 255).resize(target_size[::-1])) for m in self.masks])
+        self.preds = preds[:, :, :, np.newaxis] / 255. * 0.9
+
+
+@benchmark('rle_encode_slow')
+def bench_rle_encode_slow(data, args):
+    return 1, lambda: rle_encode(data.masks[0], mode='slow')
+
+
+@benchmark('rle_encode_fast')
+def bench_rle_encode_fast(data, args):
+    return 1, lambda: rle_encode(data.masks[0], mode='fast')
+
+
+@benchmark('rle_encode_faster')
+def bench_rle_encode_faster(data, args):
+    return len(data.masks), lambda: [rle_encode(m, mode='faster') for m in data.masks]
+
+
+@benchmark('rle_encode_batch')
+def bench_rle_encode_batch(data, args):
+    return len(data.masks), lambda: rle_encode_batch(data.masks)
+
+
+@benchmark('rle_decode')
+def bench_rle_decode(data, args):
+    return len(data.rles), lambda: [rle_decode(rle, data.shape) for rle in data.rles]
+
+
+@benchmark('rle_decode_batch')
+def bench_rle_decode_batch(data, args):
+    return len(data.rles), lambda: rle_decode_batch(data.rles, data.shape)
+
+
+@benchmark('rle_dice')
+def bench_rle_dice(data, args):
+    return len(data.rles), lambda: [rle_dice(a, b) for a, b in zip(data.rles, data.rles[1:] + data.rles[:1])]
+
+
+@benchmark('rle_dice_decoded')
+def bench_rle_dice_decoded(data, args):
+    def run():
+        a = rle_decode_batch(data.rles, data.shape)
+        b = np.roll(a, -1, axis=0)
+        return 2. * np.logical_and(a, b).sum(axis=(1, 2)) / (a.sum(axis=(1, 2)) + b.sum(axis=(1, 2)))
+    return len(data.rles), run
+
+
+@benchmark('resize_mask_matrix_encode')
+def bench_resize_mask_matrix_encode(data, args):
+    return len(data.preds), lambda: [resize_mask_matrix_encode(p, data.shape) for p in data.preds]
+
+
+@benchmark('resize_mask_matrix_encode_batch')
+def bench_resize_mask_matrix_encode_batch(data, args):
+    return len(data.preds), lambda: resize_mask_matrix_encode_batch(data.preds, data.shape)
+
+
+def _decode(backend, grayscale):
+    def bench(data, args):
+        return len(data.fns), lambda: [load_image(data.fn_dict[fn][0], data.target_size, grayscale, backend)
+                                       for fn in data.fns]
+    return bench
+
+
+for _backend in DECODE_BACKENDS:
+    benchmark('load_image_{}_gray'.format(_backend))(_decode(_backend, True))
+    benchmark('load_image_{}_rgb'.format(_backend))(_decode(_backend, False))
+
+
+@benchmark('rle_mask_source')
+def bench_rle_mask_source(data, args):
+    masks = RLEMaskSource(data.csv_path, data.shape)
+    return len(data.fns), lambda: [masks.get(fn, data.target_size) for fn in data.fns]
+
+
+@benchmark('data_iterator')
+def bench_data_iterator(data, args):
+    batch_size = 2
+
+    def run():
+        it = DataIterator(fns=data.fns, fn_dict=data.fn_dict, target_size=data.target_size, batch_size=batch_size)
+        for _ in range(len(data.fns) // batch_size):
+            next(it)
+    return len(data.fns) // batch_size * batch_size, run
+
+
+@benchmark('prefetcher')
+def bench_prefetcher(data, args):
+    seq = CarvanaSequence(data.fns, data.fn_dict, target_size=data.target_size, batch_size=2)
+
+    def run():
+        with Prefetcher(seq, workers=args.workers) as loader:
+            for _ in range(len(seq)):
+                next(loader)
+    return len(data.fns), run
+
+
+@benchmark('augment_batch')
+def bench_augment_batch(data, args):
+    seq = CarvanaSequence(data.fns, data.fn_dict, target_size=data.target_size, batch_size=len(data.fns))
+    batch_x, batch_y = seq.get_batch(0)
+
+    def run():
+        augment_batch(batch_x.copy(), batch_y.copy(), augment_rng(1, 0, 0))
+    return len(batch_x), run
+
+
+@benchmark('prefetcher_augment')
+def bench_prefetcher_augment(data, args):
+    seq = CarvanaSequence(data.fns, data.fn_dict, target_size=data.target_size, batch_size=2, data_aug=True)
+
+    def run():
+        with Prefetcher(seq, workers=args.workers) as loader:
+            for _ in range(len(seq)):
+                next(loader)
+    return len(data.fns), run
+
+
+@benchmark('normalize_data')
+def bench_normalize_data(data, args):
+    stats_dir = tempfile.mkdtemp()
+
+    def run():
+        # a fresh stats file every time, otherwise the cached statistics are timed
+        stats_path = os.path.join(stats_dir, 'stats-{}.json'.format(time.time()))
+        normalize_data(data.fns, data.fn_dict, data.target_size + (1,), stats_path=stats_path)
+    return len(data.fns), run
+
+
+@benchmark('tiled_blend')
+def bench_tiled_blend(data, args):
+    from tiling import TiledPredictor
+
+    class Identity(object):
+        def predict_on_batch(self, x):
+            return x / 255.
+    # crop and blend overhead of full resolution tiled inference, without the network
+    tiled = TiledPredictor(Identity(), data.target_size + (1,), size=data.shape, overlap=32)
+    x = np.random.RandomState(0).randint(0, 255, size=(2, data.shape[1], data.shape[0], 1)).astype(np.uint8)
+    return len(x), lambda: tiled.predict_on_batch(x)
+
+
+def _forward(build, tta=None, **kwargs):
+    def bench(data, args):
+        from models import SimpleCNN, unet, unet_family
+        from tta import TTAModel
+        model_fn = {'unet': unet, 'SimpleCNN': SimpleCNN, 'unet_family': unet_family}[build]
+        with tf.device('/cpu:0'):
+            model = model_fn(data.target_size + (1,), **kwargs)
+        if tta:
+            model = TTAModel(model, tta)
+        x = np.random.RandomState(0).randint(0, 255, size=(4,) + data.target_size + (1,)).astype(np.uint8)
+        model.predict(x, batch_size=2)  # graph warm-up
+        return len(x), lambda: model.predict(x, batch_size=2)
+    return bench
+
+
+benchmark('forward_unet_cpu')(_forward('unet'))
+benchmark('forward_simplecnn_cpu')(_forward('SimpleCNN'))
+benchmark('forward_unet_tta_hflip_cpu')(_forward('unet', tta=['identity', 'hflip']))
+benchmark('forward_unet_w0.25_sep_bilinear_cpu')(_forward('unet_family', width=0.25, separable=True,
+                                                            upsample='bilinear'))
+
+
+def run_benchmarks(data, args, names=None):
+    '''
+    :param names: substrings selecting the benchmarks to run; all by default
+    :return: {name: {'items_per_sec', 'seconds', 'items'}} with the best of args.repeat runs
+    '''
+    results = {}
+    for name, func in BENCHMARKS:
+        if names and not any(n in name for n in names):
+            continue
+        items, run = func(data, args)
+        best = float('inf')
+        for _ in range(args.repeat):
+            now = time.time()
+            run()
+            best = min(best, time.time() - now)
+        results[name] = {'items_per_sec': items / best, 'seconds': best, 'items': items}
+        print("%-36s %10.2f items/sec  (%d items in %.3fs)" % (name, items / best, items, best))
+    return results
+
+
+def compare(results, baseline, tolerance=0.8):
+    '''
+    :param tolerance: a benchmark regresses when it runs at less than `tolerance` x its baseline throughput
+    :return: names of the regressed benchmarks
+    '''
+    regressions = []
+    print("%-36s %12s %12s %8s" % ('benchmark', 'baseline', 'current', 'ratio'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['items_per_sec'], results[name]['items_per_sec']
+        ratio = after / before
+        flag = ''
+        if ratio < tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print("%-36s %12.2f %12.2f %7.2fx%s" % (name, before, after, ratio, flag))
+    return regressions
+
+
+def create_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, default=os.path.join(tempfile.gettempdir(), 'carvana-benchmark'),
+                        help="where the synthetic dataset is generated (and reused)")
+    parser.add_argument('--n', type=int, default=16, help="number of synthetic images")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per benchmark; the fastest is reported")
+    parser.add_argument('--workers', type=int, default=WORKERS, help="processes of the prefetcher benchmark")
+    parser.add_argument('--only', type=str, nargs='*', default=None, help="run benchmarks whose name contains these")
+    parser.add_argument('--out', type=str, default='benchmark.json')
+    parser.add_argument('--baseline', type=str, default=None, help="results file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.8,
+                        help="fail when a benchmark runs below this fraction of its baseline throughput")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = create_args()
+    print("generating synthetic dataset in {}...".format(args.root))
+    data = SyntheticData(args.root, args.n)
+    results = run_benchmarks(data, args, args.only)
+    report = {'version': BENCHMARK_VERSION, 'host': platform.node(), 'python': platform.python_version(),
+              'numpy': np.__version__, 'n': args.n, 'results': results}
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("results written to {}".format(args.out))
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
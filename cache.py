@@ -0,0 +1,233 @@
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+from keras.preprocessing.image import load_img
+from utils import load_image, DECODE_BACKENDS
+from multiprocessing.dummy import Pool as ThreadPool
+
+CACHE_VERSION = 1
+INDEX_NAME = 'index.json'
+
+
+def cache_fingerprint(fns, fn_dict, target_size, grayscale, decode='keras', mask_source=None):
+    '''
+    :param fns: filenames, in cache order
+    :param fn_dict: {'fn':['path/to/img', 'path/to/mask']}
+    :return: hex digest that changes whenever a source file, the file list, target_size, grayscale, the
+        decode backend or the mask source changes
+    '''
+    h = hashlib.sha1()
+    h.update(json.dumps([CACHE_VERSION, list(target_size), bool(grayscale), decode]).encode())
+    if mask_source is not None:
+        st = os.stat(mask_source.csv_path)
+        h.update('{}|{}|{}\n'.format(mask_source.csv_path, st.st_size, st.st_mtime_ns).encode())
+    for fn in fns:
+        for path in fn_dict[fn]:
+            st = os.stat(path)
+            h.update('{}|{}|{}|{}\n'.format(fn, path, st.st_size, st.st_mtime_ns).encode())
+    return h.hexdigest()
+
+
+def _cache_subdir(cache_dir, fns, target_size, grayscale, decode='keras', mask_source=None):
+    '''
+    one sub directory per file list, target_size, channel count, decode backend and mask source, so caches of
+    different settings sit side by side instead of rebuilding each other
+    '''
+    files = hashlib.sha1('\n'.join(fns).encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, '{}-{}-{}-{}-{}-{}'.format(target_size[0], target_size[1], 1 if grayscale else 3,
+                                                             decode, 'gif' if mask_source is None else 'rle', files))
+
+
+class DatasetCache(object):
+    '''
+    read-only view over the memory-mapped shards written by `build_cache`.
+
+    images are stored as uint8 [n, x, y, channel]; masks are stored bit-packed along the last image axis
+    as uint8 [n, x, ceil(y/8)]. batches are gathered with numpy indexing straight from the memmaps.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_NAME)) as f:
+            self.index = json.load(f)
+        self.fns = self.index['fns']
+        self.target_size = tuple(self.index['target_size'])
+        self.grayscale = self.index['grayscale']
+        self.has_masks = self.index['has_masks']
+        self.shard_size = self.index['shard_size']
+        self.position = {fn: i for i, fn in enumerate(self.fns)}
+        self._open()
+
+    def _open(self):
+        self.images = [np.load(os.path.join(self.path, s['images']), mmap_mode='r') for s in self.index['shards']]
+        self.masks = None
+        if self.has_masks:
+            self.masks = [np.load(os.path.join(self.path, s['masks']), mmap_mode='r') for s in self.index['shards']]
+
+    # memmaps are reopened instead of pickled, so the cache can be handed to worker processes cheaply
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['images'] = None
+        state['masks'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return len(self.fns)
+
+    def __contains__(self, fn):
+        return fn in self.position
+
+    def _gather(self, shards, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        if len(positions) == 0:
+            return np.empty((0,) + shards[0].shape[1:], dtype=shards[0].dtype)
+        shard_ids = positions // self.shard_size
+        offsets = positions - shard_ids * self.shard_size
+        first, last = shard_ids[0], shard_ids[-1]
+        # consecutive items inside one shard are returned as a view of the memmap
+        if first == last and np.all(np.diff(offsets) == 1):
+            return shards[first][offsets[0]:offsets[-1] + 1]
+        out = np.empty((len(positions),) + shards[first].shape[1:], dtype=shards[first].dtype)
+        for s in np.unique(shard_ids):
+            sel = np.flatnonzero(shard_ids == s)
+            out[sel] = shards[s][offsets[sel]]
+        return out
+
+    def get_images(self, fns):
+        '''
+        :param fns: filenames
+        :return: uint8 [len(fns), x, y, channel]
+        '''
+        return self._gather(self.images, [self.position[fn] for fn in fns])
+
+    def get_masks(self, fns):
+        '''
+        :param fns: filenames
+        :return: uint8 [len(fns), x, y, 1] with values in {0, 1}
+        '''
+        if not self.has_masks:
+            raise ValueError("cache at {} was built without masks".format(self.path))
+        packed = self._gather(self.masks, [self.position[fn] for fn in fns])
+        width = self.target_size[1]
+        return np.unpackbits(packed, axis=-1)[:, :, :width, np.newaxis]
+
+    def get_batch(self, fns):
+        if self.has_masks:
+            return self.get_images(fns), self.get_masks(fns)
+        return self.get_images(fns), None
+
+
+def build_cache(fns, fn_dict, target_size=(256, 256), grayscale=True, cache_dir='cache', shard_size=1024,
+                threads=4, force=False, decode='keras', mask_source=None, mask_sampling='nearest'):
+    '''
+    decode, resize and store every image (and mask, when fn_dict or mask_source has one) once. the cache is
+    rebuilt when the fingerprint of the source files, target_size or grayscale no longer matches the stored index.
+    :param fns: filenames
+    :param fn_dict: {'fn':['path/to/img', 'path/to/mask']}
+    :param target_size: tuple; (x, y)
+    :param cache_dir: root directory of the cache; one sub directory per (file list, target_size, grayscale,
+        decode, mask source)
+    :param shard_size: number of images per shard file
+    :param threads: decode threads
+    :param decode: jpeg decode backend, see utils.load_image
+    :param mask_source: optional masks.RLEMaskSource rasterizing the masks instead of decoding the gifs
+    :param mask_sampling: only 'nearest'; masks are stored bit-packed, 'area' coverage fractions cannot be cached
+    :return: DatasetCache
+    '''
+    if mask_sampling != 'nearest':
+        raise ValueError("masks are cached as bits, mask_sampling {} needs an uncached loader".format(mask_sampling))
+    target_size = tuple(target_size)
+    fns = sorted(fns)
+    path = _cache_subdir(cache_dir, fns, target_size, grayscale, decode, mask_source)
+    fingerprint = cache_fingerprint(fns, fn_dict, target_size, grayscale, decode, mask_source)
+    index_path = os.path.join(path, INDEX_NAME)
+    if not force and os.path.isfile(index_path):
+        with open(index_path) as f:
+            if json.load(f).get('fingerprint') == fingerprint:
+                return DatasetCache(path)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    if os.path.isfile(index_path):
+        os.remove(index_path)
+
+    if mask_source is not None:
+        has_masks = all(fn in mask_source for fn in fns)
+    else:
+        has_masks = all(len(fn_dict[fn]) > 1 for fn in fns)
+    channel = 1 if grayscale else 3
+    x, y = target_size
+    packed_y = (y + 7) // 8
+    shards = []
+    pool = ThreadPool(threads)
+    for n, start in enumerate(range(0, len(fns), shard_size)):
+        shard_fns = fns[start:start + shard_size]
+        shard = {'images': 'images-{:05d}.npy'.format(n), 'masks': None}
+        images = np.lib.format.open_memmap(os.path.join(path, shard['images']), mode='w+', dtype=np.uint8,
+                                           shape=(len(shard_fns), x, y, channel))
+        if has_masks:
+            shard['masks'] = 'masks-{:05d}.npy'.format(n)
+            masks = np.lib.format.open_memmap(os.path.join(path, shard['masks']), mode='w+', dtype=np.uint8,
+                                              shape=(len(shard_fns), x, packed_y))
+
+        def map_func(i):
+            fn = shard_fns[i]
+            images[i] = load_image(fn_dict[fn][0], target_size, grayscale, decode)
+            if has_masks:
+                if mask_source is not None:
+                    mask = mask_source.get(fn, target_size, 'nearest') > 127
+                else:
+                    mask = np.array(load_img(fn_dict[fn][1], grayscale=True, target_size=target_size)) > 127
+                masks[i] = np.packbits(mask, axis=-1)
+
+        pool.map(map_func, range(len(shard_fns)))
+        images.flush()
+        del images
+        if has_masks:
+            masks.flush()
+            del masks
+        shards.append(shard)
+        print("cached {}/{} images...".format(start + len(shard_fns), len(fns)))
+    pool.close()
+    pool.join()
+
+    index = {'version': CACHE_VERSION, 'fingerprint': fingerprint, 'fns': fns, 'target_size': list(target_size),
+             'grayscale': bool(grayscale), 'has_masks': has_masks, 'shard_size': shard_size, 'shards': shards}
+    # the index is written last, so an interrupted build is never mistaken for a valid cache
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_path + '.tmp', index_path)
+    return DatasetCache(path)
+
+
+def create_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--imdir', type=str, required=True)
+    parser.add_argument('--maskdir', type=str, default=None)
+    parser.add_argument('--cache_dir', type=str, default='cache')
+    parser.add_argument('--target_size', type=int, nargs=2, default=[256, 256])
+    parser.add_argument('--rgb', action='store_true', help="cache rgb images instead of grayscale")
+    parser.add_argument('--shard_size', type=int, default=1024)
+    parser.add_argument('--threads', type=int, default=4, help="decode threads")
+    parser.add_argument('--train_masks_csv', type=str, default=None,
+                        help="rasterize masks from train_masks.csv instead of decoding the gifs")
+    parser.add_argument('--force', action='store_true')
+    parser.add_argument('--decode', type=str, default='keras', choices=DECODE_BACKENDS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from manifest import load_manifest
+    from masks import RLEMaskSource
+    args = create_args()
+    manifest = load_manifest(args.imdir, args.maskdir)
+    total_fns = manifest.fns
+    fn_dict = manifest.fn_dict()
+    mask_source = RLEMaskSource(args.train_masks_csv) if args.train_masks_csv else None
+    cache = build_cache(total_fns, fn_dict, tuple(args.target_size), not args.rgb, args.cache_dir, args.shard_size,
+                        args.threads, args.force, args.decode, mask_source)
+    print("cache ready at {} for {} images...".format(cache.path, len(cache)))
@@ -1,3 +1,6 @@
 ORIGIN_SHAPE = (1918, 1280)
 TARGET_SIZE = (256,256)
-BATCH_SIZE = 2
\ No newline at end of file
+BATCH_SIZE = 2
+WORKERS = 4
+QUEUE_DEPTH = 8
+DECODE_BACKEND = 'keras'
\ No newline at end of file
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import cv2
+import h5py
+import numpy as np
+from config import ORIGIN_SHAPE
+from utils import parse_model_name
+from profiling import TimingStats
+
+_GRAY = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def checkpoint_input_shape(path):
+    '''
+    read the input shape of a checkpoint without loading it (no tensorflow needed, so it can run before the
+    loader processes are forked): from the model config of a .hdf5, the .json next to a .pb, or else from
+    the experiment directory name (see parse_model_name)
+    :return: (rows, cols, channel)
+    '''
+    if path.endswith('.pb'):
+        with open(path + '.json') as f:
+            return tuple(json.load(f)['input_shape'])
+    with h5py.File(path, 'r') as f:
+        config = f.attrs.get('model_config')
+    if config is not None:
+        config = json.loads(config.decode('utf8') if isinstance(config, bytes) else config)['config']
+        name = config['input_layers'][0][0]
+        for layer in config['layers']:
+            if layer['name'] == name:
+                return tuple(layer['config']['batch_input_shape'][1:])
+    target_size, grayscale = parse_model_name(os.path.basename(os.path.dirname(os.path.abspath(path))))
+    return tuple(target_size) + (1 if grayscale else 3,)
+
+
+def load_size(input_shapes):
+    '''
+    :return: (rows, cols, channel) the batches are decoded at once for all models: the largest size, in color
+        if any model takes color
+    '''
+    rows = max(shape[0] for shape in input_shapes)
+    cols = max(shape[1] for shape in input_shapes)
+    return rows, cols, max(shape[2] for shape in input_shapes)
+
+
+def fit_batch(x, shape):
+    '''
+    :param x: uint8 [n, rows, cols, channel] decoded batch
+    :param shape: (rows, cols, channel) a model takes
+    :return: uint8 batch converted to gray (when the model takes 1 channel) and nearest-resized to shape, like
+        utils.load_image resizes the images a model is trained on (area resizing would feed it smoother
+        pixels than it has seen)
+    '''
+    if x.shape[-1] != shape[2]:
+        x = np.uint8(np.clip(np.rint(x.dot(_GRAY)), 0, 255))[..., np.newaxis]
+    if x.shape[1:3] == tuple(shape[:2]):
+        return x
+    return np.stack([cv2.resize(a, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST).reshape(shape)
+                     for a in x])
+
+
+class Ensemble(object):
+    '''
+    several models behind the predict_on_batch interface of one. every model gets the decoded batch resized
+    to its own input, and its probabilities are upsampled to the original resolution and added to a running
+    weighted sum, so memory is one full resolution accumulator per batch whatever the number of models.
+
+    usage:
+        ensemble = Ensemble.load(['a/best_model.hdf5', 'b/best_model.pb'])
+        seq = CarvanaSequence(fns, fn_dict, target_size=ensemble.load_size[:2],
+                              grayscale=ensemble.load_size[2] == 1, test=True)
+        stream_predict(ensemble, seq, Prefetcher(seq), 'submission.csv')
+    '''
+    def __init__(self, models, input_shapes, weights=None, names=None, size=ORIGIN_SHAPE):
+        '''
+        :param models: objects with predict_on_batch(uint8 [n, rows, cols, channel]) -> probabilities
+        :param input_shapes: (rows, cols, channel) of every model
+        :param weights: relative weights; equal by default
+        :param size: (width, height) of the averaged probabilities
+        '''
+        weights = np.ones(len(models)) if weights is None else np.asarray(weights, dtype=np.float64)
+        if len(weights) != len(models) or len(input_shapes) != len(models):
+            raise ValueError("{} models, {} input shapes and {} weights".format(len(models), len(input_shapes),
+                                                                                len(weights)))
+        self.models = models
+        self.input_shapes = [tuple(shape) for shape in input_shapes]
+        self.weights = (weights / weights.sum()).astype(np.float32)
+        self.names = names or ['model{}'.format(i) for i in range(len(models))]
+        self.size = size
+        self.load_size = load_size(self.input_shapes)
+        self.stats = TimingStats()
+
+    @classmethod
+    def load(cls, paths, weights=None, size=ORIGIN_SHAPE):
+        '''
+        load keras checkpoints and frozen graphs (.pb, run on cpu)
+        '''
+        from export import FrozenModel, load_keras_model
+        models = [FrozenModel(path) if path.endswith('.pb') else load_keras_model(path) for path in paths]
+        return cls(models, [checkpoint_input_shape(path) for path in paths], weights, list(paths), size)
+
+    def predict_on_batch(self, x):
+        '''
+        :param x: uint8 [n, rows, cols, channel] decoded at load_size
+        :return: float32 [n, height, width, 1] weighted mean probability at the original resolution
+        '''
+        width, height = self.size
+        acc = np.zeros((len(x), height, width), dtype=np.float32)
+        for model, shape, weight, name in zip(self.models, self.input_shapes, self.weights, self.names):
+            now = time.time()
+            pred = model.predict_on_batch(fit_batch(x, shape))[..., -1]
+            start = time.time()
+            self.stats.add(os.path.basename(name) + ' predict', start - now)
+            for i in range(len(x)):
+                acc[i] += weight * cv2.resize(pred[i].astype(np.float32), (width, height),
+                                              interpolation=cv2.INTER_LINEAR)
+            self.stats.add(os.path.basename(name) + ' upsample', time.time() - start)
+        return acc[..., np.newaxis]
@@ -0,0 +1,183 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+from config import ORIGIN_SHAPE, TARGET_SIZE, DECODE_BACKEND
+from utils import resized_mask_runs, DECODE_BACKENDS
+
+_EMPTY = np.zeros(0, dtype=np.int64)
+
+
+def rle_runs(rle):
+    '''
+    :param rle: 'start length ...' with 1-based starts; an empty string (or NaN, as pandas reads empty masks)
+        for an empty mask
+    :return: int64 (starts, ends) of the runs, 0-based, half-open, sorted and merged where they touch or overlap
+    '''
+    if not isinstance(rle, str) or not rle.strip():
+        return _EMPTY, _EMPTY
+    values = np.array(rle.split(), dtype=np.int64)
+    starts = values[0::2] - 1
+    ends = starts + values[1::2]
+    if np.all(starts[1:] > ends[:-1]):
+        return starts, ends
+    order = np.argsort(starts, kind='mergesort')
+    starts, ends = starts[order], np.maximum.accumulate(ends[order])
+    first = np.concatenate([[True], starts[1:] > ends[:-1]])
+    last = np.append(first[1:], True)
+    return starts[first], ends[last]
+
+
+def _coverage(starts, ends, x):
+    '''
+    :return: number of pixels of the runs (starts, ends) below each position in x
+    '''
+    lengths = np.concatenate([[0], np.cumsum(ends - starts)])
+    i = np.searchsorted(starts, x, side='right')
+    prev = np.maximum(i - 1, 0)
+    partial = np.where(i > 0, np.minimum(ends[prev], x) - starts[prev], 0)
+    return lengths[prev] + partial
+
+
+def run_dice(a, b):
+    '''
+    dice of two masks given as sorted, disjoint runs: the intersection is read off the cumulative coverage of
+    a at the run boundaries of b, in O((len(a) + len(b)) log len(a)) without decoding either mask
+    :param a: (starts, ends), see rle_runs
+    :param b: (starts, ends)
+    :return: dice; 1 when both masks are empty
+    '''
+    area = (a[1] - a[0]).sum() + (b[1] - b[0]).sum()
+    if area == 0:
+        return 1.
+    if len(a[0]) == 0 or len(b[0]) == 0:
+        return 0.
+    intersection = (_coverage(a[0], a[1], b[1]) - _coverage(a[0], a[1], b[0])).sum()
+    return 2. * intersection / area
+
+
+def rle_dice(pred, truth):
+    '''
+    :return: dice of two rle strings
+    '''
+    return run_dice(rle_runs(pred), rle_runs(truth))
+
+
+def _dice_pairs(pairs):
+    return [rle_dice(pred, truth) for pred, truth in pairs]
+
+
+def _chunks(items, n):
+    return [items[i:i + n] for i in range(0, len(items), n)]
+
+
+def read_masks(csv_path):
+    '''
+    :return: {id without extension: rle} of a submission or train_masks.csv
+    '''
+    df = pd.read_csv(csv_path)
+    return dict(zip((os.path.splitext(fn)[0] for fn in df['img']), df['rle_mask']))
+
+
+def evaluate_submission(submission, truth, processes=4, chunk_size=64):
+    '''
+    :param submission: csv of predicted masks
+    :param truth: csv of the true masks, e.g. train_masks.csv; every submitted id must be in it
+    :return: DataFrame of per-image dice, in submission order
+    '''
+    pred, truth = read_masks(submission), read_masks(truth)
+    unknown = [fn for fn in pred if fn not in truth]
+    if unknown:
+        raise ValueError("{} submitted ids have no true mask, e.g. {}".format(len(unknown), unknown[0]))
+    fns = list(pred)
+    chunks = _chunks([(pred[fn], truth[fn]) for fn in fns], chunk_size)
+    with Pool(processes) as pool:
+        dice = sum(pool.map(_dice_pairs, chunks), [])
+    return pd.DataFrame({'img': fns, 'dice': dice})
+
+
+def _sweep_one(args):
+    prob, truth, thresholds, size = args
+    if prob is None:
+        return [np.nan] * len(thresholds)
+    truth = rle_runs(truth)
+    return [run_dice(resized_mask_runs(prob > t, size), truth) for t in thresholds]
+
+
+def sweep_thresholds(fns, probs, truth, thresholds, size=ORIGIN_SHAPE, processes=4):
+    '''
+    full resolution dice of every image at every threshold, reading each probability map once
+    :param probs: iterable of float [x, y, 1] probability maps, in the order of fns (e.g. from a
+        prediction_cache.PredictionCache); None for a missing one
+    :param truth: {fn: rle} of the true masks at `size`
+    :return: float [len(fns), len(thresholds)] dice, NaN for the missing maps
+    '''
+    tasks = ((prob, truth[fn], list(thresholds), size) for fn, prob in zip(fns, probs))
+    with Pool(processes) as pool:
+        return np.array(list(pool.imap(_sweep_one, tasks, chunksize=8))).reshape(len(fns), len(thresholds))
+
+
+def cached_probs(cache, fns, batch_size=32):
+    '''
+    :return: generator of the cached probability maps of fns, None for entries evicted since the lookup
+    '''
+    for i in range(0, len(fns), batch_size):
+        found, probs = cache.get(fns[i:i + batch_size])
+        probs = dict(zip(found, probs))
+        for fn in fns[i:i + batch_size]:
+            yield probs.get(fn)
+
+
+def create_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--truth', type=str, required=True, help="csv of the true masks, e.g. train_masks.csv")
+    parser.add_argument('--submission', type=str, default=None, help="csv of predicted masks to score")
+    parser.add_argument('--model', type=str, default=None,
+                        help="checkpoint whose cached probabilities of --imdir are swept over --thresholds")
+    parser.add_argument('--imdir', type=str, default=None)
+    parser.add_argument('--split', type=str, default='valid', choices=['valid', 'all'],
+                        help="sweep the car-grouped validation split of --imdir or all of its images")
+    parser.add_argument('--pred_cache', type=str, default='cache/predictions')
+    parser.add_argument('--target_size', type=int, nargs=2, default=list(TARGET_SIZE))
+    parser.add_argument('--decode', type=str, default=DECODE_BACKEND, choices=DECODE_BACKENDS)
+    parser.add_argument('--thresholds', type=float, nargs='+', default=list(np.arange(0.3, 0.71, 0.05)))
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--out', type=str, default='evaluation.csv', help="per-image dice")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = create_args()
+    if args.submission:
+        result = evaluate_submission(args.submission, args.truth, args.processes)
+        print("mean dice {:.5f} over {} images...".format(result['dice'].mean(), len(result)))
+    elif args.model and args.imdir:
+        from manifest import load_manifest
+        from prediction_cache import PredictionCache
+        manifest = load_manifest(args.imdir)
+        truth = read_masks(args.truth)
+        fns = manifest.split(300, seed=1)[1] if args.split == 'valid' else manifest.fns
+        fns = [fn for fn in fns if fn in truth]
+        cache = PredictionCache(args.pred_cache, args.model, tuple(args.target_size), args.decode)
+        fns, missing = cache.split(fns, manifest.fn_dict(fns))
+        if missing:
+            print("{} images have no cached prediction and are skipped; predict them with "
+                  "`test.py --model {} --imdir {}` first...".format(len(missing), args.model, args.imdir))
+        dice = sweep_thresholds(fns, cached_probs(cache, fns), truth, args.thresholds, processes=args.processes)
+        kept = ~np.isnan(dice[:, 0])
+        if not kept.all():
+            print("{} cached predictions were evicted by another process while reading and are skipped...".format(
+                len(fns) - kept.sum()))
+            fns, dice = [fn for fn, k in zip(fns, kept) if k], dice[kept]
+        for t, d in zip(args.thresholds, dice.mean(axis=0)):
+            print("threshold %.3f  mean dice %.5f" % (t, d))
+        best = int(np.argmax(dice.mean(axis=0)))
+        print("best threshold {:.3f} with mean dice {:.5f} over {} images...".format(
+            args.thresholds[best], dice.mean(axis=0)[best], len(fns)))
+        result = pd.DataFrame(dice, columns=['dice@{:.3f}'.format(t) for t in args.thresholds])
+        result.insert(0, 'img', fns)
+    else:
+        raise ValueError("give --submission, or --model and --imdir")
+    result.to_csv(args.out, index=False)
+    print("per-image dice written to {}".format(args.out))
@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import keras
+import tensorflow as tf
+from keras import backend as K
+from config import BATCH_SIZE
+from utils import dice_coef, bce_dc_loss
+from profiling import Histogram
+
+TRANSFORMS = ['remove_nodes(op=Identity, op=CheckNumerics)', 'fold_constants(ignore_errors=true)',
+              'fold_batch_norms', 'fold_old_batch_norms', 'strip_unused_nodes', 'sort_by_execution_order']
+
+
+def load_keras_model(path):
+    '''
+    load a training checkpoint for inference: learning phase fixed to test, custom objects resolved
+    '''
+    K.set_learning_phase(0)
+    return keras.models.load_model(path, custom_objects={'dice_coef': dice_coef, 'bce_dc_loss': bce_dc_loss})
+
+
+def freeze_checkpoint(model_path, out_path=None, quantize=False):
+    '''
+    freeze a keras checkpoint into an inference-only graph: variables become constants, training nodes
+    are stripped and constant subgraphs (e.g. the normalization Lambda) are folded. with quantize=True the
+    weights are stored as 8 bit (tensorflow's quantize_weights) and dequantized when the graph is loaded.
+    :param out_path: defaults to the checkpoint path with a .pb (or -int8.pb) extension
+    :return: out_path; a json with the input/output tensor names is written next to it
+    '''
+    from tensorflow.tools.graph_transforms import TransformGraph
+    out_path = out_path or os.path.splitext(model_path)[0] + ('-int8.pb' if quantize else '.pb')
+    K.clear_session()
+    model = load_keras_model(model_path)
+    sess = K.get_session()
+    inputs = [t.op.name for t in model.inputs]
+    outputs = [t.op.name for t in model.outputs]
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), outputs)
+    graph_def = tf.graph_util.remove_training_nodes(graph_def)
+    transforms = TRANSFORMS + (['quantize_weights'] if quantize else [])
+    graph_def = TransformGraph(graph_def, inputs, outputs, transforms)
+    with tf.gfile.GFile(out_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    meta = {'source': model_path, 'inputs': [name + ':0' for name in inputs],
+            'outputs': [name + ':0' for name in outputs], 'input_shape': list(model.input_shape[1:]),
+            'input_dtype': model.inputs[0].dtype.name, 'quantized': quantize, 'transforms': transforms}
+    with open(out_path + '.json', 'w') as f:
+        json.dump(meta, f, indent=1)
+    K.clear_session()
+    print("froze {} into {} ({:.1f} MB -> {:.1f} MB)...".format(model_path, out_path,
+                                                              os.path.getsize(model_path) / 2. ** 20,
+                                                              os.path.getsize(out_path) / 2. ** 20))
+    return out_path
+
+
+class FrozenModel(object):
+    '''
+    runtime for a graph written by freeze_checkpoint, with the prediction methods test.py uses on keras
+    models (predict_on_batch, predict, predict_generator). runs in its own graph and session, on cpu unless
+    told otherwise.
+
+    usage:
+        model = FrozenModel('experiment/model-.../best_model.pb')
+        pred = model.predict_on_batch(batch_x)
+    '''
+    def __init__(self, path, threads=0, cpu=True):
+        '''
+        :param threads: intra-op threads; 0 lets tensorflow pick
+        '''
+        with open(path + '.json') as f:
+            self.meta = json.load(f)
+        self.input_shape = (None,) + tuple(self.meta['input_shape'])
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.input = self.graph.get_tensor_by_name(self.meta['inputs'][0])
+        self.output = self.graph.get_tensor_by_name(self.meta['outputs'][0])
+        config = tf.ConfigProto(intra_op_parallelism_threads=threads)
+        if cpu:
+            config.device_count['GPU'] = 0
+        self.sess = tf.Session(graph=self.graph, config=config)
+
+    def predict_on_batch(self, x):
+        return self.sess.run(self.output, {self.input: x})
+
+    def predict(self, x, batch_size=BATCH_SIZE, verbose=0):
+        return np.concatenate([self.predict_on_batch(x[i:i + batch_size]) for i in range(0, len(x), batch_size)])
+
+    def predict_generator(self, generator, steps, verbose=0, **kwargs):
+        '''
+        keras-compatible signature; batches are predicted in the calling thread as they come
+        '''
+        out = []
+        for i in range(steps):
+            x = next(generator)
+            out.append(self.predict_on_batch(x[0] if isinstance(x, tuple) else x))
+            if verbose:
+                print("\r{}/{}".format(i + 1, steps), end='')
+        if verbose:
+            print()
+        return np.concatenate(out)
+
+    def close(self):
+        self.sess.close()
+
+
+def mask_dice(a, b):
+    '''
+    :return: per-image dice of the binary masks a > 0.5 and b > 0.5, [n, ...] each; 1 when both are empty
+    '''
+    a = a.reshape(len(a), -1) > 0.5
+    b = b.reshape(len(b), -1) > 0.5
+    inter = np.logical_and(a, b).sum(axis=1)
+    total = a.sum(axis=1) + b.sum(axis=1)
+    return np.where(total > 0, 2. * inter / np.maximum(total, 1), 1.)
+
+
+def time_batches(predict, x, batch_size, repeat=3):
+    '''
+    :return: (predictions, Histogram of per-batch latency over `repeat` passes, images/sec of the best pass)
+    '''
+    latency = Histogram()
+    best = float('inf')
+    for _ in range(repeat):
+        out = []
+        start = time.time()
+        for i in range(0, len(x), batch_size):
+            now = time.time()
+            out.append(predict(x[i:i + batch_size]))
+            latency.add(time.time() - now)
+        best = min(best, time.time() - start)
+    return np.concatenate(out), latency, len(x) / best
+
+
+def compare(model_path, frozen_paths, x, y=None, batch_size=BATCH_SIZE, repeat=3):
+    '''
+    latency, throughput and dice of the keras checkpoint and its frozen graphs on the same images; 'latency' is
+    seconds per image of the best pass, 'batches' the per-batch latency histogram over all passes
+    :param x: uint8 [n, x, y, channel] images
+    :param y: optional ground truth masks; without them the dice of every frozen graph is measured against
+        the keras predictions
+    :return: {name: report}
+    '''
+    K.clear_session()
+    model = load_keras_model(model_path)
+    reference, latency, throughput = time_batches(model.predict_on_batch, x, batch_size, repeat)
+    report = {'keras': {'images_per_sec': throughput, 'latency': 1. / throughput, 'batches': latency.to_dict(),
+                        'size_mb': os.path.getsize(model_path) / 2. ** 20}}
+    if y is not None:
+        report['keras']['dice'] = float(mask_dice(y, reference).mean())
+    K.clear_session()
+    for path in frozen_paths:
+        frozen = FrozenModel(path)
+        pred, latency, throughput = time_batches(frozen.predict_on_batch, x, batch_size, repeat)
+        frozen.close()
+        r = {'images_per_sec': throughput, 'latency': 1. / throughput, 'batches': latency.to_dict(),
+             'size_mb': os.path.getsize(path) / 2. ** 20,
+             'speedup': throughput / report['keras']['images_per_sec'],
+             'max_abs_diff': float(np.abs(pred - reference).max()),
+             'dice_vs_keras': float(mask_dice(reference, pred).mean())}
+        if y is not None:
+            r['dice'] = float(mask_dice(y, pred).mean())
+            r['dice_delta'] = r['dice'] - report['keras']['dice']
+        else:
+            r['dice_delta'] = r['dice_vs_keras'] - 1.
+        report[os.path.basename(path)] = r
+    return report
+
+
+def create_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, required=True,
+                        help="keras checkpoint, e.g. experiment/model-*/best_model.hdf5")
+    parser.add_argument('--quantize', action='store_true', help="also export a graph with 8 bit weights")
+    parser.add_argument('--imdir', type=str, default=None, help="images to compare the exports on")
+    parser.add_argument('--maskdir', type=str, default=None, help="ground truth masks of --imdir")
+    parser.add_argument('--n', type=int, default=32, help="number of images compared")
+    parser.add_argument('--batch_size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--decode', type=str, default='keras')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = create_args()
+    frozen_paths = [freeze_checkpoint(args.model)]
+    if args.quantize:
+        frozen_paths.append(freeze_checkpoint(args.model, quantize=True))
+    with open(frozen_paths[0] + '.json') as f:
+        input_shape = json.load(f)['input_shape']
+    y = None
+    if args.imdir:
+        from loader import load_batch
+        from manifest import load_manifest
+        manifest = load_manifest(args.imdir, args.maskdir)
+        fns = manifest.fns[:args.n]
+        batch = load_batch(fns, manifest.fn_dict(fns), tuple(input_shape[:2]), input_shape[2] == 1,
+                           test=args.maskdir is None, decode=args.decode)
+        x, y = batch if args.maskdir else (batch, None)
+    else:
+        x = np.random.RandomState(0).randint(0, 255, size=[args.n] + input_shape).astype(np.uint8)
+    report = compare(args.model, frozen_paths, x, y, args.batch_size)
+    for name, r in report.items():
+        print("%-28s %8.2f images/sec  %7.2fms/image  %7.1f MB  dice delta %s" % (
+            name, r['images_per_sec'], r['latency'] * 1e3, r['size_mb'], r.get('dice_delta', '-')))
+    report_path = os.path.join(os.path.dirname(args.model), 'export_report.json')
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=1)
+    print("report written to {}".format(report_path))
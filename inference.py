@@ -0,0 +1,181 @@
+import csv
+import time
+import threading
+from queue import Queue, Empty
+from config import ORIGIN_SHAPE, QUEUE_DEPTH
+from utils import resize_mask_matrix_encode_batch
+from loader import load_batch
+
+_DONE = object()
+
+
+class StageStats(object):
+    '''
+    per-stage counters of a streaming pipeline: images processed, time spent working and time spent
+    waiting for input
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.images = 0
+        self.busy = 0.
+        self.wait = 0.
+
+    def report(self):
+        rate = self.images / self.busy if self.busy > 0 else float('inf')
+        return "stage %-10s %7d images %9.1f images/sec busy %8.1fs busy %8.1fs waiting" % (
+            self.name, self.images, rate, self.busy, self.wait)
+
+
+class PipelineStage(threading.Thread):
+    '''
+    thread applying `func` to (fns, data) items from `in_queue` and passing the results on to `out_queue`.
+    on error, the stage keeps draining its input so the stages upstream never block on a full queue.
+    '''
+    def __init__(self, name, func, in_queue, out_queue=None):
+        super(PipelineStage, self).__init__(name=name)
+        self.daemon = True
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.stats = StageStats(name)
+        self.error = None
+
+    def run(self):
+        try:
+            while True:
+                now = time.time()
+                item = self.in_queue.get()
+                self.stats.wait += time.time() - now
+                if item is _DONE:
+                    break
+                now = time.time()
+                fns, data = item
+                out = self.func(fns, data)
+                self.stats.busy += time.time() - now
+                self.stats.images += len(fns)
+                if self.out_queue is not None:
+                    self.out_queue.put((fns, out))
+        except BaseException as e:
+            self.error = e
+            while self.in_queue.get() is not _DONE:
+                pass
+        finally:
+            if self.out_queue is not None:
+                self.out_queue.put(_DONE)
+
+
+def stream_predict(model, sequence, loader, out_path, steps=None, size=ORIGIN_SHAPE, queue_depth=QUEUE_DEPTH,
+                   cache=None, cached_fns=()):
+    '''
+    read -> predict -> threshold -> upsampled rle encode -> csv, with every hand-off through a queue of
+    `queue_depth` batches, so peak memory does not depend on the number of test images and rows reach
+    `out_path` while prediction is still running.
+    :param model: keras model; predictions run in the calling thread
+    :param sequence: loader.CarvanaSequence built with test=True
+    :param loader: iterator over the batches of `sequence` in order, e.g. loader.Prefetcher(sequence)
+    :param steps: number of batches; defaults to len(sequence)
+    :param cache: optional prediction_cache.PredictionCache keyed for the images of `sequence` and cached_fns;
+        new predictions are stored in it
+    :param cached_fns: cache hits, which are read from the cache and encoded before the images of `sequence`;
+        those another process evicted in the meantime are loaded and predicted last
+    :return: list of StageStats, one per stage; the cache stage counts the images read from and stored in it
+    '''
+    steps = len(sequence) if steps is None else steps
+    read_q, pred_q, mask_q, rle_q = [Queue(maxsize=queue_depth) for _ in range(4)]
+    csv_file = open(out_path, 'w', newline='')
+    writer = csv.writer(csv_file)
+    writer.writerow(['img', 'rle_mask'])
+
+    def read(loader):
+        try:
+            for i in range(steps):
+                if stop.is_set():
+                    return
+                now = time.time()
+                x = next(loader)
+                read_stats.busy += time.time() - now
+                fns = sequence.batch_fns(i)
+                read_stats.images += len(fns)
+                read_q.put((fns, x))
+        except BaseException as e:
+            errors.append(e)
+        if not stop.is_set():
+            read_q.put(_DONE)
+
+    def write_rows(fns, rles):
+        writer.writerows(zip(fns, rles))
+        csv_file.flush()
+
+    def predict(fns, x):
+        now = time.time()
+        pred = model.predict_on_batch(x)
+        predict_stats.busy += time.time() - now
+        predict_stats.images += len(fns)
+        if cache is not None:
+            now = time.time()
+            cache.put(fns, pred)
+            cache_stats.busy += time.time() - now
+            cache_stats.images += len(fns)
+        pred_q.put((fns, pred))
+
+    def failed():
+        return bool(errors) or any(stage.error is not None for stage in stages)
+
+    stop = threading.Event()
+    errors = []
+    read_stats = StageStats('read')
+    predict_stats = StageStats('predict')
+    cache_stats = StageStats('cache')
+    stages = [PipelineStage('threshold', lambda fns, pred: pred[:, :, :, -1:] > 0.5, pred_q, mask_q),
+              PipelineStage('encode', lambda fns, masks: resize_mask_matrix_encode_batch(masks, size), mask_q, rle_q),
+              PipelineStage('write', write_rows, rle_q)]
+    reader = threading.Thread(target=read, args=(loader,), name='read')
+    reader.daemon = True
+    try:
+        reader.start()
+        for stage in stages:
+            stage.start()
+        # hits go first, so entries written for the misses cannot evict them before they are read
+        lost = []
+        for i in range(0, len(cached_fns), sequence.batch_size):
+            if failed():
+                break
+            fns = cached_fns[i:i + sequence.batch_size]
+            now = time.time()
+            found, pred = cache.get(fns)
+            cache_stats.busy += time.time() - now
+            cache_stats.images += len(found)
+            kept = set(found)
+            lost.extend(fn for fn in fns if fn not in kept)
+            if found:
+                pred_q.put((found, pred))
+        while True:
+            now = time.time()
+            item = read_q.get()
+            predict_stats.wait += time.time() - now
+            # a failed stage drains its input: stop reading and predicting for nothing
+            if item is _DONE or failed():
+                break
+            predict(*item)
+        # hits another process evicted before they were read are loaded and predicted after all
+        for i in range(0, len(lost), sequence.batch_size):
+            if failed():
+                break
+            fns = lost[i:i + sequence.batch_size]
+            predict(fns, load_batch(fns, sequence.fn_dict, sequence.target_size, sequence.grayscale, test=True,
+                                    decode=sequence.decode))
+    finally:
+        stop.set()
+        while reader.is_alive():
+            try:
+                read_q.get(timeout=0.1)
+            except Empty:
+                pass
+        pred_q.put(_DONE)
+        for stage in stages:
+            stage.join()
+        csv_file.close()
+    errors.extend(stage.error for stage in stages if stage.error is not None)
+    if errors:
+        raise errors[0]
+    return [read_stats, predict_stats, cache_stats] + [stage.stats for stage in stages]
@@ -0,0 +1,306 @@
+import time
+import numpy as np
+from math import ceil
+from collections import deque
+from multiprocessing import Pool
+from keras.utils import Sequence
+from utils import BatchRing, fill_batch
+from augment import augment_batch, augment_rng, crop_origins
+from profiling import TimingStats, add_time
+
+
+def load_batch(fns, fn_dict, target_size=(256, 256), grayscale=True, test=False, cache=None, decode='keras',
+               mask_source=None, mask_sampling='nearest'):
+    '''
+    :param fns: filenames of one batch
+    :param fn_dict: {'fn':['path/to/img', 'path/to/mask']}
+    :param cache: optional cache.DatasetCache built for (target_size, grayscale)
+    :param decode: jpeg decode backend, see utils.load_image
+    :param mask_source: optional masks.RLEMaskSource rasterizing the masks instead of decoding the gifs
+    :param mask_sampling: 'nearest' or 'area', see masks.RLEMaskSource.get
+    :return: uint8 batch_x, or (batch_x, batch_y) unless test; batch_y is uint8 {0, 1}, or float32 coverage
+        fractions with area sampling
+    '''
+    channel = 1 if grayscale else 3
+    batch_x = np.zeros((len(fns),) + tuple(target_size) + (channel,), dtype=np.uint8)
+    batch_y = None
+    if not test:
+        batch_y = np.zeros((len(fns),) + tuple(target_size) + (1,), dtype=mask_dtype(mask_source, mask_sampling))
+    fill_batch(batch_x, batch_y, fns, fn_dict, target_size, grayscale, cache, decode, mask_source, mask_sampling)
+    if test:
+        return batch_x
+    return batch_x, batch_y
+
+
+def mask_dtype(mask_source=None, mask_sampling='nearest'):
+    if mask_source is not None and mask_sampling == 'area':
+        return np.float32
+    return np.uint8
+
+
+class CarvanaSequence(Sequence):
+    '''
+    random-access batches: batch `idx` of epoch `epoch` only depends on (seed, epoch, idx), so it can be
+    computed by any process in any order and gives the same result with 1 or N workers. with data_aug, the
+    batch is augmented where it is loaded (see augment.augment_batch), seeded by (seed, epoch, idx) as well.
+
+    with `crop`, the images are decoded at target_size (e.g. the --refine_size scale) and every one is cut to a
+    random `crop` window, centred on the mask outline half of the time (see augment.crop_origins), so a model
+    learns the tiles refine.CoarseToFine predicts; the batches have the crop size.
+    '''
+    def __init__(self, fns, fn_dict, target_size=(256, 256), grayscale=True, batch_size=2, data_aug=False,
+                 shuffle=False, test=False, cache=None, seed=1, decode='keras', mask_source=None,
+                 mask_sampling='nearest', crop=None):
+        '''
+        :param crop: optional (rows, cols) of the random windows, at most target_size
+        '''
+        self.fns = list(fns)
+        self.fn_dict = fn_dict
+        self.target_size = tuple(target_size)
+        self.grayscale = grayscale
+        self.batch_size = batch_size
+        self.data_aug = data_aug
+        self.shuffle = shuffle
+        self.test = test
+        self.cache = cache
+        self.seed = seed
+        self.decode = decode
+        self.mask_source = mask_source
+        self.mask_sampling = mask_sampling
+        self.crop = None if crop is None else tuple(crop)
+        self.epoch = 0
+        self._order_epoch = None
+        self._order = None
+
+    def __len__(self):
+        return int(ceil(len(self.fns) / float(self.batch_size)))
+
+    def order(self, epoch):
+        '''
+        :return: permutation of range(len(fns)) used in `epoch`
+        '''
+        if self._order_epoch != epoch:
+            if self.shuffle:
+                self._order = np.random.RandomState(self.seed + epoch).permutation(len(self.fns))
+            else:
+                self._order = np.arange(len(self.fns))
+            self._order_epoch = epoch
+        return self._order
+
+    def batch_fns(self, idx, epoch=None):
+        if epoch is None:
+            epoch = self.epoch
+        positions = self.order(epoch)[idx * self.batch_size: (idx + 1) * self.batch_size]
+        return [self.fns[i] for i in positions]
+
+    @property
+    def input_size(self):
+        '''
+        :return: (rows, cols) of the batches
+        '''
+        return self.target_size if self.crop is None else self.crop
+
+    def _cropped(self, batch_x, batch_y, rng):
+        origins = crop_origins(rng, len(batch_x), self.target_size, self.crop, batch_y)
+        rows, cols = self.crop
+        x = np.stack([a[r:r + rows, c:c + cols] for a, (r, c) in zip(batch_x, origins)])
+        if batch_y is None:
+            return x, None
+        return x, np.stack([a[r:r + rows, c:c + cols] for a, (r, c) in zip(batch_y, origins)])
+
+    def get_batch(self, idx, epoch=None):
+        if epoch is None:
+            epoch = self.epoch
+        batch = load_batch(self.batch_fns(idx, epoch), self.fn_dict, self.target_size, self.grayscale, self.test,
+                           self.cache, self.decode, self.mask_source, self.mask_sampling)
+        batch_x, batch_y = (batch, None) if self.test else batch
+        rng = augment_rng(self.seed, epoch, idx)
+        if self.crop is not None:
+            batch_x, batch_y = self._cropped(batch_x, batch_y, rng)
+        if self.data_aug:
+            augment_batch(batch_x, batch_y, rng)
+        return batch_x if self.test else (batch_x, batch_y)
+
+    def make_ring(self, size, shared=False):
+        return BatchRing(size, self.batch_size, self.input_size, 1 if self.grayscale else 3, masks=not self.test,
+                         mask_dtype=mask_dtype(self.mask_source, self.mask_sampling), shared=shared)
+
+    def fill(self, idx, epoch, batch_x, batch_y, timings=None):
+        '''
+        load batch `idx` of `epoch` into preallocated buffers
+        :param timings: optional dict the per-stage seconds are added to, see utils.fill_batch; augmentation
+            is added as 'augment'
+        :return: number of rows filled
+        '''
+        rng = augment_rng(self.seed, epoch, idx)
+        if self.crop is None:
+            n = fill_batch(batch_x, batch_y, self.batch_fns(idx, epoch), self.fn_dict, self.target_size,
+                           self.grayscale, self.cache, self.decode, self.mask_source, self.mask_sampling, timings)
+        else:
+            # decoded at full size, then cut into the ring
+            full_x = np.zeros((len(batch_x),) + self.target_size + batch_x.shape[3:], dtype=batch_x.dtype)
+            full_y = None
+            if batch_y is not None:
+                full_y = np.zeros((len(batch_y),) + self.target_size + batch_y.shape[3:], dtype=batch_y.dtype)
+            n = fill_batch(full_x, full_y, self.batch_fns(idx, epoch), self.fn_dict, self.target_size,
+                           self.grayscale, self.cache, self.decode, self.mask_source, self.mask_sampling, timings)
+            start = time.time()
+            x, y = self._cropped(full_x[:n], None if full_y is None else full_y[:n], rng)
+            batch_x[:n] = x
+            if batch_y is not None:
+                batch_y[:n] = y
+            add_time(timings, 'crop', start)
+        if self.data_aug:
+            augment_batch(batch_x[:n], None if batch_y is None else batch_y[:n], rng, timings=timings)
+        return n
+
+    def __getitem__(self, idx):
+        return self.get_batch(idx)
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+
+_worker_sequence = None
+_worker_ring = None
+
+
+def _init_worker(sequence, ring):
+    global _worker_sequence, _worker_ring
+    _worker_sequence = sequence
+    _worker_ring = ring
+
+
+def _fill(sequence, ring, task):
+    epoch, idx, slot = task
+    batch_x, batch_y = ring.slot(slot)
+    timings = {}
+    start = time.time()
+    n = sequence.fill(idx, epoch, batch_x, batch_y, timings)
+    timings['load'] = time.time() - start
+    return slot, n, timings
+
+
+def _worker_fill(task):
+    return _fill(_worker_sequence, _worker_ring, task)
+
+
+class Prefetcher(object):
+    '''
+    endless iterator over a CarvanaSequence that keeps `queue_depth` batches in flight on a process pool.
+    batches are returned in (epoch, idx) order; workers=0 computes them in the calling process instead.
+
+    workers fill a ring of queue_depth + hold shared uint8 buffers in place, so nothing is pickled back. the
+    returned arrays are views into the ring: a batch is valid until the consumer has taken `hold` more
+    batches, i.e. `hold` must cover every batch the consumer keeps alive (keras queues included).
+
+    `stats` holds per-batch histograms of the loading stages measured in the workers (decode, resize, mask,
+    assemble, load in total) and of `queue_wait`, the time the consumer blocked on the next batch.
+
+    usage:
+        seq = CarvanaSequence(fns, fn_dict, shuffle=True)
+        model.fit_generator(Prefetcher(seq, workers=4, hold=4), steps_per_epoch=len(seq), max_queue_size=2)
+    '''
+    def __init__(self, sequence, workers=4, queue_depth=8, epoch=0, hold=1, context=None):
+        '''
+        :param context: multiprocessing context the workers are started from; by default they are forked from
+            this process, which must then not hold a tensorflow session yet. get_context('forkserver') starts
+            them from a fresh server process instead (sequence and ring are pickled to it)
+        '''
+        self.sequence = sequence
+        self.workers = workers
+        self.queue_depth = max(1, queue_depth)
+        self.epoch = epoch
+        self.idx = 0
+        self.step = 0
+        self.pending = deque()
+        self.pool = None
+        self.stats = TimingStats()
+        self.ring = sequence.make_ring(self.queue_depth + max(1, hold), shared=workers > 0)
+        if workers > 0:
+            self.pool = (context.Pool if context is not None else Pool)(workers, initializer=_init_worker,
+                                                                        initargs=(sequence, self.ring))
+
+    def __iter__(self):
+        return self
+
+    def _next_task(self):
+        task = (self.epoch, self.idx, self.step % len(self.ring))
+        self.step += 1
+        self.idx += 1
+        if self.idx >= len(self.sequence):
+            self.idx = 0
+            self.epoch += 1
+        return task
+
+    def _batch(self, slot, n, timings):
+        self.stats.update(timings)
+        batch_x, batch_y = self.ring.slot(slot)
+        if batch_y is None:
+            return batch_x[:n]
+        return batch_x[:n], batch_y[:n]
+
+    def __next__(self):
+        if self.pool is None:
+            return self._batch(*_fill(self.sequence, self.ring, self._next_task()))
+        while len(self.pending) < self.queue_depth:
+            self.pending.append(self.pool.apply_async(_worker_fill, (self._next_task(),)))
+        start = time.time()
+        result = self.pending.popleft().get()
+        self.stats.add('queue_wait', time.time() - start)
+        return self._batch(*result)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.pending.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StageLoaders(object):
+    '''
+    the loaders of successive training stages (e.g. the resolutions of a schedule), alive one stage at a time.
+    the first stage's loaders are made in the constructor, so their workers can be forked before a tensorflow
+    session exists; the next stage's are made when it starts, with workers started from `context` (e.g. a
+    forkserver, which does not fork this process). the Prefetchers of a stage are closed and dropped when
+    it ends, so the workers and rings of only one stage exist at a time.
+
+    usage:
+        stages = StageLoaders(schedule, lambda stage, context: make_loaders(stage, context),
+                              get_context('forkserver'))
+        # create the session, then
+        for stage, loaders in stages:
+            train(stage, loaders)
+    '''
+    def __init__(self, stages, make_loaders, context=None):
+        '''
+        :param make_loaders: function (stage, context) -> tuple of the stage's loaders; the Prefetchers in it
+            are closed at the end of the stage
+        '''
+        self.stages = list(stages)
+        self.make_loaders = make_loaders
+        self.context = context
+        self.loaders = make_loaders(self.stages[0], None) if self.stages else None
+
+    def __iter__(self):
+        for i, stage in enumerate(self.stages):
+            if self.loaders is None:
+                self.loaders = self.make_loaders(stage, self.context)
+            try:
+                yield stage, self.loaders
+            finally:
+                self.close()
+
+    def close(self):
+        if self.loaders is not None:
+            for loader in self.loaders:
+                if isinstance(loader, Prefetcher):
+                    loader.close()
+            self.loaders = None
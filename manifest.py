@@ -0,0 +1,192 @@
+import os
+import re
+import hashlib
+import numpy as np
+
+MANIFEST_VERSION = 1
+IMAGE_SUFFIX = '.jpg'
+MASK_SUFFIX = '_mask.gif'
+_CARVANA_NAME = re.compile(r'^(.+)_(\d+)$')
+
+
+def parse_name(fn):
+    '''
+    :param fn: image id following the carvana naming `<car>_<NN>`, e.g. '00087a6bd4dc_01'
+    :return: (car id, view angle); (fn, -1) for names that do not follow it
+    '''
+    match = _CARVANA_NAME.match(fn)
+    if match is None:
+        return fn, -1
+    return match.group(1), int(match.group(2))
+
+
+def _dir_mtime(directory):
+    return os.stat(directory).st_mtime_ns if directory else 0
+
+
+def _scan(directory, suffix, known=None):
+    '''
+    :param known: {id: (size, mtime_ns)} from an earlier scan; only files missing from it are stat'ed
+    :return: {id: (size, mtime_ns)} of the files named id + suffix in `directory`
+    '''
+    known = known or {}
+    out = {}
+    for entry in os.scandir(directory):
+        if entry.name.endswith(suffix) and entry.is_file():
+            fn = entry.name[:-len(suffix)]
+            if fn in known:
+                out[fn] = known[fn]
+            else:
+                st = entry.stat()
+                out[fn] = (st.st_size, st.st_mtime_ns)
+    return out
+
+
+class Manifest(object):
+    '''
+    column table of the dataset: one row per image, sorted by id, with car id, view angle, and the size and
+    mtime of the image and its mask (-1 when there is no mask). paths are rebuilt from the two directories,
+    so the persisted file stays small and loads with a single np.load.
+
+    usage:
+        manifest = load_manifest(img_dir, mask_dir)
+        fn_dict = manifest.fn_dict()
+        train_fns, valid_fns = manifest.split(300)
+    '''
+    COLUMNS = ('ids', 'car', 'angle', 'img_size', 'img_mtime', 'mask_size', 'mask_mtime')
+
+    def __init__(self, img_dir, mask_dir=None, img_files=None, mask_files=None, dir_mtimes=(0, 0)):
+        '''
+        :param img_files: {id: (size, mtime_ns)} of the images
+        :param mask_files: {id: (size, mtime_ns)} of the masks
+        :param dir_mtimes: mtimes of (img_dir, mask_dir) when they were scanned
+        '''
+        self.img_dir = img_dir
+        self.mask_dir = mask_dir
+        self.dir_mtimes = tuple(dir_mtimes)
+        img_files = img_files or {}
+        mask_files = mask_files or {}
+        self.ids = np.array(sorted(img_files), dtype=str)
+        names = [parse_name(fn) for fn in self.ids]
+        self.car = np.array([car for car, _ in names], dtype=str)
+        self.angle = np.array([angle for _, angle in names], dtype=np.int16)
+        img = np.array([img_files[fn] for fn in self.ids], dtype=np.int64).reshape(-1, 2)
+        mask = np.array([mask_files.get(fn, (-1, -1)) for fn in self.ids], dtype=np.int64).reshape(-1, 2)
+        self.img_size, self.img_mtime = img[:, 0], img[:, 1]
+        self.mask_size, self.mask_mtime = mask[:, 0], mask[:, 1]
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def fns(self):
+        return self.ids.tolist()
+
+    def files(self, masks=False):
+        '''
+        :return: {id: (size, mtime_ns)} of the images, or of the masks present
+        '''
+        size, mtime = (self.mask_size, self.mask_mtime) if masks else (self.img_size, self.img_mtime)
+        return {fn: (s, m) for fn, s, m in zip(self.fns, size.tolist(), mtime.tolist()) if s >= 0}
+
+    def fn_dict(self, fns=None):
+        '''
+        :return: {'fn':['path/to/img', 'path/to/mask']}; just the image path without a mask directory
+        '''
+        fns = self.fns if fns is None else fns
+        if self.mask_dir is None:
+            return {fn: [os.path.join(self.img_dir, fn + IMAGE_SUFFIX)] for fn in fns}
+        return {fn: [os.path.join(self.img_dir, fn + IMAGE_SUFFIX), os.path.join(self.mask_dir, fn + MASK_SUFFIX)]
+                for fn in fns}
+
+    def split(self, n_valid=300, seed=1):
+        '''
+        car-grouped train/valid split: whole cars are drawn in a seeded random order until at least `n_valid`
+        images are in the validation set, so no car has views on both sides.
+        :return: (train_fns, valid_fns)
+        '''
+        cars, car_index, counts = np.unique(self.car, return_inverse=True, return_counts=True)
+        order = np.random.RandomState(seed).permutation(len(cars))
+        n_cars = np.searchsorted(np.cumsum(counts[order]), n_valid) + 1 if n_valid > 0 else 0
+        valid = np.zeros(len(cars), dtype=bool)
+        valid[order[:n_cars]] = True
+        in_valid = valid[car_index]
+        return self.ids[~in_valid].tolist(), self.ids[in_valid].tolist()
+
+    def save(self, path):
+        '''
+        write the table to `path` (.npz) atomically
+        '''
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = '{}.tmp{}'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, version=MANIFEST_VERSION, img_dir=self.img_dir, mask_dir=self.mask_dir or '',
+                     dir_mtimes=np.array(self.dir_mtimes, dtype=np.int64),
+                     **{column: getattr(self, column) for column in self.COLUMNS})
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data['version']) != MANIFEST_VERSION:
+                raise ValueError("manifest {} has version {}, expected {}".format(path, int(data['version']),
+                                                                                  MANIFEST_VERSION))
+            manifest = cls(str(data['img_dir']), str(data['mask_dir']) or None,
+                           dir_mtimes=data['dir_mtimes'].tolist())
+            for column in cls.COLUMNS:
+                setattr(manifest, column, data[column])
+        return manifest
+
+
+def default_manifest_path(img_dir, mask_dir=None, root='experiment'):
+    key = hashlib.sha1('{}|{}'.format(os.path.abspath(img_dir), mask_dir and os.path.abspath(mask_dir)).encode())
+    return os.path.join(root, 'manifest-{}.npz'.format(key.hexdigest()[:10]))
+
+
+def load_manifest(img_dir, mask_dir=None, path=None, verify=False):
+    '''
+    load the persisted manifest of img_dir (and mask_dir) and bring it up to date. a directory is only
+    listed again when its mtime changed, i.e. files were added, removed or renamed in it, and then only the
+    new files are stat'ed; unchanged directories cost one stat. the manifest is written back only when
+    something changed.
+    :param path: manifest file; defaults to experiment/manifest-<hash of the directories>.npz
+    :param verify: list and stat every file even if nothing seems to have changed, e.g. after files were
+        rewritten in place
+    :return: Manifest
+    '''
+    path = path or default_manifest_path(img_dir, mask_dir)
+    dir_mtimes = (_dir_mtime(img_dir), _dir_mtime(mask_dir))
+    old = None
+    if os.path.exists(path):
+        try:
+            old = Manifest.load(path)
+        except (ValueError, KeyError, OSError) as e:
+            print("manifest {} unreadable ({}), rescanning...".format(path, e))
+    if old is not None and old.dir_mtimes == dir_mtimes and not verify:
+        return old
+
+    known = old if old is not None and not verify else None
+    img_files = known.files() if known is not None else {}
+    if known is None or known.dir_mtimes[0] != dir_mtimes[0]:
+        img_files = _scan(img_dir, IMAGE_SUFFIX, img_files)
+    mask_files = {}
+    if mask_dir is not None:
+        mask_files = known.files(True) if known is not None else {}
+        if known is None or known.dir_mtimes[1] != dir_mtimes[1]:
+            mask_files = _scan(mask_dir, MASK_SUFFIX, mask_files)
+    manifest = Manifest(img_dir, mask_dir, img_files, mask_files, dir_mtimes)
+
+    if old is not None:
+        before = dict(zip(old.fns, zip(old.img_size.tolist(), old.img_mtime.tolist(), old.mask_size.tolist(),
+                                       old.mask_mtime.tolist())))
+        after = dict(zip(manifest.fns, zip(manifest.img_size.tolist(), manifest.img_mtime.tolist(),
+                                           manifest.mask_size.tolist(), manifest.mask_mtime.tolist())))
+        changed = sum(1 for fn in after if fn in before and before[fn] != after[fn])
+        print("manifest refreshed: {} added, {} removed, {} changed...".format(
+            len(after.keys() - before.keys()), len(before.keys() - after.keys()), changed))
+    else:
+        print("manifest built for {} images...".format(len(manifest)))
+    manifest.save(path)
+    return manifest
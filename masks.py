@@ -0,0 +1,96 @@
+import os
+import numpy as np
+import pandas as pd
+from config import ORIGIN_SHAPE
+from utils import nearest_index_map
+
+
+class RLEMaskSource(object):
+    '''
+    training masks read from train_masks.csv instead of the `_mask.gif` files.
+
+    the csv is parsed once into a run table: the 0-based start and the length of every run of every image in
+    two flat int32 arrays, plus per-image offsets into them. masks are rasterized straight at target_size from
+    the runs; the full resolution bitmap is never built.
+
+    usage:
+        masks = RLEMaskSource('train_masks.csv')
+        mask = masks.get('00087a6bd4dc_01', (256, 256))
+    '''
+    def __init__(self, csv_path, shape=ORIGIN_SHAPE):
+        '''
+        :param csv_path: csv with columns img (e.g. '00087a6bd4dc_01.jpg') and rle_mask
+        :param shape: (width, height) the rle strings refer to
+        '''
+        self.csv_path = csv_path
+        self.shape = shape
+        data = pd.read_csv(csv_path).fillna('')
+        fns = [os.path.splitext(fn)[0] for fn in data['img']]
+        rles = list(data['rle_mask'])
+        counts = np.array([len(rle.split()) // 2 for rle in rles], dtype=np.int64)
+        values = np.array(' '.join(rles).split(), dtype=np.int32)
+        self.starts = values[0::2] - 1  # rle index starts at 1, matrix index starts at 0
+        self.lengths = values[1::2].copy()
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.position = {fn: i for i, fn in enumerate(fns)}
+
+    def __len__(self):
+        return len(self.position)
+
+    def __contains__(self, fn):
+        return fn in self.position
+
+    def runs(self, fn):
+        '''
+        :return: (starts, lengths) of the runs of `fn`, 0-based flat indices
+        '''
+        i = self.position[fn]
+        return self.starts[self.offsets[i]:self.offsets[i + 1]], self.lengths[self.offsets[i]:self.offsets[i + 1]]
+
+    def coverage(self, fn, positions):
+        '''
+        :param positions: flat (possibly fractional) positions in the full resolution mask
+        :return: number of mask pixels before every position, i.e. the integral of the mask along the flat index
+        '''
+        starts, lengths = self.runs(fn)
+        covered = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        k = np.searchsorted(starts, positions, 'right')
+        previous = np.maximum(k - 1, 0)
+        partial = np.clip(positions - starts[previous], 0, lengths[previous]) if len(starts) else 0
+        return np.where(k > 0, covered[previous] + partial, 0)
+
+    def get(self, fn, target_size=(256, 256), method='nearest'):
+        '''
+        :param target_size: tuple; (x, y) as in keras load_img
+        :param method: 'nearest' samples the same pixels as a nearest resize of the gif; 'area' averages
+            the covered fraction of every target pixel
+        :return: uint8 [x, y] mask with values in [0, 255]
+        '''
+        if method == 'nearest':
+            return self._nearest(fn, target_size)
+        elif method == 'area':
+            return self._area(fn, target_size)
+        raise ValueError("mask sampling {} not understood, choose from ('nearest', 'area')".format(method))
+
+    def _nearest(self, fn, target_size):
+        width, height = self.shape
+        rmap = nearest_index_map(height, target_size[0])
+        cmap = nearest_index_map(width, target_size[1])
+        # a sampled pixel is set when the coverage grows across it
+        positions = (rmap[:, np.newaxis] * width + cmap[np.newaxis, :]).ravel()
+        inside = self.coverage(fn, positions + 1) - self.coverage(fn, positions) > 0
+        return inside.reshape(target_size).astype(np.uint8) * 255
+
+    def _area(self, fn, target_size):
+        width, height = self.shape
+        out_h, out_w = target_size
+        # covered length of every target column in every source row
+        bounds = np.arange(out_w + 1) * (width / float(out_w))
+        positions = np.arange(height)[:, np.newaxis] * width + bounds[np.newaxis, :]
+        row_cover = np.diff(self.coverage(fn, positions.ravel()).reshape(positions.shape), axis=1)
+        # overlap of every target row with every source row
+        bounds = np.arange(out_h + 1) * (height / float(out_h))
+        overlap = np.clip(bounds[:, np.newaxis] - np.arange(height)[np.newaxis, :], 0, 1)
+        weights = np.diff(overlap, axis=0)
+        fraction = weights.dot(row_cover) * (out_w * out_h / float(width * height))
+        return np.uint8(np.clip(np.round(fraction * 255), 0, 255))
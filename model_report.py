@@ -0,0 +1,139 @@
+import os
+import glob
+import json
+import argparse
+import platform
+import itertools
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from keras.backend.tensorflow_backend import set_session
+from models import unet_family, family_name, UPSAMPLE_MODES
+from export import time_batches
+
+
+def layer_macs(layer):
+    '''
+    :return: multiply-accumulates of one forward pass of `layer` for a single image; 0 for layers that cost
+        little next to the convolutions (fused activations, pooling, concatenation, casts)
+    '''
+    kind = type(layer).__name__
+    if kind in ('Conv2D', 'SeparableConv2D', 'Conv2DTranspose'):
+        k = int(np.prod(layer.kernel_size))
+        c_in, c_out = layer.input_shape[-1], layer.output_shape[-1]
+        if kind == 'SeparableConv2D':
+            _, h, w, _ = layer.output_shape
+            return h * w * c_in * layer.depth_multiplier * (k + c_out)
+        if kind == 'Conv2DTranspose':
+            # every input pixel is scattered into k outputs
+            _, h, w, _ = layer.input_shape
+            return h * w * k * c_in * c_out
+        _, h, w, _ = layer.output_shape
+        return h * w * k * c_in * c_out
+    if kind == 'Lambda' and len(layer.output_shape) == 4 and layer.output_shape[1] > layer.input_shape[1]:
+        # bilinear resize: 4 taps per output value
+        _, h, w, c = layer.output_shape
+        return 4 * h * w * c
+    return 0
+
+
+def count_macs(model):
+    '''
+    :return: multiply-accumulates per image; the flops are about twice as many
+    '''
+    return int(sum(layer_macs(layer) for layer in model.layers))
+
+
+def activation_bytes(model, dtype_bytes=4):
+    '''
+    :return: bytes of the layer outputs of one forward pass for a single image; training keeps them all for the
+        backward pass, so this is about the memory a batch of activations takes per image
+    '''
+    total = 0
+    for layer in model.layers:
+        shapes = layer.output_shape if isinstance(layer.output_shape, list) else [layer.output_shape]
+        total += sum(int(np.prod(shape[1:])) for shape in shapes)
+    return total * dtype_bytes
+
+
+def profile_config(target_size, width=1., depth=5, separable=False, upsample='transpose', batch_size=1, n=8,
+                   repeat=3, threads=0):
+    '''
+    build one unet_family configuration with random weights and time it on cpu
+    :param target_size: (x, y, channel)
+    :return: {'name', 'params', 'macs', 'gflops', 'latency_p50', 'latency_p90' (per image), 'images_per_sec', ...}
+    '''
+    K.clear_session()
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads)
+    config.device_count['GPU'] = 0
+    set_session(tf.Session(config=config))
+    model = unet_family(target_size, width=width, depth=depth, separable=separable, upsample=upsample)
+    x = np.random.RandomState(0).randint(0, 255, size=(n,) + model.input_shape[1:]).astype(np.uint8)
+    model.predict_on_batch(x[:batch_size])  # graph warm-up
+    _, latency, throughput = time_batches(model.predict_on_batch, x, batch_size, repeat)
+    macs = count_macs(model)
+    report = {'name': family_name(width, depth, separable, upsample), 'width': width, 'depth': depth,
+              'separable': separable, 'upsample': upsample, 'target_size': list(target_size),
+              'params': model.count_params(), 'macs': macs, 'gflops': 2. * macs / 1e9,
+              'latency_p50': latency.percentile(50) / batch_size, 'latency_p90': latency.percentile(90) / batch_size,
+              'images_per_sec': throughput}
+    K.clear_session()
+    return report
+
+
+def trained_dice(experiments):
+    '''
+    :param experiments: experiment directories written by train.py
+    :return: {(name, x, y): best val_dice_coef} of the runs that recorded their architecture
+    '''
+    dice = {}
+    for directory in experiments:
+        try:
+            with open(os.path.join(directory, 'architecture.json')) as f:
+                arch = json.load(f)
+            with open(os.path.join(directory, 'schedule.json')) as f:
+                best = json.load(f)[-1]['best_val_dice_coef']
+        except (OSError, ValueError, IndexError, KeyError):
+            continue
+        if best is None:
+            continue
+        key = (arch['name'], arch['target_size'][0], arch['target_size'][1])
+        dice[key] = max(best, dice.get(key, best))
+    return dice
+
+
+def create_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--target_size', type=int, nargs=2, default=[256, 256])
+    parser.add_argument('--rgb', action='store_true')
+    parser.add_argument('--widths', type=float, nargs='+', default=[0.25, 0.5, 1.])
+    parser.add_argument('--depths', type=int, nargs='+', default=[4, 5])
+    parser.add_argument('--separable', type=str, nargs='+', default=['no', 'yes'], choices=['no', 'yes'])
+    parser.add_argument('--upsample', type=str, nargs='+', default=list(UPSAMPLE_MODES), choices=UPSAMPLE_MODES)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--n', type=int, default=8, help="images timed per pass")
+    parser.add_argument('--repeat', type=int, default=3, help="timed passes; the fastest gives images/sec")
+    parser.add_argument('--threads', type=int, default=0, help="tensorflow threads; 0 lets it pick")
+    parser.add_argument('--experiments', type=str, default='experiment/model-*',
+                        help="training runs whose val dice is joined to the matching configurations")
+    parser.add_argument('--out', type=str, default='model_report.json')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = create_args()
+    target_size = tuple(args.target_size) + (3 if args.rgb else 1,)
+    dice = trained_dice(glob.glob(args.experiments))
+    reports = []
+    for width, depth, separable, upsample in itertools.product(args.widths, args.depths, args.separable,
+                                                               args.upsample):
+        r = profile_config(target_size, width, depth, separable == 'yes', upsample, args.batch_size, args.n,
+                           args.repeat, args.threads)
+        r['val_dice_coef'] = dice.get((r['name'], target_size[0], target_size[1]))
+        reports.append(r)
+        print("%-24s %10d params %8.2f GFLOPs  p50 %8.1fms/image  %8.2f images/sec  val dice %s" % (
+            r['name'], r['params'], r['gflops'], r['latency_p50'] * 1e3, r['images_per_sec'], r['val_dice_coef']))
+    with open(args.out, 'w') as f:
+        json.dump({'host': platform.node(), 'threads': args.threads, 'batch_size': args.batch_size,
+                   'configs': sorted(reports, key=lambda r: -r['images_per_sec'])}, f, indent=1)
+    print("report written to {}".format(args.out))
@@ -1,14 +1,15 @@
+import keras.backend as K
 from keras.models import Sequential, Model
-from keras.layers import Input, Conv2D, MaxPool2D, Conv2DTranspose, concatenate, Lambda
+from keras.layers import Input, Conv2D, SeparableConv2D, MaxPool2D, Conv2DTranspose, concatenate, Lambda
 
 
 def SimpleCNN(target_size, normalize=None):
     y, x, channel = target_size
-    inp = Input((x,y,channel))
+    inp = Input((x,y,channel), dtype='uint8')
     if normalize is None:
-        inputs1 = Lambda(lambda x: x/255.)(inp)
+        inputs1 = Lambda(lambda x: K.cast(x, 'float32')/255.)(inp)
     else:
-        inputs1 = Lambda(lambda x: x-normalize)(inp)
+        inputs1 = Lambda(lambda x: K.cast(x, 'float32')-normalize)(inp)
     x = Conv2D(1,(1,1))(inputs1)
     model = Model(inp, x)
     return model
@@ -16,11 +17,11 @@ def SimpleCNN(target_size, normalize=None):
 
 def unet(target_size, normalize=None):
     y, x, channel = target_size
-    inputs = Input((x, y, channel))
+    inputs = Input((x, y, channel), dtype='uint8')
     if normalize is None:
-        inputs1 = Lambda(lambda x: x/255.)(inputs)
+        inputs1 = Lambda(lambda x: K.cast(x, 'float32')/255.)(inputs)
     else:
-        inputs1 = Lambda(lambda x: x - normalize)(inputs)
+        inputs1 = Lambda(lambda x: K.cast(x, 'float32') - normalize)(inputs)
     conv1 = Conv2D(32, (3, 3), activation='relu', padding='same')(inputs1)
     conv1 = Conv2D(32, (3, 3), activation='relu', padding='same')(conv1)
     pool1 = MaxPool2D(pool_size=(2, 2))(conv1)
@@ -60,4 +61,69 @@ def unet(target_size, normalize=None):
 
     model = Model(inputs=[inputs], outputs=[conv10])
 
-    return model
\ No newline at end of file
+    return model
+
+
+UPSAMPLE_MODES = ('transpose', 'bilinear')
+
+
+def _conv(x, filters, separable):
+    if separable:
+        return SeparableConv2D(filters, (3, 3), activation='relu', padding='same')(x)
+    return Conv2D(filters, (3, 3), activation='relu', padding='same')(x)
+
+
+def _upsample(x, filters, mode):
+    if mode == 'transpose':
+        return Conv2DTranspose(filters, (2, 2), strides=(2, 2), padding='same')(x)
+    # the 1x1 projection commutes with the (linear) resize, so it runs at the lower resolution
+    x = Conv2D(filters, (1, 1))(x)
+    return Lambda(lambda x: K.tf.image.resize_bilinear(x, [2 * K.int_shape(x)[1], 2 * K.int_shape(x)[2]]),
+                  output_shape=lambda s: (s[0], 2 * s[1], 2 * s[2], s[3]))(x)
+
+
+def unet_family(target_size, normalize=None, width=1., depth=5, separable=False, upsample='transpose'):
+    '''
+    parameterized unet; the defaults build the same network as `unet`.
+    :param width: multiplier of the filters of every level (32 * width at full resolution, doubled per level)
+    :param depth: number of resolution levels, i.e. depth - 1 poolings; target_size must be divisible by
+        2 ** (depth - 1)
+    :param separable: depthwise-separable 3x3 convolutions everywhere but the first one, which sees the raw
+        image channels
+    :param upsample: 'transpose' (learned 2x2 transposed convolution) or 'bilinear' (1x1 convolution and
+        bilinear resize)
+    '''
+    if upsample not in UPSAMPLE_MODES:
+        raise ValueError("upsample must be one of {}, got {}".format(UPSAMPLE_MODES, upsample))
+    y, x, channel = target_size
+    if x % 2 ** (depth - 1) or y % 2 ** (depth - 1):
+        raise ValueError("target_size {} is not divisible by 2 ** {}".format(target_size[:2], depth - 1))
+    filters = [max(1, int(round(32 * width))) * 2 ** level for level in range(depth)]
+    inputs = Input((x, y, channel), dtype='uint8')
+    if normalize is None:
+        inputs1 = Lambda(lambda x: K.cast(x, 'float32')/255.)(inputs)
+    else:
+        inputs1 = Lambda(lambda x: K.cast(x, 'float32') - normalize)(inputs)
+
+    skips = []
+    conv = Conv2D(filters[0], (3, 3), activation='relu', padding='same')(inputs1)
+    for level in range(depth):
+        if level > 0:
+            conv = _conv(MaxPool2D(pool_size=(2, 2))(conv), filters[level], separable)
+        conv = _conv(conv, filters[level], separable)
+        skips.append(conv)
+
+    for level in reversed(range(depth - 1)):
+        up = concatenate([_upsample(conv, filters[level], upsample), skips[level]], axis=3)
+        conv = _conv(up, filters[level], separable)
+        conv = _conv(conv, filters[level], separable)
+
+    outputs = Conv2D(1, (1, 1), activation='sigmoid')(conv)
+    return Model(inputs=[inputs], outputs=[outputs])
+
+
+def family_name(width=1., depth=5, separable=False, upsample='transpose'):
+    '''
+    :return: short name of a unet_family configuration, e.g. 'w0.5-d4-sep-bilinear'
+    '''
+    return 'w{:g}-d{}{}-{}'.format(width, depth, '-sep' if separable else '', upsample)
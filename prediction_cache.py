@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from multiprocessing.dummy import Pool as ThreadPool
+
+PREDICTION_CACHE_VERSION = 1
+HASH_INDEX = 'image_hashes.json'
+
+
+def file_digest(path, chunk_size=2 ** 20):
+    '''
+    :return: sha1 hex digest of the bytes of `path`
+    '''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def quantize(pred):
+    '''
+    :return: probabilities in [0, 1] as uint8 in [0, 255], rounded half down so that q >= 128 exactly when p > 0.5
+    '''
+    return np.ceil(np.clip(pred, 0., 1.) * 255. - 0.5).astype(np.uint8)
+
+
+def dequantize(q):
+    return q.astype(np.float32) / 255.
+
+
+class PredictionCache(object):
+    '''
+    content-addressed on-disk cache of network outputs. an entry is keyed by the sha1 of the checkpoint
+    file, the sha1 of the image bytes, the target size and the decode backend, so it stays valid across
+    renamed or copied files and is never served for another checkpoint. outputs are stored uint8-quantized,
+    one .npy per image under <path>/<key[:2]>/<key>.npy.
+
+    the cache holds at most `max_bytes`; the least recently used entries (by file mtime, bumped on every
+    lookup hit) are evicted first. image digests are remembered by (size, mtime) in image_hashes.json, so
+    unchanged images are only hashed once.
+
+    several processes (e.g. the shards of shards.py launch) may share the directory: the listing is refreshed
+    after every `rescan_bytes` written, so their entries count against max_bytes too, an entry used or
+    rewritten by another process since it was listed is not evicted, and a hit evicted by another process
+    before it is read is dropped by `get`, to be predicted again.
+
+    usage:
+        cache = PredictionCache('cache/predictions', model_path, TARGET_SIZE)
+        hit_fns, miss_fns = cache.split(fns, fn_dict)
+        cache.put(miss_fns, model.predict(load_batch(miss_fns, fn_dict, test=True)))
+        hit_fns, pred = cache.get(hit_fns)
+    '''
+    def __init__(self, path, model_path, target_size=(256, 256), decode='keras', max_bytes=20 * 2 ** 30,
+                 processes=8, variant='', rescan_bytes=None):
+        '''
+        :param model_path: checkpoint (.hdf5) or frozen graph (.pb) the predictions come from
+        :param variant: anything else the predictions depend on, e.g. the test-time augmentation; part of the key
+        :param processes: threads hashing images
+        :param rescan_bytes: bytes this process writes between listings of the directory (default: max_bytes / 16)
+        '''
+        self.path = path
+        self.max_bytes = max_bytes
+        self.processes = processes
+        self.rescan_bytes = max_bytes // 16 if rescan_bytes is None else rescan_bytes
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.model_digest = file_digest(model_path)
+        self.prefix = json.dumps([PREDICTION_CACHE_VERSION, self.model_digest, list(target_size), decode] +
+                                 ([variant] if variant else []))
+        self.keys = {}
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.evicted = 0
+        self.lost = 0
+        self.hash_seconds = 0.
+        self.hashes = self._load_hashes()
+        self._scan()
+
+    def _load_hashes(self):
+        try:
+            with open(os.path.join(self.path, HASH_INDEX)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_hashes(self):
+        path = os.path.join(self.path, HASH_INDEX)
+        tmp = '{}.tmp{}'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.hashes, f)
+        os.replace(tmp, path)
+
+    def _scan(self):
+        entries = []
+        for sub in os.scandir(self.path):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.npy'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime_ns, entry.name[:-len('.npy')], st.st_size))
+        entries.sort()
+        # {key: (size, mtime)} from the least to the most recently used
+        self.entries = OrderedDict((key, (size, mtime)) for mtime, key, size in entries)
+        self.total_bytes = sum(size for size, _ in self.entries.values())
+        self.written_since_scan = 0
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.npy')
+
+    def _image_digest(self, path):
+        st = os.stat(path)
+        known = self.hashes.get(path)
+        if known is not None and known[:2] == [st.st_size, st.st_mtime_ns]:
+            return known[2]
+        digest = file_digest(path)
+        self.hashes[path] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def _drop(self, key):
+        size, _ = self.entries.pop(key, (0, 0))
+        self.total_bytes -= size
+
+    def _touch(self, key):
+        '''
+        :return: whether the entry exists (it may have been written or evicted by another process since the
+            listing); it is marked as the most recently used if so
+        '''
+        path = self._entry_path(key)
+        try:
+            os.utime(path)
+            st = os.stat(path)
+        except FileNotFoundError:
+            self._drop(key)
+            return False
+        self.total_bytes += st.st_size - self.entries.get(key, (0, 0))[0]
+        self.entries[key] = (st.st_size, st.st_mtime_ns)
+        self.entries.move_to_end(key)
+        return True
+
+    def split(self, fns, fn_dict):
+        '''
+        key every image by its content and look it up. hits are marked as used, so the entries written for
+        the misses of this run evict other entries first.
+        :param fn_dict: {'fn':['path/to/img', ...]}
+        :return: (hit fns, miss fns), both in the order of fns
+        '''
+        now = time.time()
+        pool = ThreadPool(self.processes)
+        digests = pool.map(self._image_digest, [fn_dict[fn][0] for fn in fns])
+        pool.close()
+        pool.join()
+        self._save_hashes()
+        hits, misses = [], []
+        for fn, digest in zip(fns, digests):
+            key = hashlib.sha1((self.prefix + digest).encode()).hexdigest()
+            self.keys[fn] = key
+            if self._touch(key):
+                hits.append(fn)
+            else:
+                misses.append(fn)
+        self.hits += len(hits)
+        self.misses += len(misses)
+        self.hash_seconds += time.time() - now
+        return hits, misses
+
+    def get(self, fns):
+        '''
+        :param fns: hits returned by `split`
+        :return: (the fns still cached, in order, float32 [len(those), ...] cached outputs). hits evicted by
+            another process since `split` are left out and counted as misses; they have to be predicted again
+        '''
+        found, out = [], []
+        for fn in fns:
+            key = self.keys[fn]
+            try:
+                out.append(np.load(self._entry_path(key)))
+            except FileNotFoundError:
+                self._drop(key)
+                self.lost += 1
+                self.hits -= 1
+                self.misses += 1
+                continue
+            found.append(fn)
+        self.bytes_read += sum(q.nbytes for q in out)
+        if not out:
+            return found, np.zeros((0,), dtype=np.float32)
+        return found, dequantize(np.stack(out))
+
+    def put(self, fns, pred):
+        '''
+        store the outputs of images keyed by `split`, then evict down to max_bytes
+        :param pred: [len(fns), ...] probabilities
+        '''
+        for fn, q in zip(fns, quantize(pred)):
+            key = self.keys[fn]
+            path = self._entry_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # several shards may share the cache; a reader never sees a partly written entry
+            tmp = '{}.tmp{}'.format(path, os.getpid())
+            np.save(tmp, q)
+            os.replace(tmp + '.npy', path)
+            st = os.stat(path)
+            self._drop(key)
+            self.entries[key] = (st.st_size, st.st_mtime_ns)
+            self.total_bytes += st.st_size
+            self.bytes_written += st.st_size
+            self.written_since_scan += st.st_size
+        self._evict()
+
+    def _evict(self):
+        if self.written_since_scan >= self.rescan_bytes:
+            self._scan()
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, (size, mtime) = self.entries.popitem(last=False)
+            path = self._entry_path(key)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                # evicted by another process
+                self.total_bytes -= size
+                continue
+            if st.st_mtime_ns > mtime:
+                # used or rewritten by another process since it was listed
+                self.entries[key] = (st.st_size, st.st_mtime_ns)
+                self.total_bytes += st.st_size - size
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
+            self.evicted += 1
+
+    def to_dict(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else None,
+                'bytes_saved': self.bytes_read, 'bytes_written': self.bytes_written, 'evicted': self.evicted,
+                'lost': self.lost, 'entries': len(self.entries), 'total_bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hash_seconds': self.hash_seconds}
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return "prediction cache: {} hits, {} misses ({:.1%} hit rate), {:.1f} MB served instead of predicted, " \
+               "{:.1f} MB written, {} evicted, {:.2f}/{:.2f} GB used".format(
+                   self.hits, self.misses, self.hits / lookups if lookups else 0., self.bytes_read / 2. ** 20,
+                   self.bytes_written / 2. ** 20, self.evicted, self.total_bytes / 2. ** 30,
+                   self.max_bytes / 2. ** 30)
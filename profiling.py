@@ -0,0 +1,171 @@
+import os
+import json
+import math
+import time
+import numpy as np
+from keras.callbacks import Callback
+
+
+class Histogram(object):
+    '''
+    fixed-size histogram of durations in seconds with log-spaced bins (`bins_per_decade` per factor of 10
+    between `low` and `high`, plus an underflow and an overflow bin). adding a value is one log10, so it can
+    stay on for every batch.
+    '''
+    def __init__(self, low=1e-6, high=1e3, bins_per_decade=10):
+        self.low = low
+        self.bins_per_decade = bins_per_decade
+        self.n_bins = int(round(math.log10(high / low) * bins_per_decade))
+        self.counts = np.zeros(self.n_bins + 2, dtype=np.int64)
+        self.count = 0
+        self.total = 0.
+        self.min = float('inf')
+        self.max = 0.
+
+    def add(self, seconds):
+        if seconds < self.low:
+            i = 0
+        else:
+            i = min(int(math.log10(seconds / self.low) * self.bins_per_decade) + 1, self.n_bins + 1)
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def edge(self, i):
+        '''
+        :return: upper edge of bin i
+        '''
+        return self.low * 10 ** (i / float(self.bins_per_decade))
+
+    def percentile(self, q):
+        '''
+        :return: upper edge of the bin holding the q-th percentile, clipped to the observed range
+        '''
+        if self.count == 0:
+            return float('nan')
+        i = int(np.searchsorted(np.cumsum(self.counts), q / 100. * self.count))
+        return min(max(self.edge(i), self.min), self.max)
+
+    def to_dict(self):
+        nonzero = np.flatnonzero(self.counts)
+        return {'count': self.count, 'total': self.total, 'mean': self.total / self.count if self.count else None,
+                'min': self.min if self.count else None, 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99),
+                'bins': [[self.edge(i), int(self.counts[i])] for i in nonzero]}
+
+
+class TimingStats(object):
+    '''
+    named duration histograms, e.g. one per pipeline stage
+    '''
+    def __init__(self):
+        self.histograms = {}
+
+    def add(self, name, seconds):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        self.histograms[name].add(seconds)
+
+    def update(self, timings):
+        '''
+        :param timings: {name: seconds} measured for one item
+        '''
+        for name, seconds in timings.items():
+            self.add(name, seconds)
+
+    def to_dict(self):
+        return {name: h.to_dict() for name, h in sorted(self.histograms.items())}
+
+    def report(self):
+        return ["%-16s %7d x  p50 %8.2fms  p90 %8.2fms  p99 %8.2fms  total %8.1fs" % (
+            name, h.count, h.percentile(50) * 1e3, h.percentile(90) * 1e3, h.percentile(99) * 1e3, h.total)
+            for name, h in sorted(self.histograms.items())]
+
+
+def add_time(timings, name, start):
+    '''
+    add the time since `start` to timings[name] (if timings is not None)
+    :return: now, to be used as the next start
+    '''
+    now = time.time()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.) + now - start
+    return now
+
+
+class _EpochEndMark(Callback):
+    """Note when `on_epoch_end` starts, i.e. when validation is over, for a PipelineProfiler."""
+
+    def __init__(self, profiler):
+        super(_EpochEndMark, self).__init__()
+        self.profiler = profiler
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.profiler.epoch_end = time.time()
+
+
+class PipelineProfiler(Callback):
+    """Record where training time goes and export it next to training.log.
+
+    Per training batch it records `step` (train_on_batch) and `data_wait` (time between two batches, spent
+    fetching the next batch from the generator). Per epoch it records `validation` (end of the last batch
+    to `on_epoch_end` of `profiler.mark`, which goes first in the callback list), `callbacks` (the
+    `on_epoch_end` of the callbacks between the two, e.g. saving checkpoints) and, when an
+    AsyncModelCheckpoint runs before it, `checkpoint_stall`. Without `profiler.mark`, `validation` includes
+    the callbacks. Loaders with a `stats` attribute (loader.Prefetcher) contribute their per-batch
+    decode/resize/mask/assemble and queue-wait histograms.
+
+    # Arguments
+        log_dir: directory the histograms are written to, as `filename`, after every epoch.
+        loaders: {name: loader} to include.
+        verbose: print a summary after every epoch.
+    """
+
+    def __init__(self, log_dir, loaders=None, filename='pipeline_profile.json', verbose=1):
+        super(PipelineProfiler, self).__init__()
+        self.path = os.path.join(log_dir, filename)
+        self.loaders = loaders or {}
+        self.verbose = verbose
+        self.stats = TimingStats()
+        self.last = None
+        self.batch_start = None
+        self.epoch_end = None
+        self.mark = _EpochEndMark(self)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.last = time.time()
+
+    def on_batch_begin(self, batch, logs=None):
+        self.batch_start = time.time()
+        self.stats.add('data_wait', self.batch_start - self.last)
+
+    def on_batch_end(self, batch, logs=None):
+        self.last = time.time()
+        self.stats.add('step', self.last - self.batch_start)
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        now = time.time()
+        if self.epoch_end is None:
+            self.stats.add('validation', now - self.last)
+        else:
+            self.stats.add('validation', self.epoch_end - self.last)
+            self.stats.add('callbacks', now - self.epoch_end)
+            self.epoch_end = None
+        if 'checkpoint_stall' in logs:
+            self.stats.add('checkpoint_stall', logs['checkpoint_stall'])
+        profile = {'epoch': epoch + 1, 'train': self.stats.to_dict(),
+                   'loaders': {name: loader.stats.to_dict() for name, loader in self.loaders.items()
+                               if hasattr(loader, 'stats')}}
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(profile, f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+        if self.verbose > 0:
+            print('Epoch %05d: pipeline profile' % (epoch + 1))
+            for line in self.stats.report():
+                print('  train  ' + line)
+            for name, loader in sorted(self.loaders.items()):
+                for line in loader.stats.report():
+                    print('  %-6s %s' % (name, line))
@@ -0,0 +1,170 @@
+import time
+import cv2
+import numpy as np
+from config import ORIGIN_SHAPE
+from ensemble import checkpoint_input_shape, fit_batch
+from profiling import TimingStats, add_time
+
+
+def tile_grid(length, tile, margin):
+    '''
+    crops of `tile` pixels along one axis whose centres, `tile - 2 * margin` long, cover [0, length); crops at
+    the borders are shifted inside the image and keep more of their edge side
+    :return: int64 (origins, starts, ends): crop k covers [origins[k], origins[k] + tile) and its prediction is
+        kept on [starts[k], ends[k])
+    '''
+    if tile > length or tile <= 2 * margin:
+        raise ValueError("tile {} does not fit length {} with margin {}".format(tile, length, margin))
+    stride = tile - 2 * margin
+    starts = np.arange(0, length, stride, dtype=np.int64)
+    ends = np.minimum(starts + stride, length)
+    origins = np.clip(starts - margin, 0, length - tile)
+    return origins, starts, ends
+
+
+def uncertain_map(prob, low=0.1, high=0.9):
+    '''
+    :param prob: [rows, cols] probabilities
+    :return: bool [rows, cols], True on the outline of prob > 0.5 and wherever low < prob < high. the outline
+        includes diagonal neighbours: the coarse input is nearest-sampled, so its outline may be a pixel off in
+        any direction
+    '''
+    mask = prob > 0.5
+    out = (prob > low) & (prob < high)
+    edge = mask[1:] != mask[:-1]
+    out[1:] |= edge
+    out[:-1] |= edge
+    edge = mask[:, 1:] != mask[:, :-1]
+    out[:, 1:] |= edge
+    out[:, :-1] |= edge
+    edge = mask[1:, 1:] != mask[:-1, :-1]
+    out[1:, 1:] |= edge
+    out[:-1, :-1] |= edge
+    edge = mask[1:, :-1] != mask[:-1, 1:]
+    out[1:, :-1] |= edge
+    out[:-1, 1:] |= edge
+    return out
+
+
+def uncertain_tiles(uncertain, rows, cols, size):
+    '''
+    :param uncertain: bool [coarse rows, coarse cols], see uncertain_map
+    :param rows: (starts, ends) of the kept tile regions along the rows, at the fine resolution
+    :param cols: (starts, ends) along the columns
+    :param size: (rows, cols) of the fine resolution
+    :return: bool [len(row tiles), len(col tiles)], True for tiles whose region holds an uncertain coarse pixel
+    '''
+    h, w = uncertain.shape
+    table = np.zeros((h + 1, w + 1), dtype=np.int64)
+    table[1:, 1:] = uncertain.cumsum(axis=0).cumsum(axis=1)
+    # coarse pixels overlapping every region
+    r0, r1 = rows[0] * h // size[0], -(-rows[1] * h // size[0])
+    c0, c1 = cols[0] * w // size[1], -(-cols[1] * w // size[1])
+    counts = table[r1][:, c1] - table[r0][:, c1] - table[r1][:, c0] + table[r0][:, c0]
+    return counts > 0
+
+
+class CoarseToFine(object):
+    '''
+    two-stage inference behind the predict_on_batch interface: the coarse model predicts the whole image at
+    its (low) input size; its upsampled probabilities are kept wherever it is confident, and only the tiles
+    holding its outline or uncertain pixels are cropped from the fine resolution image and predicted again by
+    the fine model, batched across the images of the batch. the fine work scales with the outline of the
+    cars, not their area.
+
+    usage:
+        refiner = CoarseToFine.load('best_model.hdf5', 'crops/best_model.hdf5')
+        seq = CarvanaSequence(fns, fn_dict, target_size=refiner.load_size[:2],
+                              grayscale=refiner.load_size[2] == 1, test=True)
+        stream_predict(refiner, seq, Prefetcher(seq), 'submission.csv')
+    '''
+    def __init__(self, coarse, coarse_shape, fine=None, fine_shape=None, fine_size=ORIGIN_SHAPE, size=ORIGIN_SHAPE,
+                 margin=32, low=0.1, high=0.9, tile_batch=8):
+        '''
+        :param coarse: model with predict_on_batch, taking (rows, cols, channel) `coarse_shape`
+        :param fine: model predicting the tiles, trained on crops at the fine_size scale; the coarse model when
+            None, which is only sensible if it was trained at that scale too. the tiles have its input size
+        :param fine_size: (width, height) of the image the tiles are cropped from
+        :param size: (width, height) of the returned probabilities
+        :param margin: pixels at each side of a tile whose prediction is dropped, as it lacks context
+        :param low: coarse probabilities in (low, high) are uncertain
+        :param tile_batch: tiles per fine forward call
+        '''
+        self.coarse = coarse
+        self.coarse_shape = tuple(coarse_shape)
+        self.fine = coarse if fine is None else fine
+        self.fine_shape = self.coarse_shape if fine_shape is None else tuple(fine_shape)
+        self.fine_size = fine_size
+        self.size = size
+        self.margin = margin
+        self.low = low
+        self.high = high
+        self.tile_batch = tile_batch
+        width, height = fine_size
+        self.load_size = (height, width, max(self.coarse_shape[2], self.fine_shape[2]))
+        self.rows = tile_grid(height, self.fine_shape[0], margin)
+        self.cols = tile_grid(width, self.fine_shape[1], margin)
+        self.stats = TimingStats()
+        self.tiles = 0
+        self.total_tiles = 0
+
+    @classmethod
+    def load(cls, coarse_path, fine_path, **kwargs):
+        '''
+        :param fine_path: checkpoint trained on crops at the fine_size scale (train.py --crop); a model trained on
+            whole cars downscaled to its input sees the tiles at another scale, and its outline is likely worse than
+            the upsampled coarse one
+        '''
+        from export import FrozenModel, load_keras_model
+
+        def load(path):
+            return FrozenModel(path) if path.endswith('.pb') else load_keras_model(path)
+        coarse = load(coarse_path)
+        if fine_path == coarse_path:
+            print("warning: {} refines its own outline; train a tile model with train.py --crop...".format(
+                coarse_path))
+            return cls(coarse, checkpoint_input_shape(coarse_path), **kwargs)
+        return cls(coarse, checkpoint_input_shape(coarse_path), load(fine_path), checkpoint_input_shape(fine_path),
+                   **kwargs)
+
+    def predict_on_batch(self, x):
+        '''
+        :param x: uint8 [n, rows, cols, channel] decoded at load_size
+        :return: float32 [n, height, width, 1] probabilities at `size`
+        '''
+        timings = {}
+        start = time.time()
+        height, width = self.load_size[:2]
+        coarse = self.coarse.predict_on_batch(fit_batch(x, self.coarse_shape))[..., -1]
+        start = add_time(timings, 'coarse', start)
+        prob = np.stack([cv2.resize(p.astype(np.float32), (width, height), interpolation=cv2.INTER_LINEAR)
+                         for p in coarse])
+        tiles = []
+        for i, p in enumerate(coarse):
+            selected = uncertain_tiles(uncertain_map(p, self.low, self.high), self.rows[1:], self.cols[1:],
+                                       (height, width))
+            tiles.extend((i, a, b) for a, b in zip(*np.nonzero(selected)))
+        self.tiles += len(tiles)
+        self.total_tiles += len(x) * len(self.rows[0]) * len(self.cols[0])
+        start = add_time(timings, 'select', start)
+
+        xf = fit_batch(x, (height, width, self.fine_shape[2]))
+        (ro, rs, re), (co, cs, ce) = self.rows, self.cols
+        th, tw = self.fine_shape[:2]
+        for k in range(0, len(tiles), self.tile_batch):
+            chunk = tiles[k:k + self.tile_batch]
+            crops = np.stack([xf[i, ro[a]:ro[a] + th, co[b]:co[b] + tw] for i, a, b in chunk])
+            pred = self.fine.predict_on_batch(crops)[..., -1]
+            for (i, a, b), q in zip(chunk, pred):
+                prob[i, rs[a]:re[a], cs[b]:ce[b]] = q[rs[a] - ro[a]:re[a] - ro[a], cs[b] - co[b]:ce[b] - co[b]]
+        start = add_time(timings, 'fine', start)
+        if self.size != self.fine_size:
+            prob = np.stack([cv2.resize(p, self.size, interpolation=cv2.INTER_LINEAR) for p in prob])
+            add_time(timings, 'resize', start)
+        self.stats.update(timings)
+        return prob[..., np.newaxis]
+
+    def to_dict(self):
+        return {'tiles': self.tiles, 'total_tiles': self.total_tiles,
+                'refined_fraction': self.tiles / float(self.total_tiles) if self.total_tiles else None,
+                'stats': self.stats.to_dict()}
@@ -0,0 +1,188 @@
+import os
+import sys
+import csv
+import time
+import argparse
+import subprocess
+import numpy as np
+from manifest import load_manifest
+
+HEADER = ['img', 'rle_mask']
+
+
+def shard_bounds(n, num_shards):
+    '''
+    :return: num_shards + 1 boundaries splitting range(n) into contiguous shards whose sizes differ by at most 1
+    '''
+    return [n * i // num_shards for i in range(num_shards + 1)]
+
+
+def shard_fns(fns, num_shards=1, shard_index=0):
+    '''
+    :param fns: file names; shards are contiguous slices of the sorted list, so shard i comes before shard i + 1
+    :return: the file names of shard `shard_index`
+    '''
+    if not 0 <= shard_index < num_shards:
+        raise ValueError("shard index {} out of range for {} shards".format(shard_index, num_shards))
+    fns = sorted(fns)
+    bounds = shard_bounds(len(fns), num_shards)
+    return fns[bounds[shard_index]:bounds[shard_index + 1]]
+
+
+def shard_path(submission, shard_index, num_shards):
+    '''
+    :return: path of the partial submission of a shard, e.g. submission-00003-of-00008.csv
+    '''
+    if num_shards == 1:
+        return submission
+    root, ext = os.path.splitext(submission)
+    return '{}-{:05d}-of-{:05d}{}'.format(root, shard_index, num_shards, ext)
+
+
+def submission_path(model, ensemble=None, refine=False, tiled=False):
+    '''
+    :return: the (merged) submission test.py writes for these arguments, named by the prediction mode and put
+        next to the model, or the first --ensemble model
+    '''
+    name = 'submission-ensemble.csv' if ensemble else 'submission-refined.csv' if refine else \
+        'submission-tiled.csv' if tiled else 'submission.csv'
+    return os.path.join(os.path.dirname(ensemble[0] if ensemble else model), name)
+
+
+def mode_args(test_args):
+    '''
+    :return: the arguments of test.py that choose the submission name (see submission_path), parsed from a
+        test.py command line
+    '''
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--ensemble', type=str, nargs='+', default=None)
+    parser.add_argument('--refine', action='store_true')
+    parser.add_argument('--tiled', action='store_true')
+    return vars(parser.parse_known_args(list(test_args))[0])
+
+
+def merge_shards(submission, num_shards, expected_fns=None):
+    '''
+    concatenate the partial submissions of all shards, in shard order, into `submission` after checking
+    that every shard is there and that no id is duplicated or (given expected_fns) missing or unexpected.
+    :return: number of rows written
+    '''
+    paths = [shard_path(submission, i, num_shards) for i in range(num_shards)]
+    missing_shards = [path for path in paths if not os.path.exists(path)]
+    if missing_shards:
+        raise ValueError("{} of {} shards missing, e.g. {}".format(len(missing_shards), num_shards, missing_shards[0]))
+    seen = set()
+    duplicates = []
+    tmp = '{}.tmp{}'.format(submission, os.getpid())
+    with open(tmp, 'w', newline='') as out:
+        writer = csv.writer(out)
+        writer.writerow(HEADER)
+        for path in paths:
+            with open(path, newline='') as f:
+                reader = csv.reader(f)
+                if next(reader, None) != HEADER:
+                    os.remove(tmp)
+                    raise ValueError("{} does not start with the header {}".format(path, ','.join(HEADER)))
+                for row in reader:
+                    fn = os.path.splitext(row[0])[0]
+                    if fn in seen:
+                        duplicates.append(fn)
+                    seen.add(fn)
+                    writer.writerow(row)
+    errors = []
+    if duplicates:
+        errors.append("{} duplicate ids, e.g. {}".format(len(duplicates), duplicates[0]))
+    if expected_fns is not None:
+        expected = set(expected_fns)
+        missing, unexpected = sorted(expected - seen), sorted(seen - expected)
+        if missing:
+            errors.append("{} ids missing, e.g. {}".format(len(missing), missing[0]))
+        if unexpected:
+            errors.append("{} unexpected ids, e.g. {}".format(len(unexpected), unexpected[0]))
+    if errors:
+        os.remove(tmp)
+        raise ValueError("shards of {} do not cover the test set: {}".format(submission, '; '.join(errors)))
+    os.replace(tmp, submission)
+    return len(seen)
+
+
+def core_sets(num_shards, cores=None):
+    '''
+    :return: disjoint lists of cpu ids, one per shard (shared round robin when there are fewer cores)
+    '''
+    cores = sorted(os.sched_getaffinity(0)) if cores is None and hasattr(os, 'sched_getaffinity') else \
+        list(range(cores or os.cpu_count()))
+    if len(cores) < num_shards:
+        return [[cores[i % len(cores)]] for i in range(num_shards)]
+    return [list(c) for c in np.array_split(cores, num_shards)]
+
+
+def launch(num_shards, model, imdir, test_args=(), force=False, script=None):
+    '''
+    run test.py once per shard as local worker processes, each pinned to its own share of the cores with
+    tensorflow and loader threads sized to it; shards whose partial submission already exists are skipped
+    unless force. the shards are merged once all of them succeed.
+    :param test_args: further test.py arguments; --ensemble, --refine and --tiled change the submission name
+    :param script: the script run per shard, test.py by default
+    :return: path of the merged submission
+    '''
+    script = script or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test.py')
+    submission = submission_path(model, **mode_args(test_args))
+    # refreshed once here instead of concurrently by every shard
+    expected_fns = load_manifest(imdir).fns
+    procs = {}
+    logs = {}
+    for i, cores in enumerate(core_sets(num_shards)):
+        if not force and os.path.exists(shard_path(submission, i, num_shards)):
+            print("shard {} already written, skipping...".format(i))
+            continue
+        cmd = [sys.executable, script, '--model', model, '--imdir', imdir, '--num_shards', str(num_shards),
+               '--shard_index', str(i), '--threads', str(len(cores)), '--workers', str(max(1, len(cores) // 2))]
+        env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)))
+        pin = None
+        if hasattr(os, 'sched_setaffinity'):
+            pin = lambda cores=cores: os.sched_setaffinity(0, cores)
+        logs[i] = open(shard_path(submission, i, num_shards) + '.log', 'w')
+        procs[i] = subprocess.Popen(cmd + list(test_args), env=env, preexec_fn=pin, stdout=logs[i],
+                                    stderr=subprocess.STDOUT)
+    now = time.time()
+    failed = []
+    for i, proc in sorted(procs.items()):
+        if proc.wait() != 0:
+            failed.append(i)
+        logs[i].close()
+        print("shard {} finished with exit code {} after {:.1f}s...".format(i, proc.returncode, time.time() - now))
+    if failed:
+        raise RuntimeError("shards {} failed, see their .log files; rerun to retry only those".format(failed))
+    n = merge_shards(submission, num_shards, expected_fns)
+    print("merged {} rows from {} shards into {}".format(n, num_shards, submission))
+    return submission
+
+
+def create_args():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    merge = sub.add_parser('merge', help="verify and concatenate the partial submissions")
+    merge.add_argument('--submission', type=str, required=True, help="merged file; shards are found next to it")
+    merge.add_argument('--num_shards', type=int, required=True)
+    merge.add_argument('--imdir', type=str, default=None, help="test images, to check that every id is covered")
+    run = sub.add_parser('launch', help="run all shards as local processes, then merge")
+    run.add_argument('--model', type=str, required=True)
+    run.add_argument('--imdir', type=str, required=True)
+    run.add_argument('--num_shards', type=int, default=2)
+    run.add_argument('--force', action='store_true', help="rerun shards that are already written")
+    args, rest = parser.parse_known_args()
+    if args.command == 'merge' and rest:
+        parser.error("unrecognized arguments: {}".format(' '.join(rest)))
+    return args, rest
+
+
+if __name__ == "__main__":
+    args, rest = create_args()
+    if args.command == 'merge':
+        expected = load_manifest(args.imdir).fns if args.imdir else None
+        n = merge_shards(args.submission, args.num_shards, expected)
+        print("merged {} rows from {} shards into {}".format(n, args.num_shards, args.submission))
+    else:
+        # unknown arguments (e.g. --stream --decode draft) are passed on to test.py
+        launch(args.num_shards, args.model, args.imdir, rest, args.force)
@@ -1,4 +1,5 @@
 import keras
+import json
 import argparse
 import time
 import tensorflow as tf
@@ -6,13 +7,76 @@ from math import ceil
 from keras.backend.tensorflow_backend import set_session
 from utils import *
 from config import *
+from loader import CarvanaSequence, Prefetcher, load_batch
+from inference import stream_predict
+from manifest import load_manifest
+from profiling import TimingStats
+from export import FrozenModel
+from shards import shard_fns, shard_path, submission_path
+from prediction_cache import PredictionCache
+from ensemble import Ensemble, checkpoint_input_shape, load_size
+from tta import TTAModel, TTA_TRANSFORMS, tta_latency
+from refine import CoarseToFine
+from tiling import TiledPredictor
+from autotune import apply_profile
 
 
 def create_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--gpu', type=float, default=1)
     parser.add_argument('--gpus', type=str, default='cpu')
-    return parser.parse_args()
+    parser.add_argument('--workers', type=int, default=None,
+                        help="data loader processes; 0 loads in-process (default: autotune profile, else {})".format(
+                            WORKERS))
+    parser.add_argument('--queue_depth', type=int, default=None,
+                        help="batches prefetched by the loader (default: autotune profile, else {})".format(
+                            QUEUE_DEPTH))
+    parser.add_argument('--batch_size', type=int, default=None,
+                        help="images per batch (default: autotune profile, else {})".format(BATCH_SIZE))
+    parser.add_argument('--decode', type=str, default=None, choices=DECODE_BACKENDS,
+                        help="jpeg decoder; 'draft'/'cv2' decode at reduced dct scale (default: autotune profile, "
+                             "else {})".format(DECODE_BACKEND))
+    parser.add_argument('--stream', action='store_true',
+                        help="predict, upsample, encode and write batch by batch with bounded memory")
+    parser.add_argument('--imdir', type=str, default=img_dir, help="test images")
+    parser.add_argument('--model', type=str, default=None,
+                        help="checkpoint (.hdf5) or frozen graph (.pb) to predict with; asks interactively if not "
+                             "given")
+    parser.add_argument('--ensemble', type=str, nargs='+', default=None,
+                        help="checkpoints/frozen graphs whose probabilities are averaged at the original resolution "
+                             "in one streaming pass; they may differ in input size")
+    parser.add_argument('--ensemble_weights', type=float, nargs='+', default=None,
+                        help="relative weight of every --ensemble model (default: equal)")
+    parser.add_argument('--num_shards', type=int, default=1, help="split the sorted test images into this many shards")
+    parser.add_argument('--shard_index', type=int, default=0, help="shard predicted by this process")
+    parser.add_argument('--threads', type=int, default=0, help="tensorflow intra/inter op threads; 0 lets it pick")
+    parser.add_argument('--refine', action='store_true',
+                        help="coarse-to-fine: predict at the model size, then re-predict only the tiles on the car "
+                             "outline from the --refine_size image with --refine_model")
+    parser.add_argument('--refine_model', type=str, default=None,
+                        help="checkpoint trained on crops at the --refine_size scale (train.py --crop), predicting "
+                             "the outline tiles; its input size is the tile size. required with --refine")
+    parser.add_argument('--refine_size', type=int, nargs=2, default=list(ORIGIN_SHAPE),
+                        help="width height of the image the tiles are cropped from")
+    parser.add_argument('--refine_band', type=float, nargs=2, default=[0.1, 0.9],
+                        help="coarse probabilities in this range are refined, besides the outline")
+    parser.add_argument('--refine_margin', type=int, default=32, help="tile border pixels not kept")
+    parser.add_argument('--tiled', action='store_true',
+                        help="predict the full resolution images with overlapping tiles of the model input size")
+    parser.add_argument('--tile_overlap', type=int, default=64, help="minimum overlap of neighbouring tiles")
+    parser.add_argument('--tile_batch', type=int, default=16,
+                        help="tiles per forward call; bounds the memory of the model whatever the image size")
+    parser.add_argument('--tta', type=str, nargs='+', default=None, choices=sorted(TTA_TRANSFORMS),
+                        help="test-time augmentation: the transformed copies of every batch are predicted in one "
+                             "forward call and averaged, e.g. --tta identity hflip")
+    parser.add_argument('--pred_cache', type=str, default='',
+                        help="prediction cache directory, e.g. cache/predictions; off by default")
+    parser.add_argument('--pred_cache_gb', type=float, default=20., help="size bound of the prediction cache")
+    args = parser.parse_args()
+    # a model trained on whole downscaled cars does not know the scale of the tiles: its edges would be worse
+    if args.refine and not args.refine_model:
+        parser.error("--refine needs --refine_model, a checkpoint trained on crops at the --refine_size scale")
+    return args
 
 on_amax = True
 debug_mode = False
@@ -21,22 +85,9 @@ img_dir = os.path.join(os.path.expanduser('~'), 'school/data science/kaggle/carv
 
 if on_amax:
     img_dir = '/home/harry/data/carvana/test'
-total_fns = [os.path.splitext(os.path.basename(x))[0] for x in glob.glob(os.path.join(img_dir, '*.jpg'))]
-fn_dict = {fn: [os.path.join(img_dir, fn + '.jpg')] for fn in total_fns}
 
-steps = ceil(len(total_fns)/BATCH_SIZE)
-if debug_mode:
-    steps = 50
-
-
-if __name__ == "__main__":
-    args = create_args()
-    # configure gpu
-    config = tf.ConfigProto()
-    config.gpu_options.per_process_gpu_memory_fraction = args.gpu
-    config.gpu_options.visible_device_list = args.gpus
-    set_session(tf.Session(config=config))
 
+def choose_model():
     print("choose from...")
     models = glob.glob('experiment/model*')
     for i,model in enumerate(models):
@@ -44,56 +95,189 @@ if __name__ == "__main__":
     i = int(input("choose pred model: "))
     print("selected {}...displaying details...".format(models[i]))
 
-    submodels = glob.glob(os.path.join(models[i], '*.hdf5'))
+    # frozen graphs written by export.py are listed next to the keras checkpoints
+    submodels = glob.glob(os.path.join(models[i], '*.hdf5')) + glob.glob(os.path.join(models[i], '*.pb'))
     for j, submodel in enumerate(submodels):
         print("{}-{}".format(j, submodel))
     i1 = int(input("choose pred model: "))
     if i1 in list(range(len(submodels))):
-        submodel = submodels[i1]
-    else:
-        submodel = os.path.join(models[i], 'best_model.hdf5')
-
-    model = keras.models.load_model(submodel, custom_objects={'dice_coef':dice_coef, 'bce_dc_loss':bce_dc_loss})
-    print("model loaded for {}...".format(submodel))
-
-    test_gen = DataIterator(fns=total_fns, fn_dict=fn_dict, target_size=TARGET_SIZE, test=True, batch_size=BATCH_SIZE)
-    # test_gen = DataGenerator(fns=total_fns, fn_dict=fn_dict, target_size=TARGET_SIZE, test=True, batch_size=BATCH_SIZE)
-    # test_gen = data_gen(total_fns, fn_dict, target_size=TARGET_SIZE, test=True, batch_size=BATCH_SIZE)
-
-    print("predicting...")
-    now = time.time()
-    pred = model.predict_generator(test_gen, steps=steps, verbose=1, workers=3)
+        return submodels[i1]
+    return os.path.join(models[i], 'best_model.hdf5')
 
-    # print("DEBUG: ", type(pred))
-    # print("DEBUG: ", np.max(pred.flatten()))
-    # print("DEBUG: ", np.min(pred.flatten()))
-    # print("DEBUG: ", pred.shape)
 
-    print("DEBUG: prediction takes %2f to proceed..." % (time.time()-now))
-
-    out = []
-    # for i, a1 in enumerate(pred):
-    #     out.append(rle_encode(a1))
-    #     if i % 1000 == 0:
-    #         print("{} images processed...".format(i))
+if __name__ == "__main__":
+    args = create_args()
+    # this process predicts one contiguous slice of the sorted test images
+    manifest = load_manifest(args.imdir)
+    total_fns = shard_fns(manifest.fns, args.num_shards, args.shard_index)
+    fn_dict = manifest.fn_dict(total_fns)
 
-    # use multiprocessing for the list of images
-    pool = ThreadPool(6)
-    now = time.time()
-    out = pool.map(resize_mask_matrix_encode, list(pred))
-    pool.close()
-    pool.join()
-    print("DEBUG: conversion takes %2f to proceed..." % (time.time() - now))
+    # an ensemble decodes every batch once, at the largest input size of its models, and always streams
+    input_shape = TARGET_SIZE + (1,)
+    if args.ensemble:
+        submodel = args.ensemble[0]
+        input_shape = load_size([checkpoint_input_shape(path) for path in args.ensemble])
+        args.stream = True
+    elif args.model:
+        submodel = args.model
+    else:
+        submodel = choose_model()
+    # refinement decodes at the fine resolution; the coarse input is resized from it
+    if args.refine:
+        if args.ensemble:
+            raise ValueError("--refine and --ensemble cannot be combined")
+        channel = max(checkpoint_input_shape(path)[2] for path in [submodel, args.refine_model])
+        input_shape = (args.refine_size[1], args.refine_size[0], channel)
+        args.stream = True
+    if args.tiled:
+        if args.ensemble or args.refine:
+            raise ValueError("--tiled cannot be combined with --ensemble or --refine")
+        input_shape = (ORIGIN_SHAPE[1], ORIGIN_SHAPE[0], checkpoint_input_shape(submodel)[2])
+        args.stream = True
+    # batch size and loader settings not given come from `python autotune.py --mode test` run on this host
+    apply_profile(args, 'test', input_shape, {'batch_size': BATCH_SIZE, 'workers': WORKERS,
+                                              'queue_depth': QUEUE_DEPTH, 'decode': DECODE_BACKEND},
+                  stream=args.stream)
 
-    out = list(zip(total_fns, out))
-    out = pd.DataFrame(out)
-    out.columns = ['img', 'rle_mask']
-    out.to_csv(os.path.join(os.path.dirname(submodel), 'submission.csv'), index=False)
-    print("successfully written to {}".format(os.path.join(os.path.dirname(submodel), 'submission.csv')))
+    # only images without a cached prediction of this checkpoint are loaded and predicted
+    pred_cache = None
+    cached_fns, predict_fns = [], total_fns
+    if args.pred_cache and not (args.ensemble or args.refine or args.tiled):
+        # keyed by the input size of the checkpoint, so models of different sizes never share entries
+        pred_cache = PredictionCache(args.pred_cache, submodel, checkpoint_input_shape(submodel)[:2], args.decode,
+                                     max_bytes=int(args.pred_cache_gb * 2 ** 30),
+                                     variant='tta=' + ','.join(args.tta) if args.tta else '')
+        cached_fns, predict_fns = pred_cache.split(total_fns, fn_dict)
+        print("{} of {} predictions cached...".format(len(cached_fns), len(total_fns)))
+    steps = ceil(len(predict_fns)/args.batch_size)
+    if debug_mode:
+        steps = 50
 
+    # loader processes are forked before the tensorflow session exists
+    test_seq = CarvanaSequence(predict_fns, fn_dict, target_size=input_shape[:2], grayscale=input_shape[2] == 1,
+                               test=True, batch_size=args.batch_size, decode=args.decode)
+    # batches are views into the prefetcher's uint8 ring and must outlive the queues downstream of it
+    max_queue_size = 2
+    hold = args.queue_depth + 2 if args.stream else max_queue_size + 2
+    test_gen = Prefetcher(test_seq, workers=args.workers, queue_depth=args.queue_depth, hold=hold)
 
+    # configure gpu
+    config = tf.ConfigProto()
+    config.gpu_options.per_process_gpu_memory_fraction = args.gpu
+    config.gpu_options.visible_device_list = args.gpus
+    if args.threads:
+        config.intra_op_parallelism_threads = args.threads
+        config.inter_op_parallelism_threads = args.threads
+    set_session(tf.Session(config=config))
 
+    if args.ensemble:
+        model = Ensemble.load(args.ensemble, args.ensemble_weights)
+    elif args.refine:
+        model = CoarseToFine.load(submodel, args.refine_model, fine_size=tuple(args.refine_size),
+                                  margin=args.refine_margin, low=args.refine_band[0], high=args.refine_band[1])
+    elif args.tiled:
+        model = TiledPredictor.load(submodel, overlap=args.tile_overlap, tile_batch=args.tile_batch)
+    elif submodel.endswith('.pb'):
+        model = FrozenModel(submodel)
+    else:
+        model = keras.models.load_model(submodel, custom_objects={'dice_coef':dice_coef, 'bce_dc_loss':bce_dc_loss})
+    print("model loaded for {}...".format(submodel))
+    base_model = model
+    tta_report = None
+    if args.tta:
+        # latency per image with and without tta, measured on the first batches before the run
+        if len(test_seq):
+            x = np.concatenate([test_seq.get_batch(i) for i in range(min(4, len(test_seq)))])
+            tta_report = tta_latency(model, x, args.tta, args.batch_size)
+            print("tta {}: {:.1f}ms/image vs {:.1f}ms/image without ({:.2f}x)...".format(
+                '+'.join(args.tta), tta_report['tta'] * 1e3, tta_report['plain'] * 1e3, tta_report['ratio']))
+        model = TTAModel(model, args.tta)
 
+    # every shard writes its own partial submission, renamed into place once complete
+    submission = shard_path(submission_path(submodel, args.ensemble, args.refine, args.tiled), args.shard_index,
+                            args.num_shards)
+    partial = submission + '.partial'
+    print("predicting {} images...".format(len(total_fns)))
+    profile = TimingStats()
+    now = time.time()
+    if args.stream:
+        stats = stream_predict(model, test_seq, test_gen, partial, steps=steps, queue_depth=args.queue_depth,
+                               cache=pred_cache, cached_fns=cached_fns)
+        test_gen.close()
+        profile.add('total', time.time() - now)
+        for stage in stats:
+            print(stage.report())
+    else:
+        # hits are read and encoded in chunks before entries for the misses can evict them
+        rles = {}
+        lost = []
+        for i in range(0, len(cached_fns), 64):
+            chunk, pred = pred_cache.get(cached_fns[i:i + 64])
+            rles.update(zip(chunk, resize_mask_matrix_encode_batch(pred)))
+            lost.extend(fn for fn in cached_fns[i:i + 64] if fn not in rles)
+        profile.add('cached', time.time() - now)
 
+        now = time.time()
+        if steps > 0:
+            pred = model.predict_generator(test_gen, steps=steps, verbose=1, workers=1, max_queue_size=max_queue_size)
+            profile.add('predict', time.time() - now)
+            if pred_cache is not None:
+                now = time.time()
+                pred_cache.put(predict_fns, pred)
+                profile.add('cache_put', time.time() - now)
 
+            # resize and encode in vectorized chunks instead of one image at a time
+            now = time.time()
+            rles.update(zip(predict_fns, resize_mask_matrix_encode_batch(pred)))
+            profile.add('encode', time.time() - now)
+        test_gen.close()
+        # hits another shard evicted before they were read are predicted after all
+        now = time.time()
+        for i in range(0, len(lost), args.batch_size):
+            chunk = lost[i:i + args.batch_size]
+            pred = model.predict(load_batch(chunk, fn_dict, input_shape[:2], input_shape[2] == 1, test=True,
+                                            decode=args.decode), batch_size=args.batch_size)
+            pred_cache.put(chunk, pred)
+            rles.update(zip(chunk, resize_mask_matrix_encode_batch(pred)))
+        if lost:
+            profile.add('lost', time.time() - now)
 
+        now = time.time()
+        out = [(fn, rles[fn]) for fn in total_fns if fn in rles]
+        out = pd.DataFrame(out)
+        out.columns = ['img', 'rle_mask']
+        out.to_csv(partial, index=False)
+        profile.add('write', time.time() - now)
+    for line in profile.report():
+        print("test   " + line)
+    for line in test_gen.stats.report():
+        print("loader " + line)
+    result = {'test': profile.to_dict(), 'loader': test_gen.stats.to_dict()}
+    if args.ensemble:
+        for line in base_model.stats.report():
+            print("ensemble " + line)
+        result['ensemble'] = {'models': args.ensemble, 'weights': base_model.weights.tolist(),
+                              'stats': base_model.stats.to_dict()}
+    if args.refine:
+        report = base_model.to_dict()
+        print("refined {} of {} tiles ({:.1%})...".format(report['tiles'], report['total_tiles'],
+                                                         report['refined_fraction'] or 0.))
+        for line in base_model.stats.report():
+            print("refine " + line)
+        result['refine'] = report
+    if args.tiled:
+        print("{} tiles per image...".format(len(base_model.origins)))
+        for line in base_model.stats.report():
+            print("tiled  " + line)
+        result['tiled'] = base_model.to_dict()
+    if args.tta:
+        for line in model.stats.report():
+            print("tta    " + line)
+        result['tta'] = {'latency': tta_report, 'stats': model.stats.to_dict()}
+    if pred_cache is not None:
+        print(pred_cache.report())
+        result['prediction_cache'] = pred_cache.to_dict()
+    with open(os.path.splitext(submission)[0] + '-profile.json', 'w') as f:
+        json.dump(result, f, indent=1)
+    os.replace(partial, submission)
+    print("successfully written to {}".format(submission))
@@ -0,0 +1,67 @@
+import os
+import pytest
+import numpy as np
+from benchmark import car_masks as make_car_masks, write_car
+
+
+def make_dataset(root, n=5, shape=(96, 64)):
+    '''
+    :param shape: (width, height) of the synthetic images
+    :return: {'fn':['path/to/img', 'path/to/mask']} for n benchmark.write_car samples, named like carvana
+        `<car>_<NN>`
+    '''
+    os.makedirs(os.path.join(root, 'train'))
+    os.makedirs(os.path.join(root, 'train_masks'))
+    rng = np.random.RandomState(0)
+    fn_dict = {}
+    for i in range(n):
+        fn = 'car{:02d}_{:02d}'.format(i // 2, i % 2 + 1)
+        img_path = os.path.join(root, 'train', fn + '.jpg')
+        mask_path = os.path.join(root, 'train_masks', fn + '_mask.gif')
+        write_car(rng, img_path, mask_path, shape)
+        fn_dict[fn] = [img_path, mask_path]
+    return fn_dict
+
+
+class Scaled(object):
+    '''
+    "predicts" its input scaled to [0, 1], remembering the batch shapes
+    '''
+    def __init__(self):
+        self.shapes = []
+
+    def predict_on_batch(self, x):
+        self.shapes.append(x.shape)
+        return x[..., :1] / 255.
+
+
+@pytest.fixture
+def fn_dict(tmpdir):
+    return make_dataset(str(tmpdir))
+
+
+@pytest.fixture
+def car_masks():
+    '''
+    benchmark.car_masks(n, shape=(width, height), seed=0)
+    '''
+    return make_car_masks
+
+
+@pytest.fixture
+def car_jpeg():
+    '''
+    car_jpeg(path, shape=(width, height), seed=0) writes a benchmark.write_car image and returns its path
+    '''
+    def write(path, shape=(1918, 1280), seed=0):
+        write_car(np.random.RandomState(seed), path, shape=shape)
+        return path
+    return write
+
+
+@pytest.fixture
+def scaled():
+    '''
+    a new Scaled model per call
+    '''
+    return Scaled
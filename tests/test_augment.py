@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from augment import augment_batch, augment_rng, crop_origins
+from loader import CarvanaSequence, Prefetcher
+
+NO_AUG = dict(flip=0., rotate=0., scale=(1., 1.), shift=0., shear=0., brightness=0., contrast=0.)
+
+
+def boxes(n=4, shape=(40, 56)):
+    y = np.zeros((n,) + shape + (1,), dtype=np.uint8)
+    for i in range(n):
+        y[i, 5 + i:25, 10:40 - i] = 1
+    return y * 255, y.copy()
+
+
+def test_identity_and_flip():
+    x, y = boxes()
+    x0, y0 = x.copy(), y.copy()
+    augment_batch(x, y, augment_rng(1, 0, 0), **NO_AUG)
+    assert np.array_equal(x, x0) and np.array_equal(y, y0)
+    augment_batch(x, y, augment_rng(1, 0, 0), **dict(NO_AUG, flip=1.))
+    assert np.array_equal(x, x0[:, :, ::-1]) and np.array_equal(y, y0[:, :, ::-1])
+
+
+def test_image_and_mask_move_together():
+    x, y = boxes()
+    augment_batch(x, y, augment_rng(1, 0, 0), rotate=10., scale=(0.8, 1.2), shift=0.1, brightness=0., contrast=0.)
+    assert set(np.unique(y)) <= {0, 1} and x.dtype == np.uint8
+    assert ((x > 127) == (y > 0)).mean() > 0.97
+    _, y0 = boxes()
+    assert not np.array_equal(y, y0)
+
+
+def test_augmentation_is_seeded_by_epoch_and_batch(fn_dict):
+    seq = CarvanaSequence(sorted(fn_dict), fn_dict, target_size=(32, 48), batch_size=2, shuffle=True,
+                          data_aug=True)
+    plain = CarvanaSequence(sorted(fn_dict), fn_dict, target_size=(32, 48), batch_size=2, shuffle=True)
+    with Prefetcher(seq, workers=0) as serial, Prefetcher(seq, workers=2, queue_depth=3) as parallel:
+        for step in range(2 * len(seq)):
+            (x0, y0), (x1, y1) = next(serial), next(parallel)
+            assert np.array_equal(x0, x1) and np.array_equal(y0, y1)
+            x2, y2 = seq.get_batch(step % len(seq), epoch=step // len(seq))
+            assert np.array_equal(x0, x2) and np.array_equal(y0, y2)
+    assert not np.array_equal(seq.get_batch(0, 0)[0], plain.get_batch(0, 0)[0])
+    assert 'augment' in parallel.stats.histograms
+
+
+def test_crop_origins_fit_and_follow_the_outline():
+    y = np.zeros((50, 40, 60, 1), dtype=np.uint8)
+    y[:, 10:30, 20:45] = 1
+    origins = crop_origins(np.random.RandomState(0), len(y), (40, 60), (16, 16), y, outline=1.)
+    assert origins.shape == (50, 2) and (origins >= 0).all() and (origins <= [40 - 16, 60 - 16]).all()
+    # every window holds car and background
+    for (r, c), mask in zip(origins, y):
+        window = mask[r:r + 16, c:c + 16]
+        assert 0 < window.sum() < window.size
+    uniform = crop_origins(np.random.RandomState(0), 50, (40, 60), (16, 16))
+    assert len(set(map(tuple, uniform))) > 10
+    with pytest.raises(ValueError):
+        crop_origins(np.random.RandomState(0), 1, (40, 60), (48, 16))
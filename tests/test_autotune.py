@@ -0,0 +1,60 @@
+import argparse
+from autotune import (save_profile, load_profile, apply_profile, worker_counts, loader_hold, loader_bytes,
+                      choose_batch_size, choose_loader)
+
+
+def test_profile_roundtrip(tmpdir):
+    path = str(tmpdir.join('autotune', 'host.json'))
+    assert load_profile('train', (256, 256, 1), path) is None
+    save_profile({'batch_size': 8, 'workers': 6}, 'train', (256, 256, 1), path)
+    save_profile({'batch_size': 16}, 'test', (256, 256, 1), path)
+    assert load_profile('train', (256, 256, 1), path) == {'batch_size': 8, 'workers': 6}
+    assert load_profile('test', (256, 256, 1), path) == {'batch_size': 16}
+    assert load_profile('train', (512, 512, 1), path) is None
+    # streamed runs hold more batches in the ring and are tuned separately
+    assert load_profile('test', (256, 256, 1), path, stream=True) is None
+    save_profile({'batch_size': 4}, 'test', (256, 256, 1), path, stream=True)
+    assert load_profile('test', (256, 256, 1), path, stream=True) == {'batch_size': 4}
+    assert load_profile('test', (256, 256, 1), path) == {'batch_size': 16}
+
+
+def test_apply_profile_keeps_given_arguments(tmpdir):
+    path = str(tmpdir.join('host.json'))
+    save_profile({'batch_size': 8, 'workers': 6}, 'train', (256, 256, 1), path)
+    defaults = {'batch_size': 2, 'workers': 4, 'queue_depth': 8}
+    args = argparse.Namespace(batch_size=None, workers=3, queue_depth=None)
+    assert apply_profile(args, 'train', (256, 256, 1), defaults, path) is not None
+    # the profile fills what was not given, config what it does not hold
+    assert (args.batch_size, args.workers, args.queue_depth) == (8, 3, 8)
+    args = argparse.Namespace(batch_size=None, workers=None, queue_depth=None)
+    assert apply_profile(args, 'train', (128, 128, 1), defaults, path) is None
+    assert (args.batch_size, args.workers, args.queue_depth) == (2, 4, 8)
+
+
+def test_worker_counts_and_ring_bytes():
+    assert worker_counts(1) == [1]
+    assert worker_counts(8) == [1, 2, 4, 8]
+    assert worker_counts(12) == [1, 2, 4, 8, 12]
+    assert loader_bytes((4, 5, 1), 2, queue_depth=3, hold=1, masks=True) == 4 * 2 * 4 * 5 * 2
+    assert loader_bytes((4, 5, 3), 2, queue_depth=3, hold=1, masks=False) == 4 * 2 * 4 * 5 * 3
+    # keras' queue of 2 plus the batch in use, unless test.py streams
+    assert loader_hold(8) == 4 and loader_hold(8, stream=True) == 10
+
+
+def test_choose_batch_size():
+    trials = [{'batch_size': 1, 'images_per_sec': 10.}, {'batch_size': 2, 'images_per_sec': 19.},
+              {'batch_size': 4, 'images_per_sec': 20.}, {'batch_size': 8, 'images_per_sec': 19.5}]
+    assert choose_batch_size(trials) == 2
+
+
+def test_choose_loader():
+    def trial(workers, depth, rate, decode='keras'):
+        return {'workers': workers, 'queue_depth': depth, 'images_per_sec': rate, 'decode': decode}
+    trials = [trial(1, 2, 20.), trial(1, 4, 22.), trial(2, 2, 40.), trial(2, 4, 44.), trial(4, 2, 80.),
+              trial(4, 4, 81.), trial(1, 2, 30., 'draft'), trial(2, 2, 60., 'draft')]
+    # as fast as it gets without a model to feed
+    assert choose_loader(trials) == trial(4, 2, 80.)
+    # enough to keep a 30 images/sec model busy with 25% headroom
+    assert choose_loader(trials, model_rate=30.) == trial(2, 2, 40.)
+    # the second decoder only wins when it needs fewer workers
+    assert choose_loader(trials, model_rate=20.) == trial(1, 2, 30., 'draft')
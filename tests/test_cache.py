@@ -0,0 +1,51 @@
+import os
+import pytest
+import numpy as np
+import pandas as pd
+from PIL import Image
+from utils import rle_encode_batch
+from cache import build_cache
+from masks import RLEMaskSource
+
+
+def test_build_cache(tmpdir, fn_dict):
+    fns = sorted(fn_dict)
+    cache = build_cache(fns, fn_dict, (32, 48), grayscale=True, cache_dir=str(tmpdir.join('cache')), shard_size=2)
+    x, y = cache.get_batch([fns[4], fns[0], fns[1]])
+    assert x.shape == (3, 32, 48, 1) and x.dtype == np.uint8
+    assert y.shape == (3, 32, 48, 1) and set(np.unique(y)) <= {0, 1}
+    mask = np.array(Image.open(fn_dict[fns[0]][1]).convert('L').resize((48, 32), Image.NEAREST)) > 127
+    assert np.array_equal(y[1, :, :, 0], mask)
+    # a contiguous run inside one shard is served as a memmap view
+    assert isinstance(cache.get_images(fns[2:4]), np.memmap)
+
+
+def test_cache_rebuilds_on_change(tmpdir, fn_dict):
+    fns = sorted(fn_dict)
+    cache_dir = str(tmpdir.join('cache'))
+    first = build_cache(fns, fn_dict, (32, 48), cache_dir=cache_dir)
+    assert build_cache(fns, fn_dict, (32, 48), cache_dir=cache_dir).index['fingerprint'] == first.index['fingerprint']
+    os.utime(fn_dict[fns[0]][0], (1, 1))
+    assert build_cache(fns, fn_dict, (32, 48), cache_dir=cache_dir).index['fingerprint'] != first.index['fingerprint']
+    assert build_cache(fns, fn_dict, (16, 24), cache_dir=cache_dir).target_size == (16, 24)
+
+
+def test_cache_follows_the_mask_source(tmpdir, fn_dict):
+    fns = sorted(fn_dict)
+    cache_dir = str(tmpdir.join('cache'))
+    # the csv masks are the gifs flipped left to right, so the two sources can be told apart
+    flipped = np.stack([np.array(Image.open(fn_dict[fn][1]).convert('L'))[:, ::-1] > 127 for fn in fns])
+    csv_path = str(tmpdir.join('train_masks.csv'))
+    data = pd.DataFrame({'img': [fn + '.jpg' for fn in fns], 'rle_mask': rle_encode_batch(flipped)})
+    data.to_csv(csv_path, index=False)
+    source = RLEMaskSource(csv_path, shape=(96, 64))
+    gif = build_cache(fns, fn_dict, (32, 48), cache_dir=cache_dir)
+    rle = build_cache(fns, fn_dict, (32, 48), cache_dir=cache_dir, mask_source=source)
+    assert rle.path != gif.path and rle.index['fingerprint'] != gif.index['fingerprint']
+    assert np.array_equal(rle.get_masks(fns)[:, :, :, 0], np.stack([source.get(fn, (32, 48)) > 127 for fn in fns]))
+    assert not np.array_equal(rle.get_masks(fns), gif.get_masks(fns))
+    # another decode backend or file list gets its own directory
+    assert build_cache(fns, fn_dict, (32, 48), cache_dir=cache_dir, decode='draft').path != gif.path
+    assert build_cache(fns[1:], fn_dict, (32, 48), cache_dir=cache_dir).path != gif.path
+    with pytest.raises(ValueError):
+        build_cache(fns, fn_dict, (32, 48), cache_dir=cache_dir, mask_source=source, mask_sampling='area')
@@ -0,0 +1,90 @@
+import os
+import h5py
+import pytest
+import numpy as np
+from utils import AsyncModelCheckpoint, write_checkpoint, checkpoint_layout_supported
+
+
+def text(names):
+    return [n.decode('utf8') if isinstance(n, bytes) else n for n in names]
+
+
+def weights_snapshot(value):
+    layers = [('conv', ['conv/kernel:0', 'conv/bias:0'], [np.full((3, 3, 1, 2), value, 'float32'),
+                                                          np.zeros(2, 'float32')]),
+              ('pool', [], [])]
+    return {'model_config': None, 'training_config': None, 'optimizer_weights': None, 'layers': layers}
+
+
+def test_write_checkpoint_uses_keras_weights_layout(tmpdir):
+    path = str(tmpdir.join('weights.hdf5'))
+    write_checkpoint(path, weights_snapshot(1.5))
+    assert os.listdir(str(tmpdir)) == ['weights.hdf5']
+    with h5py.File(path, 'r') as f:
+        assert text(f.attrs['layer_names']) == ['conv', 'pool']
+        names = text(f['conv'].attrs['weight_names'])
+        assert names == ['conv/kernel:0', 'conv/bias:0']
+        assert np.all(f['conv'][names[0]][()] == 1.5)
+
+
+class Layer(object):
+    def __init__(self, name):
+        self.name = name
+        self.weights = []
+
+
+class Model(object):
+    '''
+    weightless model; the name of its layer tells the checkpoints apart
+    '''
+    def __init__(self):
+        self.layers = [Layer('start')]
+
+
+def test_checkpoint_layout_supported():
+    assert checkpoint_layout_supported('2.0.9') and checkpoint_layout_supported('2.2.4')
+    assert not checkpoint_layout_supported('3.0.0') and not checkpoint_layout_supported('2.10.0')
+
+
+def test_retention_keeps_best_and_last(tmpdir):
+    checkpointer = AsyncModelCheckpoint(str(tmpdir.join('epoch-{epoch:02d}.hdf5')), monitor='val_dice_coef',
+                                        mode='max', save_weights_only=True, keep_best=2, keep_last=1,
+                                        best_filepath=str(tmpdir.join('best_model.hdf5')))
+    model = Model()
+    checkpointer.set_model(model)
+    checkpointer.on_train_begin()
+    scores = [0.5, 0.9, 0.7, 0.8, 0.6]
+    for epoch, score in enumerate(scores):
+        model.layers[0].name = 'epoch{}'.format(epoch + 1)
+        logs = {'val_dice_coef': score}
+        checkpointer.on_epoch_end(epoch, logs)
+        assert logs['checkpoint_stall'] >= 0
+    checkpointer.close()
+    assert sorted(os.listdir(str(tmpdir))) == ['best_model.hdf5', 'epoch-02.hdf5', 'epoch-04.hdf5',
+                                               'epoch-05.hdf5']
+    with h5py.File(str(tmpdir.join('best_model.hdf5')), 'r') as f:
+        assert text(f.attrs['layer_names']) == ['epoch2']
+
+
+def test_checkpoint_loads_in_keras(tmpdir):
+    pytest.importorskip('keras.engine')
+    from keras import backend as K
+    from keras.models import load_model
+    from models import SimpleCNN
+    K.clear_session()
+    model = SimpleCNN((16, 24, 1))
+    model.compile('adam', loss='binary_crossentropy')
+    x = np.random.RandomState(0).randint(0, 256, (2,) + model.input_shape[1:]).astype(np.uint8)
+    # one step, so there is optimizer state to save
+    model.train_on_batch(x, np.ones((2,) + model.output_shape[1:], dtype=np.float32))
+    path = str(tmpdir.join('model.hdf5'))
+    checkpointer = AsyncModelCheckpoint(path)
+    checkpointer.set_model(model)
+    checkpointer.on_train_begin()
+    checkpointer.on_epoch_end(0, {'val_loss': 1.})
+    checkpointer.close()
+    loaded = load_model(path)
+    assert loaded.get_config() == model.get_config()
+    for a, b in zip(loaded.get_weights() + loaded.optimizer.get_weights(),
+                    model.get_weights() + model.optimizer.get_weights()):
+        assert np.array_equal(a, b)
@@ -0,0 +1,57 @@
+import os
+import time
+import pytest
+import numpy as np
+from utils import load_image, DECODE_BACKENDS, _reduced_scale
+from benchmark import write_car
+
+
+def test_reduced_scale():
+    assert _reduced_scale((1918, 1280), (256, 256)) == 4
+    assert _reduced_scale((1918, 1280), (128, 128)) == 8
+    assert _reduced_scale((1918, 1280), (512, 512)) == 2
+    assert _reduced_scale((1918, 1280), (1024, 1024)) == 1
+
+
+def test_backends_agree(tmpdir, car_jpeg):
+    path = car_jpeg(str(tmpdir.join('car_01.jpg')))
+    for grayscale in [True, False]:
+        reference = load_image(path, (256, 256), grayscale, 'keras').astype('float32')
+        for backend in DECODE_BACKENDS:
+            img = load_image(path, (256, 256), grayscale, backend)
+            assert img.shape == (256, 256, 1 if grayscale else 3) and img.dtype == np.uint8
+            # scaled dct decoding only differs from the full decode by resampling the texture, which 8x8
+            # block means average out
+            diff = (img - reference).reshape(32, 8, 32, 8, -1).mean(axis=(1, 3))
+            assert np.abs(diff).mean() < 2
+
+
+def test_unreadable_images_raise(tmpdir, car_jpeg):
+    missing = str(tmpdir.join('missing_01.jpg'))
+    corrupt = str(tmpdir.join('corrupt_01.jpg'))
+    with open(car_jpeg(corrupt), 'rb') as f:
+        head = f.read(200)
+    with open(corrupt, 'wb') as f:
+        f.write(head)
+    for backend in DECODE_BACKENDS:
+        with pytest.raises(IOError, match='missing_01'):
+            load_image(missing, (256, 256), True, backend)
+        with pytest.raises(IOError):
+            load_image(corrupt, (256, 256), True, backend)
+    with pytest.raises(IOError, match='corrupt_01'):
+        load_image(corrupt, (256, 256), True, 'cv2')
+
+
+def benchmark(n=20, target_size=(256, 256), root='/tmp'):
+    path = os.path.join(root, 'benchmark_car_01.jpg')
+    write_car(np.random.RandomState(0), path)
+    for grayscale in [True, False]:
+        for backend in DECODE_BACKENDS:
+            now = time.time()
+            for _ in range(n):
+                load_image(path, target_size, grayscale, backend)
+            print("%-5s grayscale=%-5s %.1f images/sec/core" % (backend, grayscale, n / (time.time() - now)))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,54 @@
+import os
+import json
+import h5py
+import numpy as np
+from ensemble import Ensemble, checkpoint_input_shape, fit_batch, load_size
+
+
+class Constant(object):
+    def __init__(self, value):
+        self.value = value
+        self.shapes = []
+
+    def predict_on_batch(self, x):
+        self.shapes.append(x.shape)
+        return np.full(x.shape[:3] + (1,), self.value, dtype=np.float32)
+
+
+def test_fit_batch():
+    x = np.random.RandomState(0).randint(0, 255, size=(2, 16, 24, 3)).astype(np.uint8)
+    assert fit_batch(x, (16, 24, 3)) is x
+    gray = fit_batch(x, (8, 12, 1))
+    assert gray.shape == (2, 8, 12, 1) and gray.dtype == np.uint8
+    assert fit_batch(np.full((1, 16, 24, 3), 200, dtype=np.uint8), (16, 24, 1)).max() == 200
+    # pixels are sampled, not averaged: a checkerboard stays black and white
+    board = np.uint8(255 * (np.indices((16, 24)).sum(axis=0) % 2))[np.newaxis, ..., np.newaxis]
+    assert set(np.unique(fit_batch(board, (8, 12, 1)))) <= {0, 255}
+
+
+def test_ensemble_averages_at_original_resolution():
+    models = [Constant(0.2), Constant(0.8)]
+    ensemble = Ensemble(models, [(16, 24, 1), (8, 12, 3)], weights=[3, 1], size=(48, 32))
+    assert ensemble.load_size == (16, 24, 3)
+    x = np.zeros((2,) + ensemble.load_size, dtype=np.uint8)
+    pred = ensemble.predict_on_batch(x)
+    assert pred.shape == (2, 32, 48, 1) and np.allclose(pred, 0.75 * 0.2 + 0.25 * 0.8)
+    assert models[0].shapes == [(2, 16, 24, 1)] and models[1].shapes == [(2, 8, 12, 3)]
+
+
+def test_checkpoint_input_shape(tmpdir):
+    path = str(tmpdir.join('best_model.hdf5'))
+    config = {'class_name': 'Model', 'config': {'input_layers': [['input_1', 0, 0]], 'layers': [
+        {'name': 'input_1', 'class_name': 'InputLayer', 'config': {'batch_input_shape': [None, 128, 96, 1]}}]}}
+    with h5py.File(path, 'w') as f:
+        f.attrs['model_config'] = json.dumps(config).encode('utf8')
+    assert checkpoint_input_shape(path) == (128, 96, 1)
+    with open(str(tmpdir.join('frozen.pb.json')), 'w') as f:
+        json.dump({'input_shape': [64, 64, 3]}, f)
+    assert checkpoint_input_shape(str(tmpdir.join('frozen.pb'))) == (64, 64, 3)
+    # weights-only files fall back to the experiment directory name
+    os.makedirs(str(tmpdir.join('model-1-2-3-4-512-512-1')))
+    path = str(tmpdir.join('model-1-2-3-4-512-512-1', 'weights.hdf5'))
+    h5py.File(path, 'w').close()
+    assert checkpoint_input_shape(path) == (512, 512, 1)
+    assert load_size([(128, 96, 1), (64, 128, 1)]) == (128, 128, 1)
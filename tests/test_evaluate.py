@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+from evaluate import rle_runs, rle_dice, evaluate_submission, sweep_thresholds
+from utils import rle_encode_batch, resize_mask_batch
+
+SHAPE = (24, 16)
+
+
+def dense_dice(a, b):
+    total = a.sum() + b.sum()
+    return 1. if total == 0 else 2. * np.logical_and(a, b).sum() / total
+
+
+def random_masks(rng, n):
+    masks = rng.uniform(size=(n, SHAPE[1], SHAPE[0])) < rng.uniform(0.1, 0.9, size=(n, 1, 1))
+    masks[0] = False
+    return masks
+
+
+def test_rle_runs_merges_overlaps():
+    starts, ends = rle_runs('5 3 1 2 7 4 20 1')
+    assert starts.tolist() == [0, 4, 19] and ends.tolist() == [2, 10, 20]
+    assert len(rle_runs('')[0]) == 0 and len(rle_runs(float('nan'))[0]) == 0
+
+
+def test_rle_dice_matches_dense():
+    rng = np.random.RandomState(0)
+    a, b = random_masks(rng, 20), random_masks(rng, 20)
+    b[1] = False
+    rles_a, rles_b = rle_encode_batch(a), rle_encode_batch(b)
+    # rle_encode zeroes the first and the last pixel
+    for m in (a, b):
+        m.reshape(len(m), -1)[:, [0, -1]] = False
+    for i in range(len(a)):
+        assert np.isclose(rle_dice(rles_a[i], rles_b[i]), dense_dice(a[i], b[i]))
+
+
+def test_evaluate_submission(tmpdir):
+    rng = np.random.RandomState(1)
+    truth = random_masks(rng, 6)
+    pred = truth.copy()
+    pred[2:] = random_masks(rng, 4)
+    fns = ['car_{:02d}'.format(i) for i in range(6)]
+    pd.DataFrame({'img': [fn + '.jpg' for fn in fns], 'rle_mask': rle_encode_batch(truth)}).to_csv(
+        str(tmpdir.join('truth.csv')), index=False)
+    pd.DataFrame({'img': fns, 'rle_mask': rle_encode_batch(pred)}).to_csv(str(tmpdir.join('sub.csv')), index=False)
+    result = evaluate_submission(str(tmpdir.join('sub.csv')), str(tmpdir.join('truth.csv')), processes=2,
+                                 chunk_size=2)
+    assert result['img'].tolist() == fns
+    assert np.allclose(result['dice'][:2], 1.) and (result['dice'][2:] < 1).all()
+
+
+def test_sweep_thresholds():
+    rng = np.random.RandomState(2)
+    probs = rng.uniform(size=(3, 8, 12, 1)).astype(np.float32)
+    truth_masks = resize_mask_batch(probs, SHAPE)
+    truth = dict(zip('abc', rle_encode_batch(truth_masks)))
+    thresholds = [0.2, 0.5, 0.8]
+    dice = sweep_thresholds(list('abc'), probs, truth, thresholds, SHAPE, processes=2)
+    assert dice.shape == (3, 3) and np.allclose(dice[:, 1], 1.)
+    for j, t in enumerate(thresholds):
+        masks = resize_mask_batch(probs > t, SHAPE)
+        expected = [rle_dice(p, truth[fn]) for p, fn in zip(rle_encode_batch(masks), 'abc')]
+        assert np.allclose(dice[:, j], expected)
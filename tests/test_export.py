@@ -0,0 +1,37 @@
+import pytest
+import numpy as np
+from export import mask_dice, freeze_checkpoint, FrozenModel
+
+
+def test_mask_dice():
+    a = np.zeros((3, 4, 4, 1))
+    b = np.zeros((3, 4, 4, 1))
+    a[0, :2] = 1
+    b[0, :1] = 0.9
+    a[1] = 0.8
+    b[1] = 0.7
+    assert np.allclose(mask_dice(a, b), [2. * 4 / 12, 1., 1.])
+
+
+def test_frozen_model_matches_keras(tmpdir):
+    pytest.importorskip('tensorflow.tools.graph_transforms')
+    from keras import backend as K
+    from models import SimpleCNN
+    from utils import dice_coef, bce_dc_loss
+    K.clear_session()
+    model = SimpleCNN((16, 24, 3))
+    model.compile('adam', loss=bce_dc_loss, metrics=[dice_coef])
+    model_path = str(tmpdir.join('model.hdf5'))
+    model.save(model_path)
+    x = np.random.RandomState(0).randint(0, 256, (2,) + model.input_shape[1:]).astype(np.uint8)
+    expected = model.predict_on_batch(x)
+    path = freeze_checkpoint(model_path)
+    assert path == str(tmpdir.join('model.pb'))
+    frozen = FrozenModel(path)
+    try:
+        assert frozen.input_shape == model.input_shape
+        pred = frozen.predict_on_batch(x)
+    finally:
+        frozen.close()
+    assert pred.shape == expected.shape
+    assert np.allclose(pred, expected, atol=1e-5)
@@ -0,0 +1,81 @@
+import os
+import csv
+import glob
+import time
+import pytest
+import numpy as np
+from loader import CarvanaSequence, Prefetcher, load_batch
+from inference import stream_predict
+from prediction_cache import PredictionCache
+from utils import resize_mask_matrix_encode
+
+SIZE = (96, 64)
+
+
+def read_rows(path):
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        assert next(reader) == ['img', 'rle_mask']
+        return [tuple(row) for row in reader]
+
+
+def expected_row(model, fn, fn_dict):
+    x = load_batch([fn], fn_dict, (32, 48), test=True)
+    return fn, resize_mask_matrix_encode(model.predict_on_batch(x)[0], SIZE)
+
+
+class Failing(object):
+    '''
+    slow model whose output the threshold stage cannot index
+    '''
+    def __init__(self):
+        self.calls = 0
+
+    def predict_on_batch(self, x):
+        self.calls += 1
+        time.sleep(0.02)
+        return np.zeros(x.shape[:3], dtype=np.float32)
+
+
+def test_stream_predict_stops_when_a_stage_fails(tmpdir, fn_dict):
+    seq = CarvanaSequence(sorted(fn_dict) * 4, fn_dict, target_size=(32, 48), batch_size=1, test=True)
+    model = Failing()
+    with pytest.raises(IndexError):
+        stream_predict(model, seq, Prefetcher(seq, workers=0), str(tmpdir.join('submission.csv')), queue_depth=1)
+    assert model.calls < len(seq) // 2
+
+
+def test_stream_predict_writes_every_row(tmpdir, fn_dict, scaled):
+    fns = sorted(fn_dict)
+    expected = [expected_row(scaled(), fn, fn_dict) for fn in fns]
+    seq = CarvanaSequence(fns, fn_dict, target_size=(32, 48), batch_size=2, test=True)
+    out = str(tmpdir.join('submission.csv'))
+    stream_predict(scaled(), seq, Prefetcher(seq, workers=0), out, size=SIZE, queue_depth=2)
+    assert read_rows(out) == expected
+
+    # the first run with a cache stores every prediction
+    model_path = str(tmpdir.join('model.hdf5'))
+    with open(model_path, 'wb') as f:
+        f.write(b'weights')
+    cache = PredictionCache(str(tmpdir.join('cache')), model_path, (32, 48))
+    hits, misses = cache.split(fns, fn_dict)
+    assert hits == []
+    stats = stream_predict(scaled(), seq, Prefetcher(seq, workers=0), out, size=SIZE, queue_depth=2, cache=cache)
+    assert read_rows(out) == expected
+    assert {s.name: s.images for s in stats}['cache'] == len(fns)
+
+    # the second only reads hits; one of them is evicted by another process before it is read
+    cache = PredictionCache(str(tmpdir.join('cache')), model_path, (32, 48))
+    hits, misses = cache.split(fns, fn_dict)
+    assert hits == fns and misses == []
+    evicted, = glob.glob(str(tmpdir.join('cache', '*', cache.keys[fns[1]] + '.npy')))
+    os.remove(evicted)
+    seq = CarvanaSequence(misses, fn_dict, target_size=(32, 48), batch_size=2, test=True)
+    stats = stream_predict(scaled(), seq, Prefetcher(seq, workers=0), out, size=SIZE, queue_depth=2, cache=cache,
+                           cached_fns=hits)
+    rows = read_rows(out)
+    # the lost hit is predicted last
+    assert rows == [row for row in expected if row[0] != fns[1]] + [expected[1]]
+    stats = {s.name: s.images for s in stats}
+    assert stats['predict'] == 1 and stats['cache'] == len(fns)
+    assert cache.to_dict()['lost'] == 1
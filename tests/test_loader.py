@@ -0,0 +1,80 @@
+import multiprocessing
+import numpy as np
+from loader import CarvanaSequence, Prefetcher, StageLoaders
+
+
+def test_sequence_is_index_addressed(fn_dict):
+    seq = CarvanaSequence(sorted(fn_dict), fn_dict, target_size=(32, 48), batch_size=2, shuffle=True, seed=3)
+    assert len(seq) == 3
+    x, y = seq.get_batch(2, epoch=1)
+    assert x.shape == (1, 32, 48, 1) and y.shape == (1, 32, 48, 1)
+    # every epoch is a permutation of the full file list, reshuffled deterministically
+    for epoch in range(3):
+        seen = sum((seq.batch_fns(i, epoch) for i in range(len(seq))), [])
+        assert sorted(seen) == sorted(fn_dict)
+    assert seq.batch_fns(0, 0) != seq.batch_fns(0, 1) or seq.batch_fns(1, 0) != seq.batch_fns(1, 1)
+    assert CarvanaSequence(sorted(fn_dict), fn_dict, batch_size=2, shuffle=True, seed=3).batch_fns(1, 4) == \
+        seq.batch_fns(1, 4)
+
+
+def test_prefetcher_worker_count_does_not_change_batches(fn_dict):
+    seq = CarvanaSequence(sorted(fn_dict), fn_dict, target_size=(32, 48), batch_size=2, shuffle=True)
+    steps = 2 * len(seq) + 1
+    with Prefetcher(seq, workers=0) as serial, Prefetcher(seq, workers=3, queue_depth=4) as parallel:
+        for _ in range(steps):
+            (x0, y0), (x1, y1) = next(serial), next(parallel)
+            assert np.array_equal(x0, x1) and np.array_equal(y0, y1)
+
+
+def test_prefetcher_batches_are_uint8_views_valid_for_hold_steps(fn_dict):
+    seq = CarvanaSequence(sorted(fn_dict), fn_dict, target_size=(32, 48), batch_size=2)
+    hold = 3
+    with Prefetcher(seq, workers=2, queue_depth=2, hold=hold) as loader:
+        held = []
+        for step in range(3 * len(seq)):
+            held = (held + [next(loader)])[-(hold + 1):]
+            for age, (x, y) in enumerate(reversed(held)):
+                expected_x, expected_y = seq.get_batch((step - age) % len(seq))
+                assert x.dtype == np.uint8 and y.dtype == np.uint8
+                assert np.array_equal(x, expected_x) and np.array_equal(y, expected_y)
+    assert set(np.unique(expected_y)) <= {0, 1}
+
+
+def test_cropped_sequence_cuts_windows_of_the_full_batch(fn_dict):
+    full = CarvanaSequence(sorted(fn_dict), fn_dict, target_size=(64, 96), batch_size=2)
+    seq = CarvanaSequence(sorted(fn_dict), fn_dict, target_size=(64, 96), batch_size=2, crop=(32, 32))
+    assert seq.input_size == (32, 32)
+    x, y = seq.get_batch(1)
+    assert x.shape == (2, 32, 32, 1) and y.shape == (2, 32, 32, 1)
+    full_x, full_y = full.get_batch(1)
+    for a, b, full_a, full_b in zip(x, y, full_x, full_y):
+        windows = [(r, c) for r in range(64 - 31) for c in range(96 - 31)
+                   if np.array_equal(full_a[r:r + 32, c:c + 32], a) and np.array_equal(full_b[r:r + 32, c:c + 32], b)]
+        assert windows
+    # the workers cut the same windows
+    with Prefetcher(seq, workers=2, queue_depth=2) as loader:
+        for idx in range(len(seq)):
+            expected_x, expected_y = seq.get_batch(idx)
+            x, y = next(loader)
+            assert np.array_equal(x, expected_x) and np.array_equal(y, expected_y)
+
+
+def test_stage_loaders_keep_one_stage_alive(fn_dict):
+    made = []
+
+    def make_loaders(size, context):
+        seq = CarvanaSequence(sorted(fn_dict), fn_dict, target_size=size, batch_size=2)
+        loader = Prefetcher(seq, workers=1, queue_depth=2, context=context)
+        made.append((size, context, loader))
+        return seq, loader
+    context = multiprocessing.get_context('forkserver')
+    stages = StageLoaders([(16, 24), (32, 48)], make_loaders, context)
+    # the first stage's workers are forked up front, before a session would exist
+    assert [(size, c) for size, c, _ in made] == [((16, 24), None)]
+    for size, (seq, loader) in stages:
+        assert made[-1][0] == size and made[-1][2].pool is not None
+        assert all(previous.pool is None for _, _, previous in made[:-1])
+        x, y = next(loader)
+        assert x.shape[1:3] == size and np.array_equal(x, seq.get_batch(0)[0])
+    # the later stage started its workers from the forkserver, and everything is closed at the end
+    assert made[1][1] is context and all(loader.pool is None for _, _, loader in made)
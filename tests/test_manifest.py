@@ -0,0 +1,30 @@
+import os
+from manifest import load_manifest, parse_name
+
+
+def test_parse_name():
+    assert parse_name('00087a6bd4dc_01') == ('00087a6bd4dc', 1)
+    assert parse_name('car_a_16') == ('car_a', 16)
+    assert parse_name('nameless') == ('nameless', -1)
+
+
+def test_manifest_refresh_and_split(tmpdir, fn_dict):
+    img_dir, mask_dir = os.path.dirname(fn_dict['car00_01'][0]), os.path.dirname(fn_dict['car00_01'][1])
+    path = str(tmpdir.join('manifest.npz'))
+    manifest = load_manifest(img_dir, mask_dir, path)
+    assert manifest.fn_dict() == fn_dict
+    assert manifest.car.tolist() == ['car00', 'car00', 'car01', 'car01', 'car02']
+
+    # nothing changed: served from the file as is
+    assert load_manifest(img_dir, mask_dir, path).fns == manifest.fns
+    os.remove(fn_dict['car02_01'][0])
+    manifest = load_manifest(img_dir, mask_dir, path)
+    assert manifest.fns == ['car00_01', 'car00_02', 'car01_01', 'car01_02']
+    assert load_manifest(img_dir, path=str(tmpdir.join('images.npz'))).fn_dict()['car00_01'] == \
+        fn_dict['car00_01'][:1]
+
+    train_fns, valid_fns = manifest.split(1, seed=0)
+    assert sorted(train_fns + valid_fns) == manifest.fns
+    assert len(valid_fns) == 2 and valid_fns[0].split('_')[0] == valid_fns[1].split('_')[0]
+    assert set(fn.split('_')[0] for fn in train_fns).isdisjoint(fn.split('_')[0] for fn in valid_fns)
+    assert manifest.split(1, seed=0) == (train_fns, valid_fns)
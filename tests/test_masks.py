@@ -0,0 +1,40 @@
+import os
+import numpy as np
+import pandas as pd
+from PIL import Image
+from utils import rle_encode_batch
+from loader import CarvanaSequence
+from masks import RLEMaskSource
+
+
+def write_masks_csv(fn_dict, path):
+    fns = sorted(fn_dict)
+    masks = np.stack([np.array(Image.open(fn_dict[fn][1]).convert('L')) > 127 for fn in fns])
+    pd.DataFrame({'img': [fn + '.jpg' for fn in fns], 'rle_mask': rle_encode_batch(masks)}).to_csv(path, index=False)
+    return masks
+
+
+def test_nearest_matches_gif_resize(tmpdir, fn_dict):
+    write_masks_csv(fn_dict, str(tmpdir.join('train_masks.csv')))
+    source = RLEMaskSource(str(tmpdir.join('train_masks.csv')), shape=(96, 64))
+    assert len(source) == len(fn_dict)
+    for fn in fn_dict:
+        for target_size in [(32, 48), (17, 29), (128, 128)]:
+            gif = Image.open(fn_dict[fn][1]).convert('L').resize(target_size[::-1], Image.NEAREST)
+            assert np.array_equal(source.get(fn, target_size), np.array(gif))
+
+
+def test_area_is_block_mean(tmpdir, fn_dict):
+    masks = write_masks_csv(fn_dict, str(tmpdir.join('train_masks.csv')))
+    source = RLEMaskSource(str(tmpdir.join('train_masks.csv')), shape=(96, 64))
+    for fn, mask in zip(sorted(fn_dict), masks):
+        expected = mask.reshape(16, 4, 32, 3).mean(axis=(1, 3)) * 255
+        assert np.abs(source.get(fn, (16, 32), 'area') - expected).max() <= 0.5
+
+
+def test_sequence_with_mask_source(tmpdir, fn_dict):
+    write_masks_csv(fn_dict, str(tmpdir.join('train_masks.csv')))
+    source = RLEMaskSource(str(tmpdir.join('train_masks.csv')), shape=(96, 64))
+    gifs = CarvanaSequence(sorted(fn_dict), fn_dict, target_size=(32, 48), batch_size=5)
+    runs = CarvanaSequence(sorted(fn_dict), fn_dict, target_size=(32, 48), batch_size=5, mask_source=source)
+    assert np.array_equal(gifs[0][1], runs[0][1])
@@ -0,0 +1,50 @@
+from model_report import layer_macs, count_macs, activation_bytes
+
+
+class Layer(object):
+    def __init__(self, input_shape, output_shape, kernel_size=(3, 3), depth_multiplier=1):
+        self.input_shape = input_shape
+        self.output_shape = output_shape
+        self.kernel_size = kernel_size
+        self.depth_multiplier = depth_multiplier
+
+
+class Conv2D(Layer):
+    pass
+
+
+class SeparableConv2D(Layer):
+    pass
+
+
+class Conv2DTranspose(Layer):
+    pass
+
+
+class Lambda(Layer):
+    pass
+
+
+class MaxPool2D(Layer):
+    pass
+
+
+class Model(object):
+    def __init__(self, layers):
+        self.layers = layers
+
+
+def test_layer_macs():
+    assert layer_macs(Conv2D((None, 8, 8, 4), (None, 8, 8, 16))) == 8 * 8 * 9 * 4 * 16
+    # depthwise 3x3 on 4 channels, then a 1x1 from 4 to 16 channels
+    assert layer_macs(SeparableConv2D((None, 8, 8, 4), (None, 8, 8, 16))) == 8 * 8 * (9 * 4 + 4 * 16)
+    assert layer_macs(Conv2DTranspose((None, 4, 4, 16), (None, 8, 8, 8), (2, 2))) == 8 * 8 * 16 * 8
+    assert layer_macs(Lambda((None, 4, 4, 8), (None, 8, 8, 8))) == 4 * 8 * 8 * 8
+    assert layer_macs(Lambda((None, 8, 8, 1), (None, 8, 8, 1))) == 0
+    assert layer_macs(MaxPool2D((None, 8, 8, 4), (None, 4, 4, 4))) == 0
+    assert count_macs(Model([Conv2D((None, 8, 8, 1), (None, 8, 8, 2), (1, 1)), MaxPool2D(None, None)])) == 128
+
+
+def test_activation_bytes():
+    model = Model([Conv2D((None, 8, 8, 1), (None, 8, 8, 2)), MaxPool2D((None, 8, 8, 2), (None, 4, 4, 2))])
+    assert activation_bytes(model) == (8 * 8 * 2 + 4 * 4 * 2) * 4
@@ -0,0 +1,105 @@
+import os
+import numpy as np
+from prediction_cache import PredictionCache, quantize, dequantize
+
+
+def make_files(tmpdir, n):
+    model_path = str(tmpdir.join('model.hdf5'))
+    with open(model_path, 'wb') as f:
+        f.write(b'weights')
+    fn_dict = {}
+    for i in range(n):
+        path = str(tmpdir.join('img{}.jpg'.format(i)))
+        with open(path, 'wb') as f:
+            f.write(os.urandom(64))
+        fn_dict['img{}'.format(i)] = [path]
+    return model_path, fn_dict
+
+
+def test_quantize():
+    p = np.concatenate([np.linspace(0, 1, 1001), [0.5, np.nextafter(0.5, 1)]])
+    assert np.abs(dequantize(quantize(p)) - p).max() <= 0.5 / 255 + 1e-7
+    assert ((quantize(p) >= 128) == (p > 0.5)).all()
+
+
+def test_prediction_cache(tmpdir):
+    model_path, fn_dict = make_files(tmpdir, 4)
+    fns = sorted(fn_dict)
+    path = str(tmpdir.join('cache'))
+    pred = np.random.RandomState(0).uniform(size=(4, 8, 8, 1)).astype(np.float32)
+
+    cache = PredictionCache(path, model_path, (8, 8))
+    assert cache.split(fns, fn_dict) == ([], fns)
+    cache.put(fns[:3], pred[:3])
+
+    # a new run with the same checkpoint only misses the image that was not predicted
+    cache = PredictionCache(path, model_path, (8, 8))
+    assert cache.split(fns, fn_dict) == (fns[:3], fns[3:])
+    found, cached = cache.get(fns[:3])
+    assert found == fns[:3] and np.abs(cached - pred[:3]).max() <= 0.5 / 255 + 1e-7
+    assert cache.to_dict()['hit_rate'] == 0.75 and cache.to_dict()['bytes_saved'] == 3 * 64
+
+    # rewritten image or another checkpoint: misses
+    with open(fn_dict['img0'][0], 'wb') as f:
+        f.write(b'other image')
+    assert cache.split(fns[:1], fn_dict) == ([], fns[:1])
+    assert PredictionCache(path, model_path, (16, 16)).split(fns, fn_dict)[0] == []
+    with open(model_path, 'wb') as f:
+        f.write(b'new weights')
+    assert PredictionCache(path, model_path, (8, 8)).split(fns, fn_dict)[0] == []
+
+
+def test_prediction_cache_eviction(tmpdir):
+    model_path, fn_dict = make_files(tmpdir, 4)
+    fns = sorted(fn_dict)
+    path = str(tmpdir.join('cache'))
+    pred = np.zeros((4, 8, 8, 1), dtype=np.float32)
+    cache = PredictionCache(path, model_path, (8, 8))
+    cache.split(fns, fn_dict)
+    cache.put(fns[:3], pred[:3])
+    entry_size = cache.total_bytes // 3
+
+    # img0 is used again, so img1 is the least recently used entry when img3 needs room
+    cache = PredictionCache(path, model_path, (8, 8), max_bytes=3 * entry_size)
+    cache.split(fns[:1], fn_dict)
+    cache.split(fns[3:], fn_dict)
+    cache.put(fns[3:], pred[3:])
+    assert cache.evicted == 1 and cache.total_bytes == 3 * entry_size
+    cache = PredictionCache(path, model_path, (8, 8))
+    assert cache.split(fns, fn_dict) == (['img0', 'img2', 'img3'], ['img1'])
+
+
+def test_prediction_cache_shared_by_two_processes(tmpdir):
+    model_path, fn_dict = make_files(tmpdir, 6)
+    fns = sorted(fn_dict)
+    path = str(tmpdir.join('cache'))
+    pred = np.zeros((6, 8, 8, 1), dtype=np.float32)
+    cache = PredictionCache(path, model_path, (8, 8))
+    cache.split(fns, fn_dict)
+    cache.put(fns[:2], pred[:2])
+    entry_size = cache.total_bytes // 2
+
+    # both list img0 and img1; b uses img0, a then needs room for img2..img3 and must leave img0 alone
+    # a never lists the directory again, so only the mtime of img0 tells it b used it
+    a = PredictionCache(path, model_path, (8, 8), max_bytes=2 * entry_size, rescan_bytes=2 ** 40)
+    b = PredictionCache(path, model_path, (8, 8), max_bytes=2 * entry_size, rescan_bytes=0)
+    assert a.split(fns[2:4], fn_dict) == ([], fns[2:4])
+    assert b.split(fns[:1], fn_dict) == (fns[:1], [])
+    a.put(fns[2:3], pred[2:3])
+    found, cached = b.get(fns[:1])
+    assert found == fns[:1] and cached.shape == (1, 8, 8, 1)
+
+    # an entry evicted by the other process after the lookup is a miss, not an error
+    assert b.split(fns[2:3], fn_dict) == (fns[2:3], [])
+    a.put(fns[3:4], pred[3:4])
+    a.split(fns[4:6], fn_dict)
+    a.put(fns[4:6], pred[4:6])
+    found, cached = b.get(fns[2:3])
+    assert found == [] and len(cached) == 0
+    assert b.to_dict()['lost'] == 1 and b.misses == 1
+
+    # the entries of both processes count against max_bytes
+    assert a.total_bytes <= 2 * entry_size
+    on_disk = sum(len(os.listdir(os.path.join(path, d))) for d in os.listdir(path)
+                  if os.path.isdir(os.path.join(path, d)))
+    assert on_disk <= 2
@@ -0,0 +1,41 @@
+import json
+import time
+import numpy as np
+from loader import CarvanaSequence, Prefetcher
+from profiling import Histogram, PipelineProfiler
+
+
+def test_histogram_percentiles():
+    h = Histogram()
+    values = np.random.RandomState(0).lognormal(np.log(0.01), 1, size=1000)
+    for v in values:
+        h.add(v)
+    h.add(0)
+    assert h.count == 1001 and np.isclose(h.total, values.sum())
+    # bins are 10 per decade, so percentiles are within a factor 10 ** 0.1
+    for q in [50, 90, 99]:
+        assert 1 <= h.percentile(q) / np.percentile(values, q) < 10 ** 0.1 * 1.01
+    assert sum(count for _, count in h.to_dict()['bins']) == 1001
+
+
+def test_prefetcher_and_profiler_stats(tmpdir, fn_dict):
+    seq = CarvanaSequence(sorted(fn_dict), fn_dict, target_size=(32, 48), batch_size=2, decode='draft')
+    with Prefetcher(seq, workers=2, queue_depth=2) as loader:
+        profiler = PipelineProfiler(str(tmpdir), loaders={'train': loader}, verbose=0)
+        profiler.on_epoch_begin(0)
+        for batch in range(len(seq)):
+            next(loader)
+            profiler.on_batch_begin(batch)
+            profiler.on_batch_end(batch)
+        profiler.mark.on_epoch_end(0)
+        time.sleep(0.05)
+        profiler.on_epoch_end(0, {'checkpoint_stall': 0.01})
+    with open(str(tmpdir.join('pipeline_profile.json'))) as f:
+        profile = json.load(f)
+    assert set(profile['train']) == {'data_wait', 'step', 'validation', 'callbacks', 'checkpoint_stall'}
+    # the callbacks between the mark and the profiler are not counted as validation
+    assert profile['train']['callbacks']['total'] >= 0.05 > profile['train']['validation']['total']
+    assert profile['train']['step']['count'] == len(seq)
+    stages = profile['loaders']['train']
+    assert {'decode', 'resize', 'mask', 'assemble', 'load', 'queue_wait'} <= set(stages)
+    assert stages['load']['count'] == len(seq)
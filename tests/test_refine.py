@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from refine import tile_grid, uncertain_map, CoarseToFine
+
+
+def test_tile_grid():
+    for length, tile, margin in [(100, 32, 4), (64, 64, 8), (90, 20, 3)]:
+        origins, starts, ends = tile_grid(length, tile, margin)
+        assert starts[0] == 0 and ends[-1] == length and np.array_equal(starts[1:], ends[:-1])
+        assert (origins >= 0).all() and (origins + tile <= length).all()
+        assert (starts >= origins).all() and (ends <= origins + tile).all()
+    with pytest.raises(ValueError):
+        tile_grid(10, 20, 2)
+
+
+def test_uncertain_map():
+    prob = np.zeros((8, 8))
+    prob[1:6, 1:6] = 1.
+    prob[7, 7] = 0.5
+    u = uncertain_map(prob)
+    # the outline on both sides, the uncertain pixel, and nothing inside or far outside
+    assert u[7, 7] and u[1, 1:6].all() and u[0, 1:6].all() and u[6, 1:6].all()
+    assert u[0, 0] and u[6, 6] and u[0, 6]
+    assert not u[2:5, 2:5].any() and not u[7, 0]
+
+
+def test_coarse_to_fine_refines_only_the_outline(scaled):
+    height, width = 96, 160
+    yy, xx = np.mgrid[:height, :width]
+    car = ((yy - 48.) / 30) ** 2 + ((xx - 70.) / 50) ** 2 < 1
+    x = (car * 255).astype(np.uint8)[np.newaxis, :, :, np.newaxis].repeat(2, axis=0)
+    coarse, fine = scaled(), scaled()
+    refiner = CoarseToFine(coarse, (12, 20, 1), fine, (16, 16, 1), fine_size=(width, height), size=(width, height),
+                           margin=2, tile_batch=5)
+    assert refiner.load_size == (height, width, 1)
+    pred = refiner.predict_on_batch(x)
+    assert pred.shape == (2, height, width, 1)
+    assert np.array_equal(pred[..., 0] > 0.5, np.stack([car, car]))
+    assert coarse.shapes == [(2, 12, 20, 1)] and all(s[1:] == (16, 16, 1) and s[0] <= 5 for s in fine.shapes)
+    report = refiner.to_dict()
+    assert 0 < report['tiles'] < report['total_tiles'] and report['tiles'] == sum(s[0] for s in fine.shapes)
@@ -0,0 +1,77 @@
+import time
+import tracemalloc
+import numpy as np
+from utils import rle_encode, rle_decode, rle_encode_batch, rle_decode_batch, rle_encode_resized, \
+    resize_mask_matrix_encode
+from benchmark import car_masks as make_car_masks
+
+
+def test_rle_encode_batch_matches_faster(car_masks):
+    masks = car_masks(3, shape=(120, 80))
+    masks[1, 0, :5] = 1
+    masks[1, -1, -5:] = 1
+    masks[2] = 0
+    preds = masks[:, :, :, np.newaxis] * 0.9
+    assert rle_encode_batch(preds) == [rle_encode(a, mode='faster') for a in preds]
+    assert rle_encode_batch(masks) == [rle_encode(a, mode='faster') for a in masks]
+
+
+def test_rle_decode_batch_matches_rle_decode(car_masks):
+    masks = car_masks(3, shape=(120, 80))
+    rles = rle_encode_batch(masks) + ['', '1 3 9597 4']
+    out = rle_decode_batch(rles, shape=(120, 80))
+    assert out.shape == (5, 80, 120) and out.dtype == np.uint8
+    for a, rle in zip(out, rles):
+        assert np.array_equal(a, rle_decode(rle, shape=(120, 80)))
+    assert rle_encode_batch(out[:3]) == rles[:3]
+
+
+def test_rle_encode_resized_matches_resize_path(car_masks):
+    rng = np.random.RandomState(0)
+    preds = [car_masks(1, shape=(64, 64))[0, :, :, np.newaxis] * 0.8, rng.rand(32, 48, 1), np.ones((16, 16, 1)),
+             np.zeros((16, 16, 1))]
+    for pred in preds:
+        for size in [(1918, 1280), (97, 61), (10, 7)]:
+            assert rle_encode_resized(pred, size) == resize_mask_matrix_encode(pred, size)
+
+
+def benchmark_resized(n=8):
+    preds = make_car_masks(n, shape=(256, 256))[:, :, :, np.newaxis] * 0.9
+    print("encoding {} 256x256 predictions at 1918x1280...".format(n))
+    for name, func in [('resize_mask_matrix_encode', resize_mask_matrix_encode),
+                       ('rle_encode_resized', rle_encode_resized)]:
+        now = time.time()
+        for pred in preds:
+            func(pred)
+        elapsed = time.time() - now
+        # memory is traced in a separate pass, tracemalloc slows down allocations
+        tracemalloc.start()
+        func(preds[0])
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("%s: %.1f images/sec, peak %.1f MB" % (name, n / elapsed, peak / 2. ** 20))
+
+
+def benchmark(n=8):
+    masks = make_car_masks(n)
+    print("encoding {} masks of {}x{}...".format(n, masks.shape[2], masks.shape[1]))
+    for mode, count in [('slow', 1), ('fast', 1), ('faster', n)]:
+        now = time.time()
+        for a in masks[:count]:
+            rle_encode(a, mode=mode)
+        print("rle_encode(mode='%s'): %.1f images/sec" % (mode, count / (time.time() - now)))
+    now = time.time()
+    rles = rle_encode_batch(masks)
+    print("rle_encode_batch: %.1f images/sec" % (n / (time.time() - now)))
+    now = time.time()
+    for rle in rles:
+        rle_decode(rle)
+    print("rle_decode: %.1f images/sec" % (n / (time.time() - now)))
+    now = time.time()
+    rle_decode_batch(rles)
+    print("rle_decode_batch: %.1f images/sec" % (n / (time.time() - now)))
+
+
+if __name__ == "__main__":
+    benchmark()
+    benchmark_resized()
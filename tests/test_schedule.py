@@ -0,0 +1,13 @@
+import pytest
+from utils import parse_schedule
+
+
+def test_parse_schedule():
+    assert parse_schedule('128:8:4,256:4:3,512x384:2:3') == [((128, 128), 8, 4), ((256, 256), 4, 3),
+                                                             ((512, 384), 2, 3)]
+    assert parse_schedule('128, 256::5,512:1', batch_size=2, epochs=10) == [((128, 128), 2, 10),
+                                                                           ((256, 256), 2, 5), ((512, 512), 1, 10)]
+    with pytest.raises(ValueError):
+        parse_schedule('128:8:4:1')
+    with pytest.raises(ValueError):
+        parse_schedule('256x256x3:4')
@@ -0,0 +1,88 @@
+import os
+import pytest
+import pandas as pd
+from shards import shard_fns, shard_path, merge_shards, submission_path, launch
+
+FNS = ['car{:02d}_{:02d}'.format(i // 16, i % 16 + 1) for i in range(37)]
+
+
+def write_shards(submission, shards):
+    for i, fns in enumerate(shards):
+        pd.DataFrame([(fn + '.jpg', '1 2') for fn in fns], columns=['img', 'rle_mask']).to_csv(
+            shard_path(submission, i, len(shards)), index=False)
+
+
+def test_shard_fns():
+    shards = [shard_fns(FNS[::-1], 5, i) for i in range(5)]
+    assert sum(shards, []) == sorted(FNS)
+    assert set(len(s) for s in shards) == {7, 8}
+    assert shard_fns(FNS, 1, 0) == sorted(FNS)
+    with pytest.raises(ValueError):
+        shard_fns(FNS, 2, 2)
+    assert shard_path('a/submission.csv', 3, 8) == 'a/submission-00003-of-00008.csv'
+    assert shard_path('a/submission.csv', 0, 1) == 'a/submission.csv'
+
+
+def test_merge_shards(tmpdir):
+    submission = str(tmpdir.join('submission.csv'))
+    shards = [shard_fns(FNS, 3, i) for i in range(3)]
+    write_shards(submission, shards)
+    assert merge_shards(submission, 3, FNS) == len(FNS)
+    assert pd.read_csv(submission)['img'].tolist() == [fn + '.jpg' for fn in sorted(FNS)]
+
+    os.remove(submission)
+    write_shards(submission, [shards[0], shards[1] + shards[2][:1], shards[2]])
+    with pytest.raises(ValueError, match='duplicate'):
+        merge_shards(submission, 3, FNS)
+    write_shards(submission, [shards[0], shards[1], shards[2][1:]])
+    with pytest.raises(ValueError, match='missing'):
+        merge_shards(submission, 3, FNS)
+    assert not os.path.exists(submission) and len(tmpdir.listdir()) == 3
+    with pytest.raises(ValueError, match='shards missing'):
+        merge_shards(submission, 4, FNS)
+
+
+# stands in for test.py: writes the rows of its shard where test.py would
+FAKE_TEST = """
+import sys, argparse
+sys.path.insert(0, {root!r})
+from manifest import load_manifest
+from shards import shard_fns, shard_path, submission_path
+parser = argparse.ArgumentParser()
+for name in ['--model', '--imdir']:
+    parser.add_argument(name)
+for name in ['--num_shards', '--shard_index']:
+    parser.add_argument(name, type=int)
+parser.add_argument('--ensemble', nargs='+')
+parser.add_argument('--refine', action='store_true')
+parser.add_argument('--tiled', action='store_true')
+args, _ = parser.parse_known_args()
+path = shard_path(submission_path(args.model, args.ensemble, args.refine, args.tiled), args.shard_index,
+                  args.num_shards)
+with open(path, 'w') as f:
+    f.write('img,rle_mask\\n')
+    for fn in shard_fns(load_manifest(args.imdir).fns, args.num_shards, args.shard_index):
+        f.write(fn + '.jpg,1 2\\n')
+"""
+
+
+def test_submission_path():
+    assert submission_path('a/model.hdf5') == os.path.join('a', 'submission.csv')
+    assert submission_path('a/model.hdf5', refine=True) == os.path.join('a', 'submission-refined.csv')
+    assert submission_path('a/model.hdf5', ['b/model.pb', 'a/model.hdf5']) == \
+        os.path.join('b', 'submission-ensemble.csv')
+
+
+def test_launch_merges_the_shards_of_a_mode(tmpdir, fn_dict):
+    script = tmpdir.join('fake_test.py')
+    script.write(FAKE_TEST.format(root=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    imdir = os.path.dirname(next(iter(fn_dict.values()))[0])
+    model = str(tmpdir.join('model', 'best_model.hdf5'))
+    os.makedirs(os.path.dirname(model))
+    with tmpdir.as_cwd():
+        submission = launch(2, model, imdir, ['--tiled', '--stream'], script=str(script))
+        assert submission == submission_path(model, tiled=True)
+        assert pd.read_csv(submission)['img'].tolist() == [fn + '.jpg' for fn in sorted(fn_dict)]
+        # the shards written are found again
+        os.remove(submission)
+        assert launch(2, model, imdir, ['--tiled'], script=str(tmpdir.join('not_run.py'))) == submission
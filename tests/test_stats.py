@@ -0,0 +1,28 @@
+import numpy as np
+from utils import ChannelStats, dataset_stats, load_image
+
+
+def test_channel_stats_merge():
+    rng = np.random.RandomState(0)
+    imgs = [rng.randint(0, 255, size=(8 + i, 5, 3)) for i in range(6)]
+    left, right = ChannelStats(3), ChannelStats(3)
+    for img in imgs[:2]:
+        left.update(img)
+    for img in imgs[2:]:
+        right.update(img)
+    stats = left.merge(right)
+    pixels = np.concatenate([img.reshape(-1, 3) for img in imgs]).astype(np.float64)
+    assert stats.count == len(pixels)
+    assert np.allclose(stats.mean, pixels.mean(axis=0))
+    assert np.allclose(stats.var, pixels.var(axis=0))
+
+
+def test_dataset_stats_are_cached(tmpdir, fn_dict):
+    stats_path = str(tmpdir.join('stats.json'))
+    stats = dataset_stats(sorted(fn_dict), fn_dict, (16, 24), grayscale=False, stats_path=stats_path, processes=2,
+                          chunk=2)
+    pixels = np.concatenate([load_image(fn_dict[fn][0], (16, 24), False).reshape(-1, 3) for fn in fn_dict])
+    assert np.allclose(stats['mean'], pixels.mean(axis=0))
+    assert np.allclose(stats['std'], pixels.std(axis=0))
+    # the second call is served from the stats file
+    assert dataset_stats(sorted(fn_dict), {}, (16, 24), grayscale=False, stats_path=stats_path) == stats
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from tiling import overlap_grid, blend_window, TiledPredictor
+
+
+def test_overlap_grid():
+    for length, tile, overlap in [(1918, 512, 64), (1280, 512, 64), (100, 32, 0), (64, 64, 8), (90, 20, 19)]:
+        origins = overlap_grid(length, tile, overlap)
+        assert origins[0] == 0 and origins[-1] == length - tile
+        assert (np.diff(origins) <= tile - overlap).all() and (np.diff(origins) > 0).all()
+    with pytest.raises(ValueError):
+        overlap_grid(10, 20, 2)
+    with pytest.raises(ValueError):
+        overlap_grid(100, 20, 20)
+
+
+def test_blend_window():
+    w = blend_window((16, 24), 4)
+    assert w.shape == (16, 24) and (w > 0).all() and w.max() == 1.
+    assert w[8, 12] == 1. and w[0, 0] < w[1, 1] < w[4, 4]
+
+
+def test_tiled_predictor_blends_to_the_image(scaled):
+    height, width = 90, 150
+    x = np.random.RandomState(0).randint(0, 256, (3, height, width, 1)).astype(np.uint8)
+    model = scaled()
+    tiled = TiledPredictor(model, (32, 48, 1), size=(width, height), overlap=8, tile_batch=5)
+    assert tiled.load_size == (height, width, 1)
+    prob = tiled.predict_on_batch(x)
+    # a position-independent model comes out unchanged whatever the weights
+    assert prob.shape == (3, height, width, 1) and prob.dtype == np.float32
+    np.testing.assert_allclose(prob, x / 255., atol=1e-5)
+    # memory of the forward pass is bounded by tile_batch, not the image
+    assert all(shape[0] <= 5 and shape[1:] == (32, 48, 1) for shape in model.shapes)
+    assert sum(shape[0] for shape in model.shapes) == 3 * len(tiled.origins)
+    assert tiled.to_dict()['tiles_per_image'] == len(tiled.origins)
+
+
+def test_tiled_predictor_converts_color(scaled):
+    x = np.full((2, 40, 60, 3), 200, dtype=np.uint8)
+    tiled = TiledPredictor(scaled(), (32, 32, 1), size=(60, 40), overlap=4)
+    np.testing.assert_allclose(tiled.predict_on_batch(x), 200 / 255., atol=1e-5)
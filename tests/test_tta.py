@@ -0,0 +1,54 @@
+import time
+
+import numpy as np
+import pytest
+from tta import TTAModel, tta_latency
+
+
+class Recorder(object):
+    '''
+    "predicts" the first channel scaled to [0, 1], after remembering the batch it was given
+    '''
+    def __init__(self):
+        self.batches = []
+
+    def predict_on_batch(self, x):
+        self.batches.append(x.copy())
+        return x[..., :1] / 255.
+
+
+def test_tta_is_one_forward_call_and_equivariant_models_are_unchanged():
+    x = np.random.RandomState(0).randint(0, 255, size=(3, 4, 6, 1)).astype(np.uint8)
+    model = Recorder()
+    tta = TTAModel(model, ['identity', 'hflip', 'vflip', 'hvflip'])
+    pred = tta.predict_on_batch(x)
+    assert len(model.batches) == 1 and model.batches[0].shape == (12, 4, 6, 1)
+    assert np.array_equal(model.batches[0][3:6], x[:, :, ::-1])
+    assert pred.dtype == np.float32 and np.allclose(pred, x / 255.)
+    assert set(tta.stats.histograms) == {'stack', 'forward', 'merge'}
+
+
+def test_tta_averages_unflipped_outputs():
+    class LeftHalf(object):
+        def predict_on_batch(self, x):
+            out = np.zeros(x.shape[:3] + (1,), dtype=np.float32)
+            out[:, :, :x.shape[2] // 2] = 1.
+            return out
+
+    x = np.zeros((2, 4, 6, 1), dtype=np.uint8)
+    pred = TTAModel(LeftHalf(), ['identity', 'hflip']).predict_on_batch(x)
+    assert np.allclose(pred, 0.5)
+    with pytest.raises(ValueError):
+        TTAModel(LeftHalf(), ['rotate'])
+
+
+def test_tta_latency_is_per_image_cost_of_the_measured_throughput():
+    class Sleeper(object):
+        def predict_on_batch(self, x):
+            time.sleep(0.002 * len(x))
+            return np.zeros(x.shape[:3] + (1,), dtype=np.float32)
+
+    x = np.zeros((8, 4, 6, 1), dtype=np.uint8)
+    report = tta_latency(Sleeper(), x, ['identity', 'hflip'], batch_size=4, repeat=2)
+    assert 0.002 <= report['plain'] < 0.004 and 1.5 < report['ratio'] < 2.5
+    assert report['plain_batches']['count'] == report['tta_batches']['count'] == 4
@@ -0,0 +1,104 @@
+import time
+import numpy as np
+from config import ORIGIN_SHAPE
+from ensemble import checkpoint_input_shape, fit_batch
+from profiling import TimingStats, add_time
+
+
+def overlap_grid(length, tile, overlap):
+    '''
+    :return: int64 origins of the fewest crops of `tile` pixels overlapping by at least `overlap` that cover
+        [0, length); the crops are spread evenly and the last one ends at `length`
+    '''
+    if tile > length or not 0 <= overlap < tile:
+        raise ValueError("tile {} does not fit length {} with overlap {}".format(tile, length, overlap))
+    # evenly spread origins step by at most tile - overlap, also once rounded
+    n = 1 if tile == length else int(np.ceil((length - tile) / float(tile - overlap))) + 1
+    return np.rint(np.linspace(0, length - tile, n)).astype(np.int64)
+
+
+def blend_window(shape, overlap):
+    '''
+    weights of a tile prediction: 1 in the middle, ramping down linearly over `overlap` pixels towards the
+    borders (never to 0), where the model lacks context
+    :param shape: (rows, cols) of the tile
+    :return: float32 [rows, cols]
+    '''
+    def ramp(n):
+        i = np.arange(n, dtype=np.float32)
+        return np.minimum(1., (np.minimum(i, n - 1 - i) + 1.) / (overlap + 1.))
+    return np.outer(ramp(shape[0]), ramp(shape[1]))
+
+
+class TiledPredictor(object):
+    '''
+    full resolution inference with a model of a smaller, fixed input, behind the predict_on_batch interface:
+    every image is cut into overlapping tiles of the model input size, the tiles of all the images of a batch
+    are predicted `tile_batch` at a time, and the predictions are blended with blend_window into a full size
+    probability map allocated once per batch. the forward pass only ever holds `tile_batch` tiles, so its
+    memory is set by `tile_batch` and the model, whatever the image size.
+
+    usage:
+        tiled = TiledPredictor.load('best_model.hdf5', overlap=64, tile_batch=16)
+        seq = CarvanaSequence(fns, fn_dict, target_size=tiled.load_size[:2],
+                              grayscale=tiled.load_size[2] == 1, test=True)
+        stream_predict(tiled, seq, Prefetcher(seq), 'submission.csv')
+    '''
+    def __init__(self, model, input_shape, size=ORIGIN_SHAPE, overlap=64, tile_batch=16):
+        '''
+        :param model: model with predict_on_batch, taking (rows, cols, channel) `input_shape` tiles
+        :param size: (width, height) of the images and of the returned probabilities
+        :param overlap: minimum overlap of neighbouring tiles, in pixels
+        :param tile_batch: tiles per forward call
+        '''
+        self.model = model
+        self.input_shape = tuple(input_shape)
+        self.size = size
+        self.overlap = overlap
+        self.tile_batch = tile_batch
+        width, height = size
+        self.load_size = (height, width, self.input_shape[2])
+        rows, cols = self.input_shape[:2]
+        self.origins = [(r, c) for r in overlap_grid(height, rows, overlap) for c in overlap_grid(width, cols, overlap)]
+        self.window = blend_window((rows, cols), overlap)
+        # the grid is the same for every image, so is the sum of the weights
+        self.norm = np.zeros((height, width), dtype=np.float32)
+        for r, c in self.origins:
+            self.norm[r:r + rows, c:c + cols] += self.window
+        np.reciprocal(self.norm, out=self.norm)
+        self.stats = TimingStats()
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        from export import FrozenModel, load_keras_model
+        model = FrozenModel(path) if path.endswith('.pb') else load_keras_model(path)
+        return cls(model, checkpoint_input_shape(path), **kwargs)
+
+    def predict_on_batch(self, x):
+        '''
+        :param x: uint8 [n, rows, cols, channel] decoded at load_size
+        :return: float32 [n, height, width, 1] blended probabilities
+        '''
+        timings = {}
+        start = time.time()
+        x = fit_batch(x, self.load_size)
+        rows, cols = self.input_shape[:2]
+        prob = np.zeros(x.shape[:3], dtype=np.float32)
+        tiles = [(i, r, c) for i in range(len(x)) for r, c in self.origins]
+        for k in range(0, len(tiles), self.tile_batch):
+            chunk = tiles[k:k + self.tile_batch]
+            crops = np.stack([x[i, r:r + rows, c:c + cols] for i, r, c in chunk])
+            start = add_time(timings, 'crop', start)
+            pred = self.model.predict_on_batch(crops)[..., -1]
+            start = add_time(timings, 'forward', start)
+            for (i, r, c), q in zip(chunk, pred):
+                prob[i, r:r + rows, c:c + cols] += q * self.window
+            start = add_time(timings, 'blend', start)
+        prob *= self.norm
+        add_time(timings, 'blend', start)
+        self.stats.update(timings)
+        return prob[..., np.newaxis]
+
+    def to_dict(self):
+        return {'input_shape': list(self.input_shape), 'tiles_per_image': len(self.origins),
+                'overlap': self.overlap, 'tile_batch': self.tile_batch, 'stats': self.stats.to_dict()}
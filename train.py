@@ -1,12 +1,19 @@
-import os, glob, cv2, argparse
+import os, glob, cv2, json, time, argparse, multiprocessing
 import numpy as np
 import tensorflow as tf
 from multiprocessing.dummy import Pool
 from datetime import datetime
 from utils import *
 from models import *
+from cache import build_cache
+from loader import CarvanaSequence, Prefetcher, StageLoaders
+from masks import RLEMaskSource
+from manifest import load_manifest
+from profiling import PipelineProfiler
+from config import BATCH_SIZE, WORKERS, QUEUE_DEPTH, DECODE_BACKEND
+from autotune import apply_profile
 from keras.optimizers import Adam, rmsprop
-from keras.callbacks import ModelCheckpoint, CSVLogger
+from keras.callbacks import CSVLogger
 from math import ceil
 from keras import backend as K
 from keras.backend.tensorflow_backend import set_session
@@ -20,13 +27,49 @@ def create_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--train_imdir', type=str, default=img_dir)
     parser.add_argument('--train_maskdir', type=str, default=mask_dir)
-    parser.add_argument('--target_size', type=tuple, default=(256,256))
+    parser.add_argument('--target_size', type=int, nargs=2, default=[256, 256])
     parser.add_argument('--grayscale', type=bool, default=True)
-    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--batch_size', type=int, default=None,
+                        help="default: this host's autotune profile, else {}".format(BATCH_SIZE))
     parser.add_argument('--epochs', type=int, default=10)
     parser.add_argument('--gpu', type=float, default=1)
     parser.add_argument('--gpus', type=str, default=None, help="gpu1 use '1'; multi-gpu training use '0,1';")
-    return parser.parse_args()
+    parser.add_argument('--cache_dir', type=str, default=None, help="build/reuse a preprocessed dataset cache here")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="data loader processes; 0 loads in-process (default: autotune profile, else {})".format(
+                            WORKERS))
+    parser.add_argument('--queue_depth', type=int, default=None,
+                        help="batches prefetched per loader (default: autotune profile, else {})".format(QUEUE_DEPTH))
+    parser.add_argument('--seed', type=int, default=1, help="seed of the per-epoch shuffle")
+    parser.add_argument('--decode', type=str, default=None, choices=DECODE_BACKENDS,
+                        help="jpeg decoder; 'draft'/'cv2' decode at reduced dct scale (default: autotune profile, "
+                             "else {})".format(DECODE_BACKEND))
+    parser.add_argument('--train_masks_csv', type=str, default=None,
+                        help="rasterize masks from train_masks.csv instead of decoding the gifs")
+    parser.add_argument('--mask_sampling', type=str, default='nearest', choices=['nearest', 'area'])
+    parser.add_argument('--keep_best', type=int, default=1, help="best epoch checkpoints kept on disk")
+    parser.add_argument('--keep_last', type=int, default=1, help="latest epoch checkpoints kept on disk")
+    parser.add_argument('--schedule', type=str, default=None,
+                        help="progressive resolution stages SIZE[xSIZE][:BATCH_SIZE[:EPOCHS]],... e.g. "
+                             "'128:8:4,256:4:3,512:2:3'; weights carry over between stages")
+    parser.add_argument('--data_aug', action='store_true',
+                        help="augment training batches in the loader workers (flip, affine, brightness/contrast)")
+    parser.add_argument('--width', type=float, default=1., help="unet filter multiplier (32 * width at full size)")
+    parser.add_argument('--depth', type=int, default=5, help="unet resolution levels")
+    parser.add_argument('--separable', action='store_true', help="depthwise-separable unet convolutions")
+    parser.add_argument('--upsample', type=str, default='transpose', choices=UPSAMPLE_MODES)
+    parser.add_argument('--normalize', action='store_true',
+                        help="subtract the channel mean of the training set (cached in experiment/dataset_stats.json)")
+    parser.add_argument('--crop', type=int, nargs=2, default=None,
+                        help="train on random windows of this size (mostly on the car outline) cut from the images "
+                             "decoded at --target_size, e.g. --target_size 1280 1918 --crop 256 256 for the "
+                             "--refine_model of test.py --refine; the model input is the crop size")
+    args = parser.parse_args()
+    if args.crop and args.schedule:
+        parser.error("--crop cannot be combined with --schedule")
+    if args.cache_dir and args.mask_sampling != 'nearest':
+        parser.error("--cache_dir stores binary masks, use --mask_sampling nearest or no cache")
+    return args
 
 
 # train
@@ -37,32 +80,94 @@ if __name__ == "__main__":
     mask_dir = args.train_maskdir
     target_size = args.target_size
     grayscale = args.grayscale
-    batch_size = args.batch_size
     epochs = args.epochs
 
 
     now = datetime.now()
-    if grayscale:
-        target_size = target_size + (1,)
+    channel = 1 if grayscale else 3
+    # one stage per resolution; without --schedule a single stage at --target_size
+    if args.schedule:
+        stages = parse_schedule(args.schedule, None, epochs)
     else:
-        target_size = target_size + (3,)
+        stages = [(tuple(target_size), None, epochs)]
+    # the model input: the stage size, or the crops cut from it
+    crop = tuple(args.crop) if args.crop else None
+    # batch size and loader settings not given come from `python autotune.py --mode train` run on this host,
+    # tuned for the input size of every stage
+    stage_args = {}
+    for size, _, _ in stages:
+        if size not in stage_args:
+            stage_args[size] = argparse.Namespace(**vars(args))
+            apply_profile(stage_args[size], 'train', (crop or size) + (channel,),
+                          {'batch_size': BATCH_SIZE, 'workers': WORKERS, 'queue_depth': QUEUE_DEPTH,
+                           'decode': DECODE_BACKEND})
+    stages = [(size, stage_batch_size or stage_args[size].batch_size, stage_epochs)
+              for size, stage_batch_size, stage_epochs in stages]
+    target_size = (crop or stages[-1][0]) + (channel,)
     filepath_dir = 'experiment/model-{}-{}-{}-{}-{}-{}-{}/'.format(now.month, now.day, now.hour, now.minute, target_size[0],
                                                                 target_size[1], target_size[2])
     if not os.path.isdir(filepath_dir):
         os.makedirs(filepath_dir)
-    # filepath = filepath_dir + 'epoch-{epoch:02d}-{loss:.4f}-{dice_coef:.4f}-{val_loss:.4f}-{val_dice_coef:.4f}.hdf5'
     filepath = filepath_dir + 'best_model.hdf5'
-
-    # construct fn dictionary
-    total_fns = [os.path.splitext(os.path.basename(x))[0] for x in glob.glob(os.path.join(img_dir, '*.jpg'))]
-    fn_dict = {fn: [os.path.join(img_dir, fn + '.jpg'), os.path.join(mask_dir, fn + '_mask.gif')] for fn in total_fns}
-    # train/valid split
-    np.random.seed(1)
-    valid_fns = list(np.random.choice(total_fns, 300))
-    train_fns = [x for x in total_fns if x not in valid_fns]
-
-    # normalize = normalize_data(train_fns, fn_dict, target_size)
-    normalize = None
+    # lets model_report.py put the val dice of this run next to the speed of its configuration
+    architecture = {'name': family_name(args.width, args.depth, args.separable, args.upsample), 'width': args.width,
+                    'depth': args.depth, 'separable': args.separable, 'upsample': args.upsample,
+                    'target_size': list(target_size)}
+    with open(filepath_dir + 'architecture.json', 'w') as f:
+        json.dump(architecture, f, indent=1)
+
+    # construct fn dictionary from the persisted manifest, rescanning only what changed
+    manifest = load_manifest(img_dir, mask_dir)
+    total_fns = manifest.fns
+    fn_dict = manifest.fn_dict()
+    # train/valid split, whole cars on either side
+    train_fns, valid_fns = manifest.split(300, seed=1)
+
+    mask_source = None
+    if args.train_masks_csv:
+        mask_source = RLEMaskSource(args.train_masks_csv)
+
+    # normalization statistics and caches of every stage are computed up front, with process pools forked
+    # before the tensorflow session exists
+    # batches are views into the prefetchers' uint8 rings: keras may hold its queue plus the batch in use
+    max_queue_size = 2
+    prepared = {}
+    for size, settings in stage_args.items():
+        normalize = None
+        if args.normalize:
+            normalize = normalize_data(train_fns, fn_dict, size + (channel,), decode=settings.decode,
+                                       processes=max(1, settings.workers))
+        cache = None
+        if args.cache_dir:
+            cache = build_cache(total_fns, fn_dict, size, grayscale, cache_dir=args.cache_dir,
+                                decode=settings.decode, mask_source=mask_source)
+        prepared[size] = (normalize, cache)
+
+    def make_loaders(stage, context):
+        size, stage_batch_size, _ = stage
+        normalize, cache = prepared[size]
+        settings = stage_args[size]
+        train_seq = CarvanaSequence(train_fns, fn_dict, target_size=size, grayscale=grayscale,
+                                    batch_size=stage_batch_size, shuffle=True, cache=cache, seed=args.seed,
+                                    data_aug=args.data_aug, decode=settings.decode, mask_source=mask_source,
+                                    mask_sampling=args.mask_sampling, crop=crop)
+        valid_seq = CarvanaSequence(valid_fns, fn_dict, target_size=size, grayscale=grayscale,
+                                    batch_size=stage_batch_size, cache=cache, decode=settings.decode,
+                                    mask_source=mask_source, mask_sampling=args.mask_sampling, crop=crop)
+        train_gen = Prefetcher(train_seq, workers=settings.workers, queue_depth=settings.queue_depth,
+                               hold=max_queue_size + 2, context=context)
+        valid_gen = Prefetcher(valid_seq, workers=max(1, settings.workers // 2) if settings.workers else 0,
+                               queue_depth=settings.queue_depth, hold=max_queue_size + 2, context=context)
+        return normalize, train_seq, valid_seq, train_gen, valid_gen
+
+    # only one stage's loader processes and rings are alive at a time: the first stage's are forked now,
+    # the later ones' are started from a forkserver (a fresh interpreter that has imported this script, but
+    # holds no session) when their stage begins
+    context = None
+    if len(stages) > 1:
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['__main__'])
+    stage_loaders = StageLoaders(stages, make_loaders, context)
 
     # load model and train
     # config gpu% use
@@ -72,47 +177,70 @@ if __name__ == "__main__":
         if len(args.gpus.split(',')) == 1:
             config.gpu_options.visible_device_list = args.gpus
         set_session(tf.Session(config=config))
-
-    train_gen = data_gen(train_fns, fn_dict, shuffle=True)
-    valid_gen = data_gen(valid_fns, fn_dict)
-
-    # single-gpu training
-    if len(args.gpus.split(',')) == 1:
-        # model = SimpleCNN(target_size, normalize=normalize)
-        model = unet(target_size, normalize=normalize)
-        checkpointer = ModelCheckpoint(filepath=filepath, verbose=1, save_best_only=True, monitor='val_dice_coef',
-                                       mode='max')
-        csvlogger = CSVLogger(filepath_dir + 'training.log')
+    n_gpus = len(args.gpus.split(','))
+
+    model = None
+    epoch = 0
+    report = []
+    for i, ((size, stage_batch_size, stage_epochs), loader) in enumerate(stage_loaders):
+        normalize, train_seq, valid_seq, train_gen, valid_gen = loader
+        stage_size = (crop or size) + (channel,)
+        previous = model
+        # single-gpu training
+        if n_gpus == 1:
+            # model = SimpleCNN(stage_size, normalize=normalize)
+            model = unet_family(stage_size, normalize=normalize, width=args.width, depth=args.depth,
+                                separable=args.separable, upsample=args.upsample)
+            train_model = model
+        # multi-gpu training
+        else:
+            with tf.device("/cpu:0"):
+                # model = SimpleCNN(stage_size, normalize=normalize)
+                model = unet_family(stage_size, normalize=normalize, width=args.width, depth=args.depth,
+                                    separable=args.separable, upsample=args.upsample)
+                train_model = multi_gpu_model(model, n_gpus)
+        # unet is fully convolutional: the weights of the previous resolution fit as they are
+        if previous is not None:
+            model.set_weights(previous.get_weights())
         model.compile(loss=bce_dc_loss, optimizer=rmsprop(1e-4), metrics=[dice_coef, 'accuracy'])
+        if train_model is not model:
+            train_model.compile(loss=bce_dc_loss, optimizer=rmsprop(1e-4), metrics=[dice_coef, 'accuracy'])
+
+        # checkpoints are taken from the cpu template, which shares its weights with the multi-gpu model;
+        # best_model.hdf5 is the best model at the final resolution
+        tag = '{}x{}'.format(*size)
+        best_filepath = filepath if i == len(stages) - 1 else filepath_dir + 'best_model-' + tag + '.hdf5'
+        checkpointer = AsyncModelCheckpoint(filepath_dir + 'epoch-{epoch:02d}-' + tag + '-{val_dice_coef:.4f}.hdf5',
+                                            monitor='val_dice_coef', verbose=1, mode='max',
+                                            template_model=model if train_model is not model else None,
+                                            keep_best=args.keep_best, keep_last=args.keep_last,
+                                            best_filepath=best_filepath)
+        csvlogger = CSVLogger(filepath_dir + 'training.log', append=epoch > 0)
+        profiler = PipelineProfiler(filepath_dir, loaders={'train': train_gen, 'valid': valid_gen},
+                                    filename='pipeline_profile.json' if len(stages) == 1 else
+                                    'pipeline_profile-' + tag + '.json')
+        print("stage {}/{}: {} batch size {} epochs {}-{}...".format(i + 1, len(stages), tag, stage_batch_size,
+                                                                    epoch + 1, epoch + stage_epochs))
+        now = time.time()
+        history = None
         try:
-            model.fit_generator(train_gen, steps_per_epoch=ceil(len(train_fns)/batch_size), epochs=epochs,
-                                validation_data=valid_gen, validation_steps=ceil(len(valid_fns)/batch_size),
-                                callbacks=[checkpointer, csvlogger])
+            history = train_model.fit_generator(train_gen, steps_per_epoch=len(train_seq), epochs=epoch + stage_epochs,
+                                                validation_data=valid_gen, validation_steps=len(valid_seq),
+                                                max_queue_size=max_queue_size, initial_epoch=epoch,
+                                                callbacks=[profiler.mark, checkpointer, profiler, csvlogger])
         except AttributeError:
             pass
-
-    # multi-gpu training
-    elif len(args.gpus.split(',')) > 1:
-        with tf.device("/cpu:0"):
-            # model = SimpleCNN(target_size, normalize=normalize)
-            model = unet(target_size, normalize=normalize)
-            multi_model = multi_gpu_model(model, len(args.gpus.split(',')))
-        # TODO: ModelCheckpoint does not work for multi_gpu_model yet. Make one that works!
-        # checkpointer = ModelCheckpoint(filepath=filepath, verbose=1, save_best_only=True, monitor='val_dice_coef',
-        #                                mode='max')
-        csvlogger = CSVLogger(filepath_dir + 'training.log')
-        model.compile(loss=bce_dc_loss, optimizer=rmsprop(1e-4), metrics=[dice_coef, 'accuracy'])
-        multi_model.compile(loss=bce_dc_loss, optimizer=rmsprop(1e-4), metrics=[dice_coef, 'accuracy'])
-        try:
-            multi_model.fit_generator(train_gen, steps_per_epoch=ceil(len(train_fns)/batch_size), epochs=epochs,
-                                validation_data=valid_gen, validation_steps=ceil(len(valid_fns)/batch_size),
-                                callbacks=[csvlogger])
-        except AttributeError:
-            pass
-        model.set_weights(multi_model.get_weights())
-        model.save(filepath=filepath)
-
-    else:
-        raise NotImplementedError("--gpus argument not understood. argument has to have form '0,1' or '1' ")
-
-
+        seconds = time.time() - now
+        dice = history.history.get('val_dice_coef', []) if history is not None else []
+        report.append({'stage': i + 1, 'target_size': list(size), 'batch_size': stage_batch_size,
+                       'epochs': stage_epochs, 'seconds': seconds, 'seconds_per_epoch': seconds / max(1, stage_epochs),
+                       'best_val_dice_coef': max(dice) if dice else None,
+                       'last_val_dice_coef': dice[-1] if dice else None})
+        epoch += stage_epochs
+
+    with open(filepath_dir + 'schedule.json', 'w') as f:
+        json.dump(report, f, indent=1)
+    for stage in report:
+        print("stage %d %4dx%-4d batch %2d: %3d epochs in %8.1fs (%6.1fs/epoch), val_dice_coef best %s last %s" % (
+            stage['stage'], stage['target_size'][0], stage['target_size'][1], stage['batch_size'], stage['epochs'],
+            stage['seconds'], stage['seconds_per_epoch'], stage['best_val_dice_coef'], stage['last_val_dice_coef']))
@@ -0,0 +1,86 @@
+import time
+import numpy as np
+from config import BATCH_SIZE
+from profiling import TimingStats, add_time
+
+# flips of [n, rows, cols, channel] arrays; each one is its own inverse
+TTA_TRANSFORMS = {
+    'identity': lambda x: x,
+    'hflip': lambda x: x[:, :, ::-1],
+    'vflip': lambda x: x[:, ::-1],
+    'hvflip': lambda x: x[:, ::-1, ::-1],
+}
+
+
+class TTAModel(object):
+    '''
+    test-time augmentation behind the prediction methods of a model: the transformed copies of a batch are
+    stacked into one batch of len(transforms) x n images and predicted in a single forward call, then the
+    outputs are flipped back and averaged on the host. the batch the wrapped model sees grows accordingly.
+    `stats` holds the per-batch 'stack', 'forward' and 'merge' times.
+
+    usage:
+        model = TTAModel(keras.models.load_model(path), ['identity', 'hflip'])
+        pred = model.predict_on_batch(batch_x)
+    '''
+    def __init__(self, model, transforms=('identity', 'hflip')):
+        unknown = [t for t in transforms if t not in TTA_TRANSFORMS]
+        if unknown or not transforms:
+            raise ValueError("tta transforms must be a non-empty subset of {}, got {}".format(
+                sorted(TTA_TRANSFORMS), list(transforms)))
+        self.model = model
+        self.transforms = list(transforms)
+        self.stats = TimingStats()
+
+    def predict_on_batch(self, x):
+        n = len(x)
+        timings = {}
+        start = time.time()
+        stacked = np.concatenate([TTA_TRANSFORMS[t](x) for t in self.transforms])
+        start = add_time(timings, 'stack', start)
+        pred = self.model.predict_on_batch(stacked)
+        start = add_time(timings, 'forward', start)
+        out = np.array(TTA_TRANSFORMS[self.transforms[0]](pred[:n]), dtype=np.float32)
+        for k, t in enumerate(self.transforms[1:], 1):
+            out += TTA_TRANSFORMS[t](pred[k * n:(k + 1) * n])
+        out /= len(self.transforms)
+        add_time(timings, 'merge', start)
+        self.stats.update(timings)
+        return out
+
+    def predict(self, x, batch_size=BATCH_SIZE, verbose=0):
+        return np.concatenate([self.predict_on_batch(x[i:i + batch_size]) for i in range(0, len(x), batch_size)])
+
+    def predict_generator(self, generator, steps, verbose=0, **kwargs):
+        '''
+        keras-compatible signature; batches are predicted in the calling thread as they come
+        '''
+        out = []
+        for i in range(steps):
+            x = next(generator)
+            out.append(self.predict_on_batch(x[0] if isinstance(x, tuple) else x))
+            if verbose:
+                print("\r{}/{}".format(i + 1, steps), end='')
+        if verbose:
+            print()
+        return np.concatenate(out)
+
+
+def tta_latency(model, x, transforms, batch_size=BATCH_SIZE, repeat=3):
+    '''
+    time the plain model and its TTAModel on the same images
+    :param x: uint8 [n, rows, cols, channel]
+    :return: {'plain', 'tta'} seconds per image of the best pass, their 'ratio' and the per-batch latency
+        histograms {'plain_batches', 'tta_batches'}
+    '''
+    from export import time_batches
+    tta = TTAModel(model, transforms)
+    # first calls build the graph for the plain and the stacked batch size
+    model.predict_on_batch(x[:batch_size])
+    tta.predict_on_batch(x[:batch_size])
+    _, plain, plain_rate = time_batches(model.predict_on_batch, x, batch_size, repeat)
+    _, stacked, tta_rate = time_batches(tta.predict_on_batch, x, batch_size, repeat)
+    report = {'transforms': list(transforms), 'images': len(x), 'plain': 1. / plain_rate, 'tta': 1. / tta_rate,
+              'plain_batches': plain.to_dict(), 'tta_batches': stacked.to_dict()}
+    report['ratio'] = report['tta'] / report['plain']
+    return report
@@ -1,6 +1,11 @@
 import os
 import glob
+import json
+import time
+import shutil
+import hashlib
 import cv2
+import h5py
 import keras
 import threading
 import numpy as np
@@ -10,8 +15,12 @@ import keras.backend as K
 from PIL import Image
 from keras.preprocessing.image import load_img
 from keras.callbacks import Callback, warnings
-from config import ORIGIN_SHAPE
-from multiprocessing.dummy import Pool as ThreadPool
+from config import ORIGIN_SHAPE, QUEUE_DEPTH
+from profiling import add_time
+from augment import augment_batch, augment_rng
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+from queue import Queue
 
 
 class MultiGPUModelCheckpoint(Callback):
@@ -66,17 +75,17 @@ class MultiGPUModelCheckpoint(Callback):
 
         if mode == 'min':
             self.monitor_op = np.less
-            self.best = np.Inf
+            self.best = np.inf
         elif mode == 'max':
             self.monitor_op = np.greater
-            self.best = -np.Inf
+            self.best = -np.inf
         else:
             if 'acc' in self.monitor or self.monitor.startswith('fmeasure'):
                 self.monitor_op = np.greater
-                self.best = -np.Inf
+                self.best = -np.inf
             else:
                 self.monitor_op = np.less
-                self.best = np.Inf
+                self.best = np.inf
 
     def on_epoch_end(self, epoch, logs=None):
         logs = logs or {}
@@ -97,10 +106,7 @@ class MultiGPUModelCheckpoint(Callback):
                                   % (epoch + 1, self.monitor, self.best,
                                      current, filepath))
                         self.best = current
-                        if self.save_weights_only:
-                            self.model.save_weights(filepath, overwrite=True)
-                        else:
-                            self.model.save(filepath, overwrite=True)
+                        self._save(filepath, epoch, logs)
                     else:
                         if self.verbose > 0:
                             print('Epoch %05d: %s did not improve' %
@@ -108,15 +114,425 @@ class MultiGPUModelCheckpoint(Callback):
             else:
                 if self.verbose > 0:
                     print('Epoch %05d: saving model to %s' % (epoch + 1, filepath))
-                if self.save_weights_only:
-                    self.model.save_weights(filepath, overwrite=True)
-                else:
-                    self.model.save(filepath, overwrite=True)
+                self._save(filepath, epoch, logs)
+
+    def _save(self, filepath, epoch, logs):
+        if self.save_weights_only:
+            self.model.save_weights(filepath, overwrite=True)
+        else:
+            self.model.save(filepath, overwrite=True)
+
+
+def _json_default(obj):
+    if hasattr(obj, 'get_config'):
+        return {'class_name': obj.__class__.__name__, 'config': obj.get_config()}
+    if type(obj).__module__ == np.__name__:
+        return obj.item() if np.ndim(obj) == 0 else obj.tolist()
+    if callable(obj):
+        return obj.__name__
+    raise TypeError('Not JSON Serializable: {}'.format(obj))
+
+
+def _weight_names(weights):
+    return [w.name if getattr(w, 'name', None) else 'param_' + str(i) for i, w in enumerate(weights)]
+
+
+# keras releases (major.minor) whose hdf5 layout of save_weights_to_hdf5_group and save_model write_checkpoint
+# reproduces; AsyncModelCheckpoint saves with keras itself under any other release
+CHECKPOINT_KERAS_VERSIONS = ('2.0', '2.1', '2.2')
+
+
+def checkpoint_layout_supported(version=None):
+    '''
+    :return: whether write_checkpoint writes the checkpoint layout of keras `version` (the installed one by default)
+    '''
+    version = str(keras.__version__ if version is None else version)
+    return '.'.join(version.split('.')[:2]) in CHECKPOINT_KERAS_VERSIONS
+
+
+def _write_weights(group, layers):
+    '''
+    write [(layer name, weight names, values)] in the layout of keras' save_weights_to_hdf5_group
+    '''
+    group.attrs['layer_names'] = [name.encode('utf8') for name, _, _ in layers]
+    group.attrs['backend'] = K.backend().encode('utf8')
+    group.attrs['keras_version'] = str(keras.__version__).encode('utf8')
+    for name, weight_names, values in layers:
+        g = group.create_group(name)
+        g.attrs['weight_names'] = [w.encode('utf8') for w in weight_names]
+        for weight_name, value in zip(weight_names, values):
+            g.create_dataset(weight_name, data=value)
+
+
+def write_checkpoint(filepath, snapshot):
+    '''
+    write a weight snapshot taken by AsyncModelCheckpoint to an hdf5 file keras can load back with
+    load_model (or load_weights for weights-only snapshots). the file is written next to `filepath` and
+    renamed over it, so readers never see a partial checkpoint. the layout is keras' own, as of the releases
+    in CHECKPOINT_KERAS_VERSIONS; ValueError under any other.
+    '''
+    if not checkpoint_layout_supported():
+        raise ValueError("write_checkpoint does not know the checkpoint layout of keras {}, supported: {}".format(
+            keras.__version__, ', '.join(CHECKPOINT_KERAS_VERSIONS)))
+    tmp = '{}.tmp{}'.format(filepath, os.getpid())
+    try:
+        with h5py.File(tmp, 'w') as f:
+            if snapshot['model_config'] is None:
+                _write_weights(f, snapshot['layers'])
+            else:
+                f.attrs['keras_version'] = str(keras.__version__).encode('utf8')
+                f.attrs['backend'] = K.backend().encode('utf8')
+                f.attrs['model_config'] = snapshot['model_config'].encode('utf8')
+                _write_weights(f.create_group('model_weights'), snapshot['layers'])
+                if snapshot['training_config'] is not None:
+                    f.attrs['training_config'] = snapshot['training_config'].encode('utf8')
+                if snapshot['optimizer_weights']:
+                    names, values = snapshot['optimizer_weights']
+                    g = f.create_group('optimizer_weights')
+                    g.attrs['weight_names'] = [w.encode('utf8') for w in names]
+                    for name, value in zip(names, values):
+                        g.create_dataset(name, data=value)
+            f.flush()
+        os.replace(tmp, filepath)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class AsyncModelCheckpoint(MultiGPUModelCheckpoint):
+    """MultiGPUModelCheckpoint that does not block training on hdf5 serialization.
+
+    At a checkpoint the weights (and optimizer state) are copied to host memory with a single
+    `K.batch_get_value` call; a background thread then writes them to a temporary file that is renamed
+    into place. At most one snapshot waits behind the one being written, so a slow disk shows up as
+    stall instead of unbounded memory. The time the training thread spends in this callback is added to
+    the epoch logs as `checkpoint_stall` (put this callback before CSVLogger to have it in training.log).
+
+    # Arguments
+        template_model: model to save instead of the trained one, e.g. the cpu template of a
+            `multi_gpu_model`; its weights are shared with the trained model. optimizer state is still
+            taken from the trained model.
+        keep_best: number of best checkpoints (by `monitor`) to keep on disk.
+        keep_last: number of most recent checkpoints to keep on disk.
+        best_filepath: if given, the best checkpoint so far is also copied (atomically) to this path.
+        include_optimizer: save the optimizer state with full models.
+
+    With keep_best or keep_last set, a checkpoint is deleted once it is neither among the `keep_best`
+    best nor among the `keep_last` latest ones; with neither set every checkpoint is kept. Use a
+    `filepath` with `{epoch}` in it when retaining more than one.
+
+    The files are written in keras' hdf5 layout by `write_checkpoint`. Under a keras release it does not
+    know (see CHECKPOINT_KERAS_VERSIONS), checkpoints are saved synchronously by keras instead.
+    `close()` (called by `on_train_end`) waits for the pending writes.
+    """
+
+    def __init__(self, filepath, monitor='val_loss', verbose=0, save_best_only=False, save_weights_only=False,
+                 mode='auto', period=1, template_model=None, keep_best=None, keep_last=None, best_filepath=None,
+                 include_optimizer=True):
+        super(AsyncModelCheckpoint, self).__init__(filepath, monitor, verbose, save_best_only, save_weights_only,
+                                                   mode, period)
+        self.template_model = template_model
+        self.keep_best = keep_best
+        self.keep_last = keep_last
+        self.best_filepath = best_filepath
+        self.include_optimizer = include_optimizer
+        self.saved = []
+        self.best_written = self.best
+        self.stall = []
+        self.errors = []
+        self.queue = None
+        self.writer = None
+        self.synchronous = not checkpoint_layout_supported()
+        if self.synchronous:
+            warnings.warn('keras %s is not in CHECKPOINT_KERAS_VERSIONS, checkpoints are saved synchronously' %
+                          keras.__version__, RuntimeWarning)
+
+    def on_train_begin(self, logs=None):
+        if self.synchronous:
+            return
+        self.queue = Queue(maxsize=1)
+        self.writer = threading.Thread(target=self._write_loop, name='checkpoint-writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def on_epoch_end(self, epoch, logs=None):
+        now = time.time()
+        super(AsyncModelCheckpoint, self).on_epoch_end(epoch, logs)
+        self._raise_errors()
+        stall = time.time() - now
+        self.stall.append(stall)
+        if logs is not None:
+            logs['checkpoint_stall'] = stall
+
+    def on_train_end(self, logs=None):
+        self.close()
+        if self.verbose > 0 and self.stall:
+            print("checkpoint stall: %.3fs total, %.3fs max per epoch" % (sum(self.stall), max(self.stall)))
+
+    def close(self):
+        '''
+        wait until the pending checkpoints are written and stop the writer; raises the first write error
+        '''
+        if self.writer is not None:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+        self._raise_errors()
+
+    def _raise_errors(self):
+        if self.errors:
+            raise self.errors.pop(0)
+
+    def snapshot(self):
+        '''
+        :return: host copy of everything write_checkpoint needs, taken on the calling thread
+        '''
+        model = self.template_model if self.template_model is not None else self.model
+        layers = [(layer.name, _weight_names(layer.weights), len(layer.weights)) for layer in model.layers]
+        weights = [w for layer in model.layers for w in layer.weights]
+        optimizer = getattr(self.model, 'optimizer', None)
+        full = not self.save_weights_only
+        optimizer_weights = getattr(optimizer, 'weights', []) if full and self.include_optimizer else []
+        values = K.batch_get_value(weights + optimizer_weights)
+        snapshot = {'model_config': None, 'training_config': None, 'optimizer_weights': None, 'layers': []}
+        i = 0
+        for name, names, n in layers:
+            snapshot['layers'].append((name, names, values[i:i + n]))
+            i += n
+        if full:
+            snapshot['model_config'] = json.dumps({'class_name': model.__class__.__name__,
+                                                   'config': model.get_config()}, default=_json_default)
+            if self.include_optimizer and optimizer is not None:
+                snapshot['training_config'] = json.dumps({
+                    'optimizer_config': {'class_name': optimizer.__class__.__name__,
+                                         'config': optimizer.get_config()},
+                    'loss': self.model.loss,
+                    'metrics': self.model.metrics,
+                    'sample_weight_mode': self.model.sample_weight_mode,
+                    'loss_weights': self.model.loss_weights}, default=_json_default)
+                snapshot['optimizer_weights'] = (_weight_names(optimizer_weights), values[i:])
+        return snapshot
+
+    def _save(self, filepath, epoch, logs):
+        if self.synchronous:
+            now = time.time()
+            model = self.template_model if self.template_model is not None else self.model
+            if self.save_weights_only:
+                model.save_weights(filepath, overwrite=True)
+            else:
+                model.save(filepath, overwrite=True, include_optimizer=self.include_optimizer)
+            self._written(filepath, epoch, logs.get(self.monitor), now)
+            return
+        snapshot = self.snapshot()
+        if self.writer is None:
+            self._write(filepath, epoch, logs.get(self.monitor), snapshot)
+        else:
+            self.queue.put((filepath, epoch, logs.get(self.monitor), snapshot))
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except BaseException as e:
+                self.errors.append(e)
+
+    def _write(self, filepath, epoch, score, snapshot):
+        now = time.time()
+        write_checkpoint(filepath, snapshot)
+        self._written(filepath, epoch, score, now)
+
+    def _written(self, filepath, epoch, score, start):
+        '''
+        retention and the copy to best_filepath after `filepath` was written
+        '''
+        self.saved = [c for c in self.saved if c[2] != filepath] + [(epoch, score, filepath)]
+        if self.best_filepath is not None and score is not None and self.monitor_op(score, self.best_written):
+            self.best_written = score
+            tmp = '{}.tmp{}'.format(self.best_filepath, os.getpid())
+            shutil.copyfile(filepath, tmp)
+            os.replace(tmp, self.best_filepath)
+        self._prune()
+        if self.verbose > 0:
+            print('Epoch %05d: checkpoint written to %s in %.2fs' % (epoch + 1, filepath, time.time() - start))
+
+    def _ranked(self):
+        scored = [c for c in self.saved if c[1] is not None]
+        return sorted(scored, key=lambda c: c[1], reverse=self.monitor_op == np.greater)
+
+    def _prune(self):
+        if self.keep_best is None and self.keep_last is None:
+            return
+        keep_last = self.keep_last or 0
+        keep = set(path for _, _, path in (self.saved[-keep_last:] if keep_last else []))
+        keep.update(path for _, _, path in self._ranked()[:self.keep_best or 0])
+        for c in [c for c in self.saved if c[2] not in keep]:
+            if os.path.exists(c[2]):
+                os.remove(c[2])
+            self.saved.remove(c)
+
+DECODE_BACKENDS = ('keras', 'draft', 'cv2')
+
+
+def _reduced_scale(size, target_size):
+    '''
+    :param size: (width, height) of the jpeg
+    :param target_size: tuple; (x, y)
+    :return: largest jpeg dct scale denominator that still decodes to at least target_size
+    '''
+    width, height = size
+    for scale in (8, 4, 2):
+        if -(-width // scale) >= target_size[1] and -(-height // scale) >= target_size[0]:
+            return scale
+    return 1
+
+
+def load_image(path, target_size=(256, 256), grayscale=True, backend='keras', timings=None):
+    '''
+    :param target_size: tuple; (x, y) as in keras load_img
+    :param backend: 'keras' decodes at full size with load_img; 'draft' (PIL Image.draft) and 'cv2'
+        (cv2.IMREAD_REDUCED_*) let libjpeg decode at 1/2, 1/4 or 1/8 scale first. all of them finish
+        with a nearest resize to target_size
+    :param timings: optional dict the 'decode' and 'resize' seconds are added to; load_img does both in
+        one call and is counted as decode
+    :return: uint8 [x, y, channel]; IOError if the file is missing or cannot be decoded
+    '''
+    start = time.time()
+    if backend == 'keras':
+        img = np.array(load_img(path, grayscale=grayscale, target_size=target_size), dtype=np.uint8)
+        add_time(timings, 'decode', start)
+    elif backend == 'draft':
+        img = Image.open(path)
+        img.draft('L' if grayscale else 'RGB', (target_size[1], target_size[0]))
+        img = img.convert('L' if grayscale else 'RGB')
+        start = add_time(timings, 'decode', start)
+        if img.size != (target_size[1], target_size[0]):
+            img = img.resize((target_size[1], target_size[0]), Image.NEAREST)
+        img = np.array(img, dtype=np.uint8)
+        add_time(timings, 'resize', start)
+    elif backend == 'cv2':
+        try:
+            with Image.open(path) as header:
+                scale = _reduced_scale(header.size, target_size)
+        except OSError as e:
+            raise IOError("could not read the jpeg header of {}: {}".format(path, e))
+        if grayscale:
+            flag = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                    8: cv2.IMREAD_REDUCED_GRAYSCALE_8}[scale]
+        else:
+            flag = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                    8: cv2.IMREAD_REDUCED_COLOR_8}[scale]
+        img = cv2.imread(path, flag)
+        if img is None:
+            raise IOError("cv2 could not read or decode {}".format(path))
+        start = add_time(timings, 'decode', start)
+        if img.shape[:2] != tuple(target_size):
+            img = cv2.resize(img, (target_size[1], target_size[0]), interpolation=cv2.INTER_NEAREST)
+        if not grayscale:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        add_time(timings, 'resize', start)
+    else:
+        raise ValueError("decode backend {} not understood, choose from {}".format(backend, DECODE_BACKENDS))
+    return img.reshape(tuple(target_size) + (1 if grayscale else 3,))
+
+
+class BatchRing(object):
+    '''
+    fixed ring of preallocated batch buffers: uint8 images [batch_size, x, y, channel] and masks
+    [batch_size, x, y, 1]. slot i is handed out again `size` batches later, so a batch stays valid as long as
+    its consumer holds fewer than `size` newer batches. with shared=True the buffers live in shared memory
+    and can be filled in place by worker processes.
+    '''
+    def __init__(self, size, batch_size, target_size=(256, 256), channel=1, masks=True, mask_dtype=np.uint8,
+                 shared=False):
+        self.size = size
+        self.x_shape = (batch_size,) + tuple(target_size) + (channel,)
+        self.y_shape = (batch_size,) + tuple(target_size) + (1,) if masks else None
+        self.mask_dtype = np.dtype(mask_dtype)
+        self.raw = None
+        if shared:
+            self.raw = [(RawArray('B', int(np.prod(self.x_shape))),
+                         RawArray('B', int(np.prod(self.y_shape)) * self.mask_dtype.itemsize) if masks else None)
+                        for _ in range(size)]
+        self._views()
+
+    def _views(self):
+        if self.raw is None:
+            self.x = [np.zeros(self.x_shape, dtype=np.uint8) for _ in range(self.size)]
+            self.y = [np.zeros(self.y_shape, dtype=self.mask_dtype) if self.y_shape else None
+                      for _ in range(self.size)]
+        else:
+            self.x = [np.frombuffer(x, dtype=np.uint8).reshape(self.x_shape) for x, _ in self.raw]
+            self.y = [np.frombuffer(y, dtype=self.mask_dtype).reshape(self.y_shape) if y is not None else None
+                      for _, y in self.raw]
+
+    def __getstate__(self):
+        if self.raw is None:
+            raise ValueError("only shared batch rings can be sent to other processes")
+        state = self.__dict__.copy()
+        state['x'] = None
+        state['y'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._views()
+
+    def __len__(self):
+        return self.size
+
+    def slot(self, i):
+        '''
+        :return: (batch_x, batch_y) buffers of slot i % size; batch_y is None without masks
+        '''
+        return self.x[i % self.size], self.y[i % self.size]
+
+
+def fill_batch(batch_x, batch_y, fns, fn_dict, target_size=(256, 256), grayscale=True, cache=None, decode='keras',
+               mask_source=None, mask_sampling='nearest', timings=None):
+    '''
+    load the images (and the masks, unless batch_y is None) of `fns` into the first len(fns) rows of
+    preallocated buffers. images are stored as uint8 in [0, 255]; masks as {0, 1} in a uint8 buffer, or as
+    coverage fractions in a float buffer.
+    :param timings: optional dict the seconds spent in 'cache', 'decode', 'resize', 'mask' and 'assemble'
+        (copies into the buffers) are added to
+    :return: number of rows filled
+    '''
+    n = len(fns)
+    start = time.time()
+    if cache is not None:
+        x, y = cache.get_batch(fns)
+        start = add_time(timings, 'cache', start)
+        batch_x[:n] = x
+        if batch_y is not None:
+            batch_y[:n] = y
+        add_time(timings, 'assemble', start)
+        return n
+    for i, fn in enumerate(fns):
+        img = load_image(fn_dict[fn][0], target_size, grayscale, decode, timings)
+        start = time.time()
+        batch_x[i] = img
+        start = add_time(timings, 'assemble', start)
+        if batch_y is not None:
+            if mask_source is not None:
+                mask = mask_source.get(fn, target_size, mask_sampling)
+            else:
+                mask = np.array(load_img(fn_dict[fn][1], grayscale=True, target_size=target_size))
+            start = add_time(timings, 'mask', start)
+            if batch_y.dtype == np.uint8:
+                batch_y[i, :, :, 0] = mask > 127
+            else:
+                batch_y[i, :, :, 0] = mask / 255.
+            add_time(timings, 'assemble', start)
+    return n
+
 
 # threadsafe generator
 class DataIterator(object):
     def __init__(self,fns, fn_dict, target_size=(256,256), grayscale=True, batch_size=2, data_aug=False, shuffle=False,
-             test=False):
+             test=False, cache=None, decode='keras', mask_source=None, ring_size=QUEUE_DEPTH + 2, seed=1):
         self.fns = fns
         self.fn_dict = fn_dict
         self.target_size = target_size
@@ -125,6 +541,11 @@ class DataIterator(object):
         self.data_aug = data_aug
         self.shuffle = shuffle
         self.test = test
+        self.cache = cache
+        self.decode = decode
+        self.mask_source = mask_source
+        self.seed = seed
+        self.ring = BatchRing(ring_size, batch_size, target_size, 1 if grayscale else 3, masks=not test)
         self.lock = threading.Lock()
         self.datagenerator = self.data_gen()
 
@@ -138,68 +559,38 @@ class DataIterator(object):
 
     def data_gen(self):
         idx = 0
-        batch_x = np.zeros((self.batch_size,) + self.target_size + (3,))
-        batch_y = np.zeros((self.batch_size,) + self.target_size + (1,))
-        if self.shuffle:
-            fns = np.random.permutation(self.fns)
-        if self.grayscale:
-            batch_x = np.zeros((self.batch_size,) + self.target_size + (1,))
+        step = 0
         while True:
-            if not self.test:
-                for i, fn in enumerate(self.fns[idx: (idx + self.batch_size)]):
-                    img = load_img(self.fn_dict[fn][0], grayscale=self.grayscale, target_size=self.target_size)
-                    mask = load_img(self.fn_dict[fn][1], grayscale=True, target_size=self.target_size)
-                    if self.grayscale:
-                        batch_x[i] = np.array(img, dtype='float32')[:, :, np.newaxis]
-                    else:
-                        batch_x[i] = np.array(img, dtype='float32')
-                    batch_y[i] = np.array(mask, dtype='float32')[:, :, np.newaxis]
-                idx += self.batch_size
-                yield batch_x, batch_y / 255.
-            else:
-                for i, fn in enumerate(self.fns[idx: (idx + self.batch_size)]):
-                    img = load_img(self.fn_dict[fn][0], grayscale=self.grayscale, target_size=self.target_size)
-                    if self.grayscale:
-                        batch_x[i] = np.array(img, dtype='float32')[:, :, np.newaxis]
-                    else:
-                        batch_x[i] = np.array(img, dtype='float32')
-                idx += self.batch_size
-                yield batch_x, None
+            batch_x, batch_y = self.ring.slot(step)
+            step += 1
+            batch_fns = self.fns[idx: (idx + self.batch_size)]
+            n = fill_batch(batch_x, batch_y, batch_fns, self.fn_dict, self.target_size, self.grayscale, self.cache,
+                           self.decode, self.mask_source)
+            if self.data_aug:
+                augment_batch(batch_x[:n], None if batch_y is None else batch_y[:n],
+                              augment_rng(self.seed, 0, step - 1))
+            idx += self.batch_size
+            yield batch_x, batch_y
 
 
 class DataGenerator(DataIterator):
     def __init__(self, **kwargs):
         super(DataGenerator, self).__init__(**kwargs)
+        self.idx = 0
 
     def __next__(self):
-        idx = 0
-        batch_x = np.zeros((self.batch_size,) + self.target_size + (3,))
-        batch_y = np.zeros((self.batch_size,) + self.target_size + (1,))
-        if self.shuffle:
-            fns = np.random.permutation(self.fns)
-        if self.grayscale:
-            batch_x = np.zeros((self.batch_size,) + self.target_size + (1,))
-        while True:
-            if not self.test:
-                for i, fn in enumerate(self.fns[idx: (idx + self.batch_size)]):
-                    img = load_img(self.fn_dict[fn][0], grayscale=self.grayscale, target_size=self.target_size)
-                    mask = load_img(self.fn_dict[fn][1], grayscale=True, target_size=self.target_size)
-                    if self.grayscale:
-                        batch_x[i] = np.array(img, dtype='float32')[:, :, np.newaxis]
-                    else:
-                        batch_x[i] = np.array(img, dtype='float32')
-                    batch_y[i] = np.array(mask, dtype='float32')[:, :, np.newaxis]
-                idx += self.batch_size
-                return batch_x, batch_y / 255.
-            else:
-                for i, fn in enumerate(self.fns[idx: (idx + self.batch_size)]):
-                    img = load_img(self.fn_dict[fn][0], grayscale=self.grayscale, target_size=self.target_size)
-                    if self.grayscale:
-                        batch_x[i] = np.array(img, dtype='float32')[:, :, np.newaxis]
-                    else:
-                        batch_x[i] = np.array(img, dtype='float32')
-                idx += self.batch_size
-                return batch_x
+        channel = 1 if self.grayscale else 3
+        batch_x = np.zeros((self.batch_size,) + self.target_size + (channel,), dtype=np.uint8)
+        batch_y = None if self.test else np.zeros((self.batch_size,) + self.target_size + (1,), dtype=np.uint8)
+        batch_fns = self.fns[self.idx: (self.idx + self.batch_size)]
+        fill_batch(batch_x, batch_y, batch_fns, self.fn_dict, self.target_size, self.grayscale, self.cache,
+                   self.decode, self.mask_source)
+        if self.data_aug:
+            augment_batch(batch_x, batch_y, augment_rng(self.seed, 0, self.idx // self.batch_size))
+        self.idx += self.batch_size
+        if self.test:
+            return batch_x
+        return batch_x, batch_y
 
 
 def rle_decode(x, shape=(1918, 1280)):
@@ -225,6 +616,7 @@ def rle_encode(x, mode='faster'):
         x[-1] = 0
         runs = np.where(x[1:] != x[:-1])[0] + 2
         runs[1::2] = runs[1::2] - runs[:-1:2]
+        out = [str(r) for r in runs]
 
     elif mode == 'fast':
         ones = np.where(x == 1)[0]
@@ -251,6 +643,53 @@ def rle_encode(x, mode='faster'):
     return ' '.join(out)
 
 
+def rle_encode_batch(x):
+    '''
+    vectorized equivalent of [rle_encode(a, mode='faster') for a in x]
+    :param x: predictions or masks; [n, height, width] or [n, height, width, 1]
+    :return: list of n rle strings
+    '''
+    x = np.asarray(x)
+    n = x.shape[0]
+    x = x.reshape(n, -1) > 0.5
+    x[:, 0] = False
+    x[:, -1] = False
+    # one run-boundary pass over the whole batch; boundaries alternate start/end inside every image
+    boundaries = np.flatnonzero(x[:, 1:] != x[:, :-1])
+    rows, cols = np.divmod(boundaries, x.shape[1] - 1)
+    runs = cols + 2
+    runs[1::2] -= runs[0::2]
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n))])
+    tokens = list(map(str, runs.tolist()))
+    return [' '.join(tokens[bounds[i]:bounds[i + 1]]) for i in range(n)]
+
+
+def rle_decode_batch(xs, shape=(1918, 1280)):
+    '''
+    vectorized equivalent of np.stack([rle_decode(x, shape) for x in xs])
+    :param xs: list of rle strings
+    :return: uint8 [n, height, width]
+    '''
+    width, height = shape
+    n = width*height
+    counts = np.array([len(x.split()) // 2 for x in xs], dtype=np.int64)
+    values = np.array(' '.join(xs).split(), dtype=np.int64)
+    offsets = np.repeat(np.arange(len(xs), dtype=np.int64) * n, counts)
+    starts = np.clip(values[0::2] - 1, 0, n)  # rle index starts at 1, matrix index starts at 0
+    ends = np.clip(starts + values[1::2], 0, n)
+    # alternating gap/run boundaries over the whole batch; the running max merges overlapping runs
+    points = np.empty(2 * len(starts) + 2, dtype=np.int64)
+    points[0] = 0
+    points[1:-1:2] = starts + offsets
+    points[2:-1:2] = ends + offsets
+    points[-1] = len(xs) * n
+    points = np.maximum.accumulate(points)
+    values = np.zeros(len(points) - 1, dtype=np.uint8)
+    values[1::2] = 1
+    img = np.repeat(values, np.diff(points))
+    return img.reshape((len(xs), height, width))
+
+
 def dice_coef(y_true, y_pred):
     y_pred = K.cast(K.greater_equal(y_pred, 0.5), dtype='float32')
     num = K.sum(2*y_true * y_pred, axis=[1,2,3]) + 1e-5
@@ -263,71 +702,148 @@ def bce_dc_loss(y_true, y_pred):
     return keras.losses.binary_crossentropy(y_true, y_pred) - dice_coef(y_true, y_pred)
 
 
-def normalize_data(fns, fn_dict, target_size):
+class ChannelStats(object):
+    '''
+    online per-channel mean/variance. partial results from different images or processes are combined
+    with the pairwise (Chan et al.) update, so the order of merging does not matter.
+    '''
+    def __init__(self, channel=1):
+        self.count = 0
+        self.mean = np.zeros(channel)
+        self.m2 = np.zeros(channel)
+
+    def update(self, img):
+        '''
+        :param img: [x, y, channel]
+        '''
+        img = np.asarray(img, dtype=np.float64).reshape(-1, self.mean.shape[0])
+        other = ChannelStats(self.mean.shape[0])
+        other.count = img.shape[0]
+        other.mean = img.mean(axis=0)
+        other.m2 = ((img - other.mean) ** 2).sum(axis=0)
+        return self.merge(other)
+
+    def merge(self, other):
+        count = self.count + other.count
+        if count == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / float(count)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / float(count)
+        self.count = count
+        return self
+
+    @property
+    def var(self):
+        return self.m2 / max(self.count, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+
+def _stats_chunk(args):
+    paths, target_size, grayscale, decode = args
+    stats = ChannelStats(1 if grayscale else 3)
+    for path in paths:
+        stats.update(load_image(path, target_size, grayscale, decode))
+    return stats
+
+
+def stats_key(fns, target_size, grayscale, decode='keras'):
+    '''
+    :return: key of the dataset statistics of (file list, target_size, grayscale, decode)
+    '''
+    h = hashlib.sha1('\n'.join(sorted(fns)).encode())
+    return '{}-{}-{}-{}-{}'.format(h.hexdigest()[:16], target_size[0], target_size[1], 1 if grayscale else 3, decode)
+
+
+def dataset_stats(fns, fn_dict, target_size=(256, 256), grayscale=True, decode='keras',
+                  stats_path='experiment/dataset_stats.json', processes=5, chunk=64):
+    '''
+    per-channel pixel statistics of the images, computed over worker processes without holding the dataset
+    in memory. results are stored in `stats_path` under stats_key(...) and read back on the next call.
+    :param target_size: tuple; (x, y)
+    :return: {'count': pixels per channel, 'mean': [...], 'var': [...], 'std': [...]}
+    '''
+    key = stats_key(fns, target_size, grayscale, decode)
+    stored = {}
+    if stats_path and os.path.isfile(stats_path):
+        with open(stats_path) as f:
+            stored = json.load(f)
+        if key in stored:
+            return stored[key]
+
+    paths = [fn_dict[fn][0] for fn in sorted(fns)]
+    tasks = [(paths[i:i + chunk], tuple(target_size), grayscale, decode) for i in range(0, len(paths), chunk)]
+    stats = ChannelStats(1 if grayscale else 3)
+    pool = Pool(processes)
+    for partial in pool.imap_unordered(_stats_chunk, tasks):
+        stats.merge(partial)
+    pool.close()
+    pool.join()
+    print("data statistics computed for {} images...".format(len(paths)))
+
+    result = {'count': stats.count, 'mean': stats.mean.tolist(), 'var': stats.var.tolist(),
+              'std': stats.std.tolist()}
+    if stats_path:
+        if os.path.dirname(stats_path) and not os.path.isdir(os.path.dirname(stats_path)):
+            os.makedirs(os.path.dirname(stats_path))
+        stored[key] = result
+        with open(stats_path + '.tmp', 'w') as f:
+            json.dump(stored, f, indent=2)
+        os.replace(stats_path + '.tmp', stats_path)
+    return result
+
+
+def normalize_data(fns, fn_dict, target_size, decode='keras', stats_path='experiment/dataset_stats.json',
+                   processes=5):
     '''
     :param fns: filenames
     :param target_size: tuple; (x, y, channel)
+    :param decode: jpeg decode backend, see load_image
+    :param stats_path: json file caching the statistics, see dataset_stats
+    :param processes: worker processes computing them
     :return: channelwise normalization
     '''
-    n = len(fns)
     x, y, channel = target_size
     grayscale = True
     if channel > 1:
         grayscale = False
-    pool = ThreadPool(5)
-
-    def map_func(fn):
-        img_dir = fn_dict[fn][0]
-        out = np.array(load_img(img_dir, target_size=(x, y), grayscale=grayscale), dtype='float32')[np.newaxis,:]
-        if grayscale:
-            out = out[:,:,:,np.newaxis]
-        return out
-
-    data = pool.map(map_func, fns)
-    pool.close()
-    pool.join()
-    data = np.concatenate(data)
-    print("data normalized for {} images...".format(n))
-    return np.mean(data, (0,1,2))
+    stats = dataset_stats(fns, fn_dict, (x, y), grayscale, decode, stats_path, processes)
+    print("data normalized for {} images...".format(len(fns)))
+    return np.array(stats['mean'], dtype='float32')
 
 
 def data_gen(fns, fn_dict, target_size=(256,256), grayscale=True, batch_size=2, data_aug=False, shuffle=False,
-             test=False):
+             test=False, cache=None, decode='keras', ring_size=QUEUE_DEPTH + 2, seed=1):
     '''
     :param fns: list of filenames
     :param fn_dict: {'fn':['path/to/img', 'path/to/mask']}
+    :param cache: optional cache.DatasetCache built for (target_size, grayscale); batches are then read from
+        its memory-mapped shards instead of decoding every file
+    :param decode: jpeg decode backend, see load_image
+    :param ring_size: number of uint8 batch buffers cycled through; a yielded batch is overwritten
+        ring_size steps later
+    :param data_aug: augment every batch, see augment.augment_batch; batch i is seeded by (seed, 0, i)
     :return:
     '''
-    lock = threading.Lock()
-    with lock:
-        idx = 0
-        batch_x = np.zeros((batch_size, ) + target_size + (3, ))
-        batch_y = np.zeros((batch_size, ) + target_size + (1, ))
-        if shuffle:
-            fns = np.random.permutation(fns)
-        if grayscale:
-            batch_x = np.zeros((batch_size, ) + target_size + (1,))
-        while True:
-            if not test:
-                for i, fn in enumerate(fns[idx : (idx + batch_size)]):
-                    img = load_img(fn_dict[fn][0], grayscale=grayscale, target_size=target_size)
-                    mask = load_img(fn_dict[fn][1], grayscale=True, target_size=target_size)
-                    if grayscale:
-                        batch_x[i] = np.array(img, dtype='float32')[:,:,np.newaxis]
-                    else:
-                        batch_x[i] = np.array(img, dtype='float32')
-                    batch_y[i] = np.array(mask, dtype='float32')[:,:,np.newaxis]
-                idx += batch_size
-                yield batch_x, batch_y/255.
-            else:
-                for i, fn in enumerate(fns[idx : (idx + batch_size)]):
-                    img = load_img(fn_dict[fn][0], grayscale=grayscale, target_size=target_size)
-                    if grayscale:
-                        batch_x[i] = np.array(img, dtype='float32')[:,:,np.newaxis]
-                    else:
-                        batch_x[i] = np.array(img, dtype='float32')
-                idx += batch_size
-                yield batch_x
+    idx = 0
+    step = 0
+    ring = BatchRing(ring_size, batch_size, target_size, 1 if grayscale else 3, masks=not test)
+    if shuffle:
+        fns = np.random.permutation(fns)
+    while True:
+        batch_x, batch_y = ring.slot(step)
+        step += 1
+        n = fill_batch(batch_x, batch_y, fns[idx : (idx + batch_size)], fn_dict, target_size, grayscale, cache, decode)
+        if data_aug:
+            augment_batch(batch_x[:n], None if batch_y is None else batch_y[:n], augment_rng(seed, 0, step - 1))
+        idx += batch_size
+        if test:
+            yield batch_x
+        else:
+            yield batch_x, batch_y
 
 
 def parse_model_name(x):
@@ -339,6 +855,28 @@ def parse_model_name(x):
     return target_size, grayscale
 
 
+def parse_schedule(schedule, batch_size=2, epochs=10):
+    '''
+    :param schedule: comma separated training stages 'SIZE[xSIZE][:BATCH_SIZE[:EPOCHS]]', e.g.
+        '128:8:4,256:4:3,512:2:3'; a missing batch size or epoch count falls back to the defaults
+    :return: [((x, y), batch_size, epochs)] per stage
+    '''
+    stages = []
+    for stage in schedule.split(','):
+        fields = stage.strip().split(':')
+        if not 1 <= len(fields) <= 3 or not fields[0]:
+            raise ValueError("schedule stage {!r} not understood, expected SIZE[xSIZE][:BATCH_SIZE[:EPOCHS]]".format(
+                stage))
+        size = [int(v) for v in fields[0].split('x')]
+        if len(size) > 2:
+            raise ValueError("schedule stage {!r} has more than 2 dimensions, the channels come from --grayscale"
+                             .format(stage))
+        size = (size[0], size[-1])
+        stages.append((size, int(fields[1]) if len(fields) > 1 and fields[1] else batch_size,
+                       int(fields[2]) if len(fields) > 2 and fields[2] else epochs))
+    return stages
+
+
 def resize_mask_matrix(x, size):
     '''
     :param x: mask matrix: [x, y, c]
@@ -346,10 +884,97 @@ def resize_mask_matrix(x, size):
     '''
     x = np.uint8(x[:,:,-1] > 0.5)*255
     x_im = Image.fromarray(x)
-    out = np.array(x_im.resize(size)) / 255.
+    out = np.array(x_im.resize(size, Image.NEAREST)) / 255.
     return out[:, :, np.newaxis]
 
 
 def resize_mask_matrix_encode(x, size=ORIGIN_SHAPE):
     x_resize = resize_mask_matrix(x, size)
     return rle_encode(x_resize, mode='faster')
+
+
+def resize_mask_batch(x, size=ORIGIN_SHAPE):
+    '''
+    batched resize_mask_matrix
+    :param x: predictions; [n, x, y, c]
+    :return: bool [n, size[1], size[0]] thresholded masks
+    '''
+    return np.stack([np.array(Image.fromarray(np.uint8(a[:, :, -1] > 0.5)*255).resize(size, Image.NEAREST)) > 127
+                     for a in x])
+
+
+def nearest_index_map(n_in, n_out):
+    '''
+    :return: source index sampled by PIL's nearest-neighbour resize for each of the n_out output positions;
+        the coordinate is accumulated step by step in double precision exactly like PIL does
+    '''
+    scale = n_in / float(n_out)
+    steps = np.full(n_out, scale)
+    steps[0] = scale * 0.5
+    return np.minimum(np.add.accumulate(steps).astype(np.int64), n_in - 1)
+
+
+def resized_mask_runs(x, size=ORIGIN_SHAPE):
+    '''
+    runs of the flattened mask resize_mask_matrix_encode(x, size) encodes, without materializing the full-size
+    mask: runs are found on the low resolution mask and expanded through the row/column maps of the nearest
+    resize
+    :param x: prediction; [x, y, c]
+    :param size: (width, height) of the mask
+    :return: int64 (starts, ends) of the runs, 0-based and half-open
+    '''
+    m = x[:, :, -1] > 0.5
+    width, height = size
+    cmap = nearest_index_map(m.shape[1], width)
+    rmap = nearest_index_map(m.shape[0], height)
+    # sampled source columns and the output column span each of them covers
+    cols, first = np.unique(cmap, return_index=True)
+    last = np.append(first[1:], width)
+    m = np.pad(m[:, cols], ((0, 0), (1, 1)), mode='constant').view(np.int8)
+    rows, pos = np.nonzero(np.diff(m, axis=1))
+    run_rows = rows[0::2]
+    run_starts = first[pos[0::2]]
+    run_ends = last[pos[1::2] - 1]
+    # repeat the runs of every source row for each output row sampling it
+    counts = np.bincount(run_rows, minlength=m.shape[0])
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    row_counts = counts[rmap]
+    total = row_counts.sum()
+    out_rows = np.repeat(np.arange(height, dtype=np.int64), row_counts)
+    idx = np.repeat(offsets[rmap] - np.concatenate([[0], np.cumsum(row_counts)[:-1]]), row_counts) + np.arange(total)
+    starts = run_starts[idx] + out_rows * width
+    ends = run_ends[idx] + out_rows * width
+    # runs touching across a row boundary are a single run in the flattened mask
+    split = starts[1:] != ends[:-1]
+    starts = starts[np.concatenate([[True], split])[:len(starts)]]
+    ends = ends[np.concatenate([split, [True]])[:len(ends)]]
+    # rle_encode(mode='faster') zeroes the first and the last pixel
+    if len(starts) and starts[0] == 0:
+        starts[0] = 1
+    if len(ends) and ends[-1] == width * height:
+        ends[-1] -= 1
+    keep = ends > starts
+    return starts[keep], ends[keep]
+
+
+def rle_encode_resized(x, size=ORIGIN_SHAPE):
+    '''
+    same string as resize_mask_matrix_encode(x, size), see resized_mask_runs
+    :param x: prediction; [x, y, c]
+    :param size: (width, height) of the encoded mask
+    :return: rle string
+    '''
+    starts, ends = resized_mask_runs(x, size)
+    runs = np.empty(2 * len(starts), dtype=np.int64)
+    runs[0::2] = starts + 1
+    runs[1::2] = ends - starts
+    return ' '.join(map(str, runs.tolist()))
+
+
+def resize_mask_matrix_encode_batch(x, size=ORIGIN_SHAPE):
+    '''
+    batched resize_mask_matrix_encode
+    :param x: predictions; [n, x, y, c]
+    :return: list of n rle strings
+    '''
+    return [rle_encode_resized(a, size) for a in x]